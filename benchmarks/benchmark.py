@@ -0,0 +1,431 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Benchmarks of T-Mart: photon throughput of representative scenes, time of the kernels and the AEC stages
+
+# Each scene runs in a fresh process, its wall time, time of each stage, photons per second and peak memory
+# are printed and can be saved as a JSON baseline to compare later versions against:
+#
+#   python benchmarks/benchmark.py                            # all scenes
+#   python benchmarks/benchmark.py --save baseline.json
+#   python benchmarks/benchmark.py --compare baseline.json    # exit status 1 if a scene got slower
+#   python benchmarks/benchmark.py --scenes flat_water rough_DEM --n_photon 2000 --AEC_size 1980
+#
+# Without the 6S executable, or with --stand_in, 6S is replaced by an analytical stand-in, see use_stand_in.
+# The stand-in is never written to the 6S cache. Results of the two are not comparable.
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.insert(0, two_up)
+
+import os, io, json, time, platform, subprocess, tempfile, contextlib, argparse
+import numpy as np
+
+SCENES = ['flat_water', 'rough_DEM', 'surface_rho', 'kernels', 'AEC']
+
+# Relative change of a time or memory use reported as a regression
+TOLERANCE = 0.2
+
+# Stages shorter than this in the baseline are not compared, in seconds
+MIN_TIME = 0.2
+
+
+### 6S stand-in
+
+# Rayleigh optical thickness of the atmosphere, Hansen and Travis 1974, wl in um
+def _rayleigh_OT(wl):
+    return 0.008569 * wl**-4 * (1 + 0.0113 * wl**-2 + 0.00013 * wl**-4)
+
+def _stand_in_atm_profile_wl(self, band):
+    wl = self.wl / 1000
+    weights = np.exp(-self.layers_alts_mean / 8) # scale height of molecules, km
+    weights = weights / weights.sum()
+
+    # Ozone (Chappuis band) and a little of everything else
+    ot_molecule = 0.03 * np.exp(-((self.wl - 600) / 80)**2) + 0.005
+    return ot_molecule * weights, _rayleigh_OT(wl) * weights
+
+def _stand_in_aerosol_wl(self, band):
+    EXT_r550 = (self.wl / 550) ** -1.0 # Angstrom exponent of 1
+    SSA = 0.98
+    ot_mie = self.aot550 * EXT_r550 * SSA
+    ot_aerosol = self.aot550 * EXT_r550 - ot_mie
+
+    conc_relative = np.exp(-self.layers_alts_mean/self.aerosol_scale_height)
+    conc_normalized = conc_relative / np.sum(conc_relative)
+    return ot_mie * conc_normalized, ot_aerosol * conc_normalized
+
+def _stand_in_irradiance_fit(*args, **kwargs):
+    return np.poly1d([-0.02, -0.05, 1.0])
+
+# Minimal Py6S for the objects T-Mart creates before 6S runs
+def _stand_in_Py6S():
+    import types
+
+    class AtmosProfile():
+        MidlatitudeSummer = 2
+        def PredefinedType(atm_type): return ('PredefinedType', atm_type)
+        def UserWaterAndOzone(water, ozone): return ('UserWaterAndOzone', water, ozone)
+
+    Py6S = types.ModuleType('Py6S')
+    Py6S.Params = types.ModuleType('Py6S.Params')
+    Py6S.Params.atmosprofile = types.ModuleType('Py6S.Params.atmosprofile')
+    Py6S.Params.atmosprofile.AtmosProfile = AtmosProfile
+    for module in [Py6S, Py6S.Params, Py6S.Params.atmosprofile]:
+        sys.modules[module.__name__] = module
+
+
+def use_stand_in(force = False):
+    '''Replace 6S with the stand-in if forced or if 6S cannot run here, return True if replaced.
+    Optical thicknesses are analytical, the irradiance correction is a fixed polynomial.'''
+
+    import tmart
+
+    try:
+        import Py6S
+        available = Py6S.SixS()._find_path() is not None
+    except ImportError:
+        _stand_in_Py6S()
+        available = False
+
+    if available and not force:
+        return False
+
+    # Replaces the cached 6S outputs, so nothing is written to the cache
+    tmart.Atmosphere._atm_profile_wl = _stand_in_atm_profile_wl
+    tmart.Atmosphere._aerosol_wl = _stand_in_aerosol_wl
+    tmart.AEC.irradiance_fit = _stand_in_irradiance_fit
+    return True
+
+
+### Scenes, each returns the number of photons traced
+
+class Timer():
+    '''Wall time of the stages of a scene.'''
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+
+def _atmosphere(aot550 = 0.1):
+    import tmart
+    from Py6S.Params.atmosprofile import AtmosProfile
+    atm_profile = AtmosProfile.PredefinedType(AtmosProfile.MidlatitudeSummer)
+    return tmart.Atmosphere(atm_profile, aot550 = aot550, aerosol_type = 'Maritime')
+
+
+# Rough terrain with a lake in the middle
+def _rough_surface(size = 101, cell_size = 30):
+    import tmart
+
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 2 * np.pi, size)
+    DEM = np.zeros((size, size))
+    for i in range(6):
+        kx, ky, phase = rng.integers(1, 8), rng.integers(1, 8), rng.uniform(0, 2*np.pi)
+        DEM += rng.uniform(50, 150) * np.sin(kx * x[None, :] + phase) * np.cos(ky * x[:, None])
+    DEM += rng.normal(0, 10, DEM.shape)
+
+    yy, xx = np.mgrid[0:size, 0:size] - size // 2
+    isWater = (xx**2 + yy**2 < (size // 6)**2).astype(int)
+    DEM = np.where(isWater, 0, np.maximum(DEM - DEM.min() + 1, 1))
+    reflectance = np.where(isWater, 0.02, rng.uniform(0.05, 0.3, DEM.shape))
+
+    my_surface = tmart.Surface(DEM = DEM, reflectance = reflectance, isWater = isWater, cell_size = cell_size)
+    my_surface.set_background(bg_ref = 0.1, bg_isWater = 0, bg_elevation = 0)
+    return my_surface
+
+
+# As in AEC.get_parameters: flat water, the sensor looks at the centre of the window
+def scene_flat_water(timer, args):
+    import tmart
+
+    window_size, cell_size = 101, 180
+    with timer.stage('setup'):
+        my_surface = tmart.Surface(DEM = np.full((window_size, window_size), 0),
+                                   reflectance = np.full((window_size, window_size), 0.02),
+                                   isWater = np.full((window_size, window_size), 1), cell_size = cell_size)
+        my_surface.set_background(bg_isWater = 1)
+        my_tmart = tmart.Tmart(Surface = my_surface, Atmosphere = _atmosphere(), shadow = False)
+        my_tmart.set_wind(wind_speed = 1, wind_azi_avg = True)
+        my_tmart.set_geometry(target_pt_direction = [170, 90], pixel = [window_size//2, window_size//2], sun_dir = [40, 270])
+        bins = np.linspace(0, cell_size * window_size, window_size + 1)
+
+    with tmart.TmartPool(args.nc) as pool:
+        with timer.stage('run'):
+            results = my_tmart.run(wl = 865, n_photon = args.n_photon, njobs = args.njobs, engine = args.engine,
+                                   streaming = True, hist_bins = [bins, bins], pool = pool, seed = 1)
+    with timer.stage('calc_ref'):
+        tmart.calc_ref(results, detail = True)
+    return args.n_photon
+
+
+# Mountains and a lake, with shadows
+def scene_rough_DEM(timer, args):
+    import tmart
+
+    with timer.stage('setup'):
+        my_surface = _rough_surface()
+        my_tmart = tmart.Tmart(Surface = my_surface, Atmosphere = _atmosphere(), shadow = True)
+        my_tmart.set_wind(wind_speed = 5)
+        my_tmart.set_geometry(sensor_coords = [1515, 1515, 800_000], target_pt_direction = [165, 45], sun_dir = [50, 150])
+
+    with tmart.TmartPool(args.nc) as pool:
+        with timer.stage('run'):
+            results = my_tmart.run(wl = 560, n_photon = args.n_photon, njobs = args.njobs, engine = args.engine, pool = pool, seed = 1)
+    with timer.stage('calc_ref'):
+        tmart.calc_ref(results, n_photon = args.n_photon)
+    return args.n_photon
+
+
+# As in surface_rho.calculate: L_sky and L_sr over a small patch of water
+def scene_surface_rho(timer, args):
+    import tmart
+
+    with timer.stage('calculate'):
+        tmart.surface_rho.calculate(wl = 550, viewing_zenith = 40, solar_zenith = 30, relative_azimuth = 135,
+                                    aot550 = 0.1, n_photon = args.n_photon)
+    return 2 * args.n_photon
+
+
+# DEM intersections and free paths, the inner loops of the scalar engine
+def scene_kernels(timer, args):
+    import tmart
+    from tmart.tm_intersect import intersect_line_DEMtri2, intersect_line_DEMgrid
+    from tmart.tm_move import pt_move
+
+    rng = np.random.default_rng(1)
+    with timer.stage('setup'):
+        my_surface = _rough_surface()
+        my_tmart = tmart.Tmart(Surface = my_surface, Atmosphere = _atmosphere())
+        my_tmart.set_geometry(sensor_coords = [1515, 1515, 800_000], target_pt_direction = [165, 45], sun_dir = [50, 150])
+        my_tmart.wl = 560
+        my_tmart._init_atm(None)
+
+    # Lines from above the DEM going down, about half of them end in the terrain
+    n = 20_000
+    q0 = np.column_stack([rng.uniform(0, 3030, n), rng.uniform(0, 3030, n), rng.uniform(400, 1500, n)])
+    q1 = q0 + np.column_stack([rng.uniform(-1000, 1000, n), rng.uniform(-1000, 1000, n), rng.uniform(-1500, -300, n)])
+
+    with timer.stage('intersect_line_DEMgrid'):
+        for i in range(n):
+            intersect_line_DEMgrid(q0[i], q1[i], my_surface.DEM_grid)
+    with timer.stage('intersect_line_DEMtri2'):
+        for i in range(n // 100):
+            intersect_line_DEMtri2(q0[i], q1[i], my_surface.DEM_triangulated)
+
+    directions = np.column_stack([rng.uniform(0, 180, n), rng.uniform(0, 360, n)])
+    starts = np.column_stack([np.zeros(n), np.zeros(n), rng.uniform(0, 100, n)])
+    taus = -np.log(rng.random(n))
+    with timer.stage('pt_move'):
+        for i in range(n):
+            pt_move(my_tmart.OT_profile_wl, starts[i], directions[i], taus[i])
+    return 0
+
+
+# Band 2 of a synthetic Sentinel-2 tile: read, T-Mart parameters and write
+def scene_AEC(timer, args):
+    import tmart
+    import rasterio
+    import math
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        config = tmart.AEC.read_config(None)
+    config['LUT_dir'] = 'None'
+
+    size = args.AEC_size
+    reshape_factor = int(config['reshape_factor_S2'])
+    temp_reshape_factor = (reshape_factor * 6) // math.gcd(reshape_factor, 6)
+    AEC_size = math.ceil(size / temp_reshape_factor) * temp_reshape_factor
+    metadata = {'sensor': 'S2A', 'resolution': 10, 'reshape_factor': reshape_factor, 'window_size': int(config['window_size']),
+                'height': size, 'width': size, 'AEC_height': AEC_size, 'AEC_width': AEC_size,
+                'vza': 5, 'vaa': 100, 'sza': 40, 'saa': 150, 'tm_pt_dir': [175, 190], 'tm_sun_dir': [40, 60],
+                'B02_mult': 0.0001, 'B02_add': -0.1}
+    anci = {'r_maritime': 0.8, 'water_vapour': 20, 'ozone': 300}
+
+    # A lake in land, no data in a corner as at the edge of a swath
+    temp_dir = tempfile.mkdtemp(prefix = 'tmart_benchmark_')
+    metadata['B02'] = os.path.join(temp_dir, 'B02.tif')
+    mask_all = {'10m': np.ones((AEC_size, AEC_size), dtype = bool)}
+    rng = np.random.default_rng(0)
+    with timer.stage('synthesize'):
+        with rasterio.open(metadata['B02'], 'w', driver = 'GTiff', height = size, width = size, count = 1, dtype = 'uint16',
+                           transform = rasterio.Affine(10, 0, 0, 0, -10, 0), tiled = True) as ds:
+            for row0 in range(0, size, 1024):
+                rows = np.arange(row0, min(row0 + 1024, size))[:, None]
+                cols = np.arange(size)[None, :]
+                water = (rows - size/2)**2 + (cols - size/3)**2 < (size/4)**2
+                TOA = np.where(water, 0.07, 0.15) + rng.normal(0, 0.01, (len(rows), size))
+                DN = np.maximum((TOA + 0.1) / 0.0001, 1).astype('uint16')
+                DN[rows + cols > 1.7 * size] = 0
+                ds.write(DN, 1, window = rasterio.windows.Window(0, row0, size, len(rows)))
+                mask_all['10m'][row0:row0 + len(rows), :size] = ~water
+    mask_cloud = {str(10 * reshape_factor) + 'm': np.zeros((AEC_size // reshape_factor, AEC_size // reshape_factor), dtype = bool)}
+
+    with timer.stage('AEC_read'):
+        band = tmart.AEC.AEC_read('B02', metadata, config, mask_all)
+    with timer.stage('AEC_get_parameters'):
+        AEC_parameters = tmart.AEC.AEC_get_parameters(band, None, 492, 0.1, metadata, config, anci, args.n_photon, args.njobs)
+    with timer.stage('AEC_write'):
+        tmart.AEC.AEC_write(band, AEC_parameters, None, 492, 0.1, metadata, config, anci, mask_cloud)
+
+    import shutil
+    shutil.rmtree(temp_dir, ignore_errors = True)
+    return args.n_photon
+
+
+# Peak resident memory of this process and its finished children, in MB
+def peak_rss():
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10 # bytes on macOS, KB elsewhere
+
+
+# Run a scene in this process, the output of T-Mart is discarded
+def run_scene(scene, args):
+    import tmart
+
+    stand_in = use_stand_in(args.stand_in)
+    timer = Timer()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        n_photon = globals()['scene_' + scene](timer, args)
+
+        # Default pool of T-Mart, so that its processes count in the peak memory
+        tmart.tm_pool._close_default_pool()
+    wall_time = time.perf_counter() - start
+
+    result = {'wall_time': wall_time, 'stages': timer.stages, 'peak_rss_MB': peak_rss(), 'stand_in_6S': stand_in}
+    if n_photon > 0:
+        result['n_photon'] = n_photon
+        result['photons_per_s'] = n_photon / sum(t for k, t in timer.stages.items() if k in ['run', 'calculate', 'AEC_get_parameters'])
+    return result
+
+
+### Reports and baselines
+
+def print_result(scene, result):
+    line = '{:<12} {:>8.2f} s'.format(scene, result['wall_time'])
+    if 'photons_per_s' in result: line += '  {:>9.0f} photons/s'.format(result['photons_per_s'])
+    if result['peak_rss_MB'] is not None: line += '  {:>7.0f} MB'.format(result['peak_rss_MB'])
+    print(line)
+    for k, t in result['stages'].items():
+        print('    {:<24} {:>8.3f} s'.format(k, t))
+
+
+# Ratios to the baseline, a list of regressions
+def compare(results, baseline, tolerance = TOLERANCE):
+
+    if results['settings'] != baseline['settings']:
+        print('WARNING: settings differ from the baseline: ' + str(baseline['settings']))
+
+    regressions = []
+    print('\nCompared with the baseline of ' + baseline['date'])
+    for scene, result in results['scenes'].items():
+        if scene not in baseline['scenes']: continue
+        old = baseline['scenes'][scene]
+        if result['stand_in_6S'] != old['stand_in_6S']:
+            print('WARNING: {}: 6S stand-in {} in the baseline, {} now'.format(scene, old['stand_in_6S'], result['stand_in_6S']))
+
+        # (name, new, old, lower is better)
+        metrics = [('wall_time', result['wall_time'], old['wall_time'], True)]
+        metrics += [(k, t, old['stages'][k], True) for k, t in result['stages'].items()
+                    if k in old['stages'] and old['stages'][k] >= MIN_TIME]
+        if 'photons_per_s' in result and 'photons_per_s' in old:
+            metrics.append(('photons_per_s', result['photons_per_s'], old['photons_per_s'], False))
+        if result['peak_rss_MB'] is not None and old['peak_rss_MB'] is not None:
+            metrics.append(('peak_rss_MB', result['peak_rss_MB'], old['peak_rss_MB'], True))
+
+        for name, new, before, lower in metrics:
+            change = new / before - 1
+            worse = change > tolerance if lower else change < -tolerance
+            flag = '  REGRESSION' if worse else ''
+            print('{:<12} {:<24} {:>12.3f} {:>12.3f} {:>+8.1%}{}'.format(scene, name, new, before, change, flag))
+            if worse: regressions.append((scene, name, change))
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmarks of T-Mart')
+    parser.add_argument('--scenes', nargs = '+', default = SCENES, choices = SCENES)
+    parser.add_argument('--n_photon', type = int, default = 10_000, help = 'photons per T-Mart run')
+    parser.add_argument('--nc', type = int, default = 1, help = 'number of CPU cores')
+    parser.add_argument('--njobs', type = int, default = 10)
+    parser.add_argument('--engine', default = 'scalar', choices = ['scalar', 'batch'])
+    parser.add_argument('--AEC_size', type = int, default = 10_980, help = 'rows and columns of the synthetic Sentinel-2 band')
+    parser.add_argument('--stand_in', action = 'store_true', help = 'use the 6S stand-in even if 6S is available')
+    parser.add_argument('--save', help = 'save the results as a JSON baseline')
+    parser.add_argument('--compare', help = 'JSON baseline to compare with')
+    parser.add_argument('--tolerance', type = float, default = TOLERANCE, help = 'relative change reported as a regression')
+    parser.add_argument('--child', help = argparse.SUPPRESS) # internal: run one scene and write the result to this file
+    args = parser.parse_args()
+
+    if args.child is not None:
+        with open(args.child, 'w') as f:
+            json.dump(run_scene(args.scenes[0], args), f)
+        return 0
+
+    import numpy, scipy
+    settings = {k: getattr(args, k) for k in ['n_photon', 'nc', 'njobs', 'engine', 'AEC_size', 'stand_in']}
+    results = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': settings,
+               'environment': {'python': platform.python_version(), 'numpy': numpy.__version__, 'scipy': scipy.__version__,
+                               'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+               'scenes': {}}
+
+    # A fresh process for each scene, for its own peak memory
+    for scene in args.scenes:
+        fd, file = tempfile.mkstemp(suffix = '.json')
+        os.close(fd)
+        command = [sys.executable, path.abspath(__file__), '--scenes', scene, '--child', file]
+        command += ['--{}={}'.format(k, v) for k, v in settings.items() if k != 'stand_in']
+        if args.stand_in: command.append('--stand_in')
+
+        completed = subprocess.run(command)
+        if completed.returncode != 0:
+            print('WARNING: scene {} failed'.format(scene))
+            continue
+        with open(file) as f:
+            results['scenes'][scene] = json.load(f)
+        os.remove(file)
+        print_result(scene, results['scenes'][scene])
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent = 2)
+        print('\nSaved: ' + args.save)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('\n{} regression(s) beyond {:.0%}'.format(len(regressions), args.tolerance))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
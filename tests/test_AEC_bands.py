@@ -0,0 +1,109 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### AEC of several bands with memory budgets for 1, 2 and all bands at a time, outputs and the order of on_done should be the same
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+import rasterio
+import importlib
+import tempfile
+import shutil
+import os
+
+# T-Mart and 6S are replaced by parameters from the median of the band and a fixed fit
+AEC_module = importlib.import_module('tmart.AEC.AEC')
+
+def AEC_get_parameters(band, AEC_band_6S, wl, AOT, metadata, config, anci, n_photon, njobs):
+    conv_window_1 = np.outer(np.hanning(7), np.hanning(7))
+    return {'conv_window_1': conv_window_1 / conv_window_1.sum(),
+            'F_correction': 0.5 + wl / 10_000,
+            'F_captured': 0.9,
+            'R_atm': 0.02 + 0.1 * band['median']}
+
+AEC_module.AEC_get_parameters = AEC_get_parameters
+tmart.AEC.irradiance_correction # load the module before replacing irradiance_fit
+tmart.AEC.irradiance_fit = lambda **kwargs: np.poly1d([-0.5, 0.1, 1])
+
+### Synthetic bands at 10 m, padded to a multiple of the reshape factor ###
+rng = np.random.default_rng(0)
+height, width = 50, 58
+reshape_factor = 3
+AEC_height, AEC_width = 51, 60
+band_names = ['B1', 'B2', 'B3', 'B4', 'B5']
+
+input_dir = tempfile.mkdtemp()
+transform = rasterio.transform.from_origin(500_000, 5_000_000, 10, 10)
+inputs = {}
+for name in band_names:
+    data = rng.integers(500, 3000, (height, width)).astype(np.uint16)
+    data[:5, :7] = 0 # no data
+    inputs[name] = data
+    with rasterio.open(os.path.join(input_dir, name + '.tif'), 'w', driver='GTiff', height=height, width=width, count=1,
+                       dtype='uint16', crs='EPSG:32633', transform=transform) as ds:
+        ds.write(data, 1)
+
+# Land on the left, water on the right
+mask_land = np.zeros((AEC_height, AEC_width), dtype=bool)
+mask_land[:, :20] = True
+mask_all = {'10m': mask_land}
+mask_cloud = {'30m': np.zeros((AEC_height // reshape_factor, AEC_width // reshape_factor), dtype=bool)}
+
+config = {'tile_rows': '16', 'cloud_contribution': '1', 'AE_land': 'False', 'LUT_dir': 'None'}
+anci = {'r_maritime': 0.5}
+bands = [(name, None, 443 + 100 * i) for i, name in enumerate(band_names)]
+
+# Memory of a band in AEC_bands
+memory_band = 8 * 8 * (16 + 2 * 64) * AEC_width / 2**20
+
+outputs = {}
+for n_bands in [1, 2, 5]:
+
+    band_dir = tempfile.mkdtemp()
+    metadata = {'sensor': 'S2A', 'resolution': 10, 'reshape_factor': reshape_factor,
+                'AEC_height': AEC_height, 'AEC_width': AEC_width, 'window_size': 5,
+                'sza': 30, 'saa': 150, 'vza': 5, 'vaa': 100, 'tm_pt_dir': [175, 100], 'tm_sun_dir': [30, 150]}
+    for name in band_names:
+        shutil.copy(os.path.join(input_dir, name + '.tif'), band_dir)
+        metadata[name] = os.path.join(band_dir, name + '.tif')
+        metadata[name + '_mult'] = 0.0001
+        metadata[name + '_add'] = -0.1
+
+    config['memory_budget'] = str(memory_band * (n_bands + 0.5))
+    done = []
+    tmart.AEC.AEC_bands(bands, 0.1, metadata, config, anci, mask_cloud, mask_all, 1_000, 10, on_done = done.append)
+
+    assert done == band_names, done
+    outputs[n_bands] = []
+    for name in band_names:
+        with rasterio.open(metadata[name]) as ds:
+            outputs[n_bands].append(ds.read(1))
+    shutil.rmtree(band_dir)
+
+shutil.rmtree(input_dir)
+
+# The bands are corrected, no data stays 0
+for name, output in zip(band_names, outputs[1]):
+    assert not np.array_equal(output, inputs[name]), name
+    assert np.array_equal(output == 0, inputs[name] == 0), name
+for n_bands in [2, 5]:
+    for name, one, several in zip(band_names, outputs[1], outputs[n_bands]):
+        assert np.array_equal(one, several), (n_bands, name)
+
+print('Bands processed 1, 2 and 5 at a time are identical')
@@ -0,0 +1,49 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Filling nan and median of an image in strips of rows, against the whole image 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+
+rng = np.random.default_rng(0)
+
+# No data in corners, a full row, a large block spanning several tiles 
+image = rng.random((300,250))
+image[:40,:60] = np.nan
+image[280:,150:] = np.nan
+image[100,:] = np.nan
+image[150:260,:200] = np.nan
+
+image_filled = tmart.AEC.fillnan(image)
+
+for tile_rows in [1, 7, 64, 300]:
+    
+    read_rows = lambda top, bottom: image[top:bottom]
+    tiles = [tmart.AEC.fillnan_rows(read_rows, row0, min(row0 + tile_rows, 300), 300, halo=4) 
+             for row0 in range(0, 300, tile_rows)]
+    assert np.array_equal(np.concatenate(tiles), image_filled)
+    
+    # Median of odd and even number of pixels, ties 
+    for shape in [(300,250), (299,251)]:
+        values = np.round(rng.random(shape), 3)
+        assert tmart.AEC.median_rows(values, tile_rows) == np.median(values)
+        assert tmart.AEC.median_rows(values, tile_rows, n_bins=16) == np.median(values)
+
+print('Tiles match the whole image')
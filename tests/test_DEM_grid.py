@@ -0,0 +1,63 @@
+# This file is part of TMart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Compare the DDA walk on the DEM grid with testing all triangles, the closest intersections should be the same
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+from tmart.tm_intersect import intersect_line_DEMtri2, intersect_line_DEMgrid
+
+rng = np.random.default_rng(0)
+
+### A rough DEM ###
+image_DEM = rng.uniform(0, 300, (20, 25)) # in meters
+image_reflectance = np.full(image_DEM.shape, 0.1) # unitless
+image_isWater = np.zeros(image_DEM.shape) # 1 is water, 0 is land
+
+for alignPixels in [False, True]:
+
+    my_surface = tmart.Surface(DEM = image_DEM,
+                               reflectance = image_reflectance,
+                               isWater = image_isWater,
+                               cell_size = 50,
+                               alignPixels = alignPixels)
+    my_surface.set_background(bg_ref = 0.1, bg_elevation = 10)
+    
+    n_hit = 0
+    
+    for i in range(2000):
+        
+        q0 = np.array([rng.uniform(-200,1500), rng.uniform(-200,1200), rng.uniform(-50,800)])
+        q1 = q0 + rng.normal(size=3) * rng.uniform(10,1500)
+        
+        # vertical movements 
+        if i % 4 == 0: q1[0:2] = q0[0:2]
+        
+        intersect_all = intersect_line_DEMtri2(q0, q1, my_surface.DEM_triangulated)
+        intersect_grid = intersect_line_DEMgrid(q0, q1, my_surface.DEM_grid)
+        
+        if intersect_all.shape[0] > 0:
+            n_hit += 1
+            closest = intersect_all.iloc[intersect_all.linear_distance.idxmin()].to_numpy()
+            assert intersect_grid is not None
+            assert np.allclose(closest, intersect_grid)
+        else:
+            assert intersect_grid is None
+
+    print('alignPixels: ' + str(alignPixels) + ', intersections: ' + str(n_hit) + ', all identical')
@@ -0,0 +1,55 @@
+# This file is part of TMart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### OT between altitudes from the cumulative OT profile against summing layer by layer 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import numpy as np
+from tmart.tm_OT import OTProfile
+
+rng = np.random.default_rng(0)
+
+# Synthetic profile: Alt_bottom, Alt_top (km), ot_abs, ot_rayleigh, ot_mie, ot_scatt, l_height, percentage
+alts = np.array([0, 0.5, 1, 2, 3, 5, 8, 12, 20, 30, 50, 120])
+atm_profile = np.zeros((len(alts)-1, 8))
+atm_profile[:,0] = alts[:-1]
+atm_profile[:,1] = alts[1:]
+atm_profile[:,2:5] = rng.random((len(alts)-1, 3)) * 0.05
+atm_profile[:,6] = atm_profile[:,1] - atm_profile[:,0]
+
+# Layer-by-layer reference, altitudes in m 
+def OT_between(z0, z1, columns):
+    bottom, top = sorted([z0/1000, z1/1000])
+    overlap = np.clip(np.minimum(atm_profile[:,1], top) - np.maximum(atm_profile[:,0], bottom), 0, None)
+    return np.sum(atm_profile[:,columns].sum(axis=1) * overlap / atm_profile[:,6])
+
+OT_profile = OTProfile(atm_profile)
+
+z = np.concatenate([rng.uniform(0, 130_000, 1000), alts * 1000])
+z_other = rng.uniform(0, 130_000, len(z))
+
+# Vectorized and scalar 
+ext_TOA = OT_profile.ext_to_TOA(z)
+abs_between = OT_profile.abs_between(z, z_other)
+
+for i in range(len(z)):
+    assert np.isclose(ext_TOA[i], OT_between(z[i], 120_000, [2,3,4]))
+    assert np.isclose(OT_profile.ext_to_TOA(z[i]), ext_TOA[i])
+    assert np.isclose(abs_between[i], OT_between(z[i], z_other[i], [2]))
+
+print('Cumulative OT profile agrees with layer sums')
@@ -0,0 +1,76 @@
+# This file is part of TMart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Compare the batch engine with the scalar engine, differences should be within Monte Carlo error
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+from Py6S.Params.atmosprofile import AtmosProfile
+
+# Specify wavelength in nm
+wl = 550
+
+### DEM and reflectance ###
+image_DEM = np.array([[0,0],[0,0]]) # in meters
+image_reflectance = np.array([[0.02,0.02],[0.02,0.02]]) # unitless
+image_isWater = np.array([[1,1],[1,1]]) # 1 is water, 0 is land
+
+# Synthesize a surface object
+my_surface = tmart.Surface(DEM = image_DEM,
+                           reflectance = image_reflectance,
+                           isWater = image_isWater,
+                           cell_size = 10_000)
+my_surface.set_background(bg_ref        = 0.02, # background reflectance
+                          bg_isWater    = 1, # if is water
+                          bg_elevation  = 0, # elevation of both background
+                          bg_coords     = [[0,0],[10,10]]) # a line dividing the two background
+
+### Atmosphere ###
+atm_profile = AtmosProfile.PredefinedType(AtmosProfile.MidlatitudeSummer)
+my_atm = tmart.Atmosphere(atm_profile, aot550 = 0.2, aerosol_type = 'Maritime')
+
+### Running T-Mart ###
+my_tmart = tmart.Tmart(Surface = my_surface, Atmosphere= my_atm, shadow=False)
+my_tmart.set_wind(wind_speed=3, wind_azi_avg = True)
+my_tmart.set_geometry(sensor_coords=[51,50,130_000],
+                      target_pt_direction=[170,0],
+                      sun_dir=[30,0])
+
+n_photon = 10_000
+
+### Multiprocessing needs to be wrapped in 'if __name__ == "__main__":' for Windows systems.
+if __name__ == "__main__":
+    
+    # A target error that is not reached, to run all photons and get the errors 
+    runs = {}
+    for engine in ['scalar', 'batch']:
+        results, info = my_tmart.run(wl=wl, band=None, n_photon=n_photon, engine=engine, streaming=True, seed=1, 
+                                     target_error=1e-6)
+        R = tmart.calc_ref(results, n_photon=info['n_photon'], detail=True)
+        runs[engine] = (R, info['error'])
+
+    (R_scalar, error_scalar), (R_batch, error_batch) = runs['scalar'], runs['batch']
+
+    print('\nscalar      batch')
+    for k in R_scalar.keys():
+        print(k, '     ' , R_scalar[k], '     ', R_batch[k])
+    
+    for k in ['R_atm', 'R_dir', 'R_env', 'R_total']:
+        sigma = np.hypot(R_scalar[k] * error_scalar[k], R_batch[k] * error_batch[k])
+        assert abs(R_batch[k] - R_scalar[k]) < 4 * sigma, (k, R_batch[k], R_scalar[k], sigma)
@@ -0,0 +1,48 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### FFT convolution of AEC against scipy.signal.convolve2d with boundary='fill' 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+import time
+from scipy import signal
+
+rng = np.random.default_rng(0)
+
+# image shape, kernel shape, block size: one block, many blocks, even kernels, kernel larger than the image 
+for shape, k_shape, block_size in [((300,250), (31,31), 2048), 
+                                   ((300,250), (30,17), 64), 
+                                   ((261,233), (201,201), 128),
+                                   ((40,50), (201,201), 2048)]:
+    
+    image = rng.random(shape)
+    kernel = rng.random(k_shape)
+    kernel = kernel / kernel.sum()
+    
+    start_time = time.time()
+    R_direct = signal.convolve2d(image, kernel, mode='same', boundary='fill', fillvalue=image.mean())
+    time_direct = time.time() - start_time
+    
+    start_time = time.time()
+    R_fft = tmart.AEC.convolve_fft(image, kernel, fillvalue=image.mean(), block_size=block_size)
+    time_fft = time.time() - start_time
+    
+    print('{} {}: max difference {:.1e}, direct {:.3f} s, FFT {:.3f} s'.format(shape, k_shape, np.abs(R_direct - R_fft).max(), time_direct, time_fft))
+    assert np.allclose(R_direct, R_fft, rtol=0, atol=1e-12)
@@ -0,0 +1,70 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Cox-Munk facets drawn from the Gaussian of slopes against the earlier sampler, uniform slope angles with rejection 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import numpy as np
+from scipy.stats import ks_2samp
+from tmart.tm_water import cox_munk, eta_to_dirP, sample_cox_munk, sample_cox_munk_batch
+from tmart.tm_geometry import dirP_to_coord
+
+rng = np.random.default_rng(0)
+
+# The earlier sampler 
+def sample_cox_munk_uniform(wind_speed, wind_dir, rng):
+    cm_max = 0
+    for i in range(0,90):
+        cm_calc = cox_munk(-i, 0, wind_speed, unit='degree') 
+        if cm_calc >= cm_max:
+            cm_max = cm_calc
+        else:
+            cm_max = cm_max *1.1
+            break
+    cm_rand = cm_calc +1 
+    while cm_calc < cm_rand:
+        eta_a_degree = rng.uniform(-90,90)    
+        eta_c_degree = rng.uniform(-90,90)    
+        cm_calc = cox_munk(eta_a_degree, eta_c_degree, wind_speed, unit='degree')
+        cm_rand = rng.uniform(0,cm_max) 
+    L = eta_to_dirP(eta_a_degree, eta_c_degree)
+    L[1] = (L[1] + wind_dir) % 360
+    return dirP_to_coord(1, L[0:2])
+
+
+for wind_speed, wind_dir, n in [(1, 0, 1000), (5, 30, 2000), (15, 250, 2000)]:
+    
+    old = np.array([sample_cox_munk_uniform(wind_speed, wind_dir, rng) for i in range(n)])
+    new = np.array([sample_cox_munk(wind_speed, wind_dir, rng) for i in range(n)])
+    new_batch = sample_cox_munk_batch(20 * n, wind_speed, wind_dir, rng)
+    
+    assert np.allclose(np.linalg.norm(new_batch, axis=1), 1)
+    assert np.all(new_batch[:,2] > 0)
+    
+    # Each component of the normals, and the downwind skewness 
+    p_values = [ks_2samp(old[:,k], facets[:,k]).pvalue for facets in [new, new_batch] for k in range(3)]
+    print('Wind {} m/s: smallest p-value {:.3f}'.format(wind_speed, min(p_values)))
+    assert min(p_values) > 0.001
+    
+    downwind = [-np.cos(np.radians(wind_dir)), -np.sin(np.radians(wind_dir))]
+    skew_old, skew_new = old[:,0:2] @ downwind, new_batch[:,0:2] @ downwind
+    assert abs(skew_old.mean() - skew_new.mean()) < 4 * skew_old.std() / np.sqrt(n)
+
+# Calm water 
+assert np.array_equal(sample_cox_munk(0, 0, rng), [0, 0, 1])
+assert sample_cox_munk_batch(5, 0, 0, rng).shape == (5, 3)
@@ -0,0 +1,63 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Closed-form intersections with flat surfaces against walking the DEM grid 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+from tmart.tm_intersect import intersect_line_DEMgrid, intersect_line_plane, intersect_line_plane_batch
+
+rng = np.random.default_rng(0)
+
+# Flat and homogeneous, as in get_parameters 
+ws = 21
+my_surface = tmart.Surface(DEM = np.full((ws,ws), 0), reflectance = np.full((ws,ws), 0.05), 
+                           isWater = np.full((ws,ws), 1), cell_size = 180)
+my_surface.set_background(bg_ref = 0.05, bg_isWater = 1)
+assert my_surface.flat_elevation == 0
+assert my_surface.homogeneous == (0.05, 1)
+
+# Elevated flat surface, default background reflectance
+my_surface.DEM = np.full((ws,ws), 200)
+my_surface.set_background(bg_elevation = 200)
+assert my_surface.flat_elevation == 200
+assert my_surface.homogeneous is None
+
+# Lines across the plane, inside and outside the grid, both directions 
+grid = my_surface.DEM_grid
+q0 = np.column_stack([rng.uniform(-2000, 6000, 2000), rng.uniform(-2000, 6000, 2000), rng.uniform(-500, 1000, 2000)])
+q1 = q0 + np.column_stack([rng.uniform(-2000, 2000, 2000), rng.uniform(-2000, 2000, 2000), rng.uniform(-1500, 1500, 2000)])
+
+hit, q_hit, N_hit = intersect_line_plane_batch(q0, q1, grid, 200.0)
+n_hit = 0
+for j in range(len(q0)):
+    walked = intersect_line_DEMgrid(q0[j], q1[j], grid)
+    plane = intersect_line_plane(q0[j], q1[j], grid, 200.0)
+    assert (walked is None) == (plane is None) == (not hit[j])
+    if plane is not None:
+        n_hit += 1
+        assert np.allclose(walked, plane, rtol=0, atol=1e-6)
+        assert np.allclose(plane[0:3], q_hit[j]) and np.allclose(plane[3:6], N_hit[j])
+
+# Not flat
+my_surface.DEM[3,4] = 250
+my_surface.set_background(bg_elevation = 200)
+assert my_surface.flat_elevation is None
+
+print('Flat surface intersections match: {} of {} lines'.format(n_hit, len(q0)))
@@ -0,0 +1,71 @@
+# This file is part of TMart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Free paths of photons: the scattering OT travelled equals the sampled OT, vectorized and single-photon kernels agree 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import numpy as np
+from tmart.tm_OT import OTProfile
+from tmart.tm_move import free_path, _free_path_single
+
+rng = np.random.default_rng(0)
+
+# Synthetic profile: Alt_bottom, Alt_top (km), ot_abs, ot_rayleigh, ot_mie, ot_scatt, l_height, percentage
+alts = np.linspace(0, 100, 21)
+atm_profile = np.zeros((len(alts)-1, 8))
+atm_profile[:,0] = alts[:-1]
+atm_profile[:,1] = alts[1:]
+atm_profile[:,2] = rng.random(len(alts)-1) * 0.01
+atm_profile[:,3] = np.exp(-alts[:-1] / 8) * 0.02
+atm_profile[:,4] = np.exp(-alts[:-1] / 2) * 0.05
+atm_profile[:,5] = atm_profile[:,3] + atm_profile[:,4]
+atm_profile[:,6] = atm_profile[:,1] - atm_profile[:,0]
+atm_profile_copy = atm_profile.copy()
+
+OT_profile = OTProfile(atm_profile)
+
+n = 5000
+z0 = np.concatenate([rng.uniform(0, 100_000, n-21), alts * 1000])
+mu = rng.uniform(-1, 1, n)
+mu[:50] = 0 # parallel to the layers 
+sampled_tao = -np.log(1 - rng.random(n))
+
+distance, tao_abs, ot_rayleigh, ot_mie, out = free_path(OT_profile, z0, mu, sampled_tao)
+z1 = z0 + distance * mu
+
+# Scattering OT along the paths 
+ot_scatt = np.abs(np.interp(np.clip(z1, 0, 100_000), OT_profile.alts, OT_profile.cum_scatt) - 
+                  np.interp(z0, OT_profile.alts, OT_profile.cum_scatt)) / np.abs(np.where(mu == 0, 1, mu))
+ot_scatt[mu == 0] = ot_rayleigh[mu == 0] + ot_mie[mu == 0]
+
+stopped = ~out & (z1 >= 0)
+assert np.allclose(ot_scatt[stopped], sampled_tao[stopped])
+assert np.all(ot_scatt[~stopped] <= sampled_tao[~stopped])
+assert np.allclose(ot_rayleigh + ot_mie, ot_scatt)
+assert np.allclose(z1[out], 100_000) and np.allclose(z1[z1 < 0], -10)
+print('Photons out of TOA: {}, reaching the ground: {}'.format(out.sum(), (z1 < 0).sum()))
+
+# One photon at a time 
+for i in range(n):
+    single = _free_path_single(OT_profile, z0[i], mu[i], sampled_tao[i])
+    assert np.allclose([v[0] for v in single[0:4]], [distance[i], tao_abs[i], ot_rayleigh[i], ot_mie[i]])
+    assert single[4][0] == out[i]
+
+# No side effects on the profile 
+assert np.array_equal(atm_profile, atm_profile_copy)
+print('Free paths agree')
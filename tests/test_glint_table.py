@@ -0,0 +1,54 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Glint reflectance of flat water from the table of a run against find_R_cm 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import numpy as np
+from tmart.tm_water import find_R_cm, find_R_cm_batch, GlintTable, GLINT_MAX_ERROR
+from tmart.tm_geometry import dirP_to_coord
+
+rng = np.random.default_rng(0)
+
+for sun_dir, wind_dir, wind_speed, wind_azi_avg in [([30, 120], 0, 1, True), ([50, 0], 45, 5, False), ([10, 300], 200, 12, True)]:
+    
+    # Directions of photons over the hemisphere and around the specular direction 
+    op = np.concatenate([rng.normal(size=(2000,3)), 
+                         dirP_to_coord(1, [sun_dir[0], sun_dir[1] + 180]) + rng.normal(0, 0.1, (2000,3))])
+    op[:,2] = np.abs(op[:,2])
+    op = op / np.linalg.norm(op, axis=1)[:,None]
+    
+    exact = np.array([find_R_cm(d, sun_dir, [0,0], wind_dir, wind_speed, 1.34, False) for d in op])
+    if wind_azi_avg:
+        exact = (exact + np.array([find_R_cm(d, sun_dir, [0,0], wind_dir + 90, wind_speed, 1.34, False) for d in op])) / 2
+        
+    # Vectorized find_R_cm 
+    batch = find_R_cm_batch(op, sun_dir, wind_dir, wind_speed, 1.34)
+    if wind_azi_avg:
+        batch = (batch + find_R_cm_batch(op, sun_dir, wind_dir + 90, wind_speed, 1.34)) / 2
+    assert np.allclose(batch, exact, rtol=1e-9, atol=0)
+    
+    # Table, one direction at a time and vectorized 
+    table = GlintTable(sun_dir, wind_dir, wind_speed, 1.34, wind_azi_avg)
+    single = np.array([table.value(d) for d in op])
+    assert np.allclose(single, table.value_batch(op), rtol=1e-12, atol=0)
+    
+    error = np.max(np.abs(single - exact)) / table.table.max()
+    print('Wind {} m/s, sun {}: table error {:.5f}, checked {:.5f}'.format(wind_speed, sun_dir, error, table.error))
+    assert table.error <= GLINT_MAX_ERROR
+    assert error <= GLINT_MAX_ERROR
@@ -0,0 +1,76 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Points above the horizon map must see the sun when tested along the path 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+from tmart.tm_geometry import dirP_to_coord
+from tmart.tm_intersect import HorizonMap, intersect_line_DEMgrid
+
+rng = np.random.default_rng(0)
+
+# Rugged terrain
+n, cell_size = 40, 30
+y, x = np.mgrid[0:n,0:n]
+image_DEM = np.maximum(200 * np.sin(x/7) * np.cos(y/9) + 100 + rng.random((n,n)) * 20, 0)
+my_surface = tmart.Surface(DEM = image_DEM, reflectance = np.full((n,n), 0.1), 
+                           isWater = np.full((n,n), 0), cell_size = cell_size)
+my_surface.set_background(bg_ref = 0.1, bg_isWater = 0, bg_elevation = 0, bg_coords = [[0,0],[10,10]])
+grid = my_surface.DEM_grid
+
+# Points on the surface, as collisions, and above it, inside and outside the grid 
+n_point = 1000
+q = np.column_stack([rng.uniform(grid['x0'] - 100, grid['x0'] + grid['n_col'] * cell_size + 100, n_point), 
+                     rng.uniform(grid['y0'] - 100, grid['y0'] + grid['n_row'] * cell_size + 100, n_point), 
+                     np.zeros(n_point)])
+for j in range(n_point):
+    hit = intersect_line_DEMgrid([q[j,0], q[j,1], 1000], [q[j,0], q[j,1], -10], grid)
+    q[j,2] = (hit[2] if hit is not None else 0) + (0.01 if j % 2 == 0 else rng.uniform(0, 300))
+
+for sun_dir in [[0,0], [30,0], [60,45], [75,200], [85,310]]:
+    horizon_map = HorizonMap(grid, sun_dir)
+    lit = horizon_map.lit_batch(q)
+    n_lit = 0
+    
+    for j in range(n_point):
+        assert horizon_map.lit(q[j]) == lit[j]
+        
+        q_sun = dirP_to_coord((120_000 - q[j,2]) / np.cos(sun_dir[0]/180*np.pi), sun_dir) + q[j]
+        shadowed = intersect_line_DEMgrid(q[j], q_sun, grid) is not None
+        assert not (lit[j] and shadowed), (sun_dir, q[j])
+        n_lit += not shadowed
+    
+    print('Sun {}: {} of {} lit points above the horizon'.format(sun_dir, np.sum(lit), n_lit))
+
+# Flat: all lit 
+my_surface.DEM = np.full((n,n), 0)
+my_surface.set_background(bg_elevation = 0)
+assert HorizonMap(my_surface.DEM_grid, [60,45]).lit_batch(q).all()
+
+# Rebuilt when the DEM or the sun changes 
+my_tmart = tmart.Tmart(Surface = my_surface, Atmosphere = None, shadow = True)
+my_tmart.set_geometry(sensor_coords=[51,50,130_000], target_pt_direction=[170,0], sun_dir=[30,0])
+horizon_map = my_tmart._horizon_map()
+assert my_tmart._horizon_map() is horizon_map
+my_tmart.set_geometry(sensor_coords=[51,50,130_000], target_pt_direction=[170,0], sun_dir=[40,0])
+assert my_tmart._horizon_map() is not horizon_map
+horizon_map = my_tmart._horizon_map()
+my_surface.set_background(bg_elevation = 0)
+assert my_tmart._horizon_map() is not horizon_map
@@ -0,0 +1,50 @@
+# This file is part of TMart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Startup time of 'import tmart': heavy dependencies and subpackages are only imported when used 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import subprocess
+
+# Seconds 'import tmart' may add on top of 'import numpy' 
+TIME_BUDGET = 0.3
+
+# Modules 'import tmart' must not load 
+HEAVY_MODULES = ['pandas', 'scipy', 'matplotlib', 'Py6S', 'pathos', 'dill', 'rasterio', 'netCDF4', 
+                 'tmart.AEC', 'tmart.surface_rho']
+
+# Best of a few fresh interpreters 
+def import_time(statement, n=5):
+    code = ('import sys, time; sys.path.insert(0, {!r}); t = time.perf_counter(); ' + statement + 
+            '; print(time.perf_counter() - t)').format(two_up)
+    return min(float(subprocess.check_output([sys.executable, '-c', code])) for i in range(n))
+
+t_numpy = import_time('import numpy')
+t_tmart = import_time('import numpy; import tmart')
+print('import numpy: {:.3f} s, import tmart: {:.3f} s'.format(t_numpy, t_tmart))
+
+code = 'import sys; sys.path.insert(0, {!r}); import tmart; print(" ".join(sys.modules))'.format(two_up)
+loaded = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+heavy = [m for m in HEAVY_MODULES if m in loaded]
+
+assert not heavy, 'import tmart loads ' + str(heavy)
+assert t_tmart - t_numpy < TIME_BUDGET, 'import tmart takes {:.3f} s more than numpy'.format(t_tmart - t_numpy)
+
+# Subpackages still load on access 
+code = 'import sys; sys.path.insert(0, {!r}); import tmart; print(tmart.AEC.fillnan, tmart.surface_rho.calculate)'.format(two_up)
+print(subprocess.check_output([sys.executable, '-c', code]).decode())
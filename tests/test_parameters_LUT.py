@@ -0,0 +1,72 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### LUT of AEC parameters: build, resume, interpolate and fall back to get_parameters 
+### get_parameters is replaced by a function linear in the axes, which the LUT interpolates exactly 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+import tempfile
+
+n_runs = []
+
+def linear_parameters(SR, target_pt_direction, sun_dir, atm_profile, aerosol_type, aot550, window_size, **kwargs):
+    n_runs.append(1)
+    x = 0.1*sun_dir[0] + 0.01*target_pt_direction[0] + aot550 + SR + 0.5*aerosol_type + 0.001*atm_profile['water_vapour']
+    conv_window_1 = np.full((window_size, window_size), x)
+    return {'conv_window_1': conv_window_1, 'F_correction': x, 'F_captured': 2*x, 'R_atm': 3*x, 'R_glint': 4*x}
+
+tmart.AEC.get_parameters = linear_parameters
+
+axes = {'sza': [20, 40], 'saa': [270], 'vza': [170, 180], 'vaa': [90],
+        'aot550': [0, 0.2], 'SR': [0.5], 'r_maritime': [0, 1], 'water_vapour': [10, 30], 'ozone': [300]}
+kwargs = dict(n_photon = 100, SR = 0.5, wl = 833, target_pt_direction = [175, 90], sun_dir = [33, 270],
+              atm_profile = {'water_vapour': 12, 'ozone': 300}, aerosol_type = 0.3, aot550 = 0.15,
+              cell_size = 180, window_size = 5, isWater = 0, njobs = 1)
+
+with tempfile.TemporaryDirectory() as LUT_dir:
+    
+    tmart.AEC.make_parameters_LUT(LUT_dir, 'S2A_B8', axes, wl = 833, cell_size = 180, window_size = 5)
+    assert len(n_runs) == 32
+    
+    # Resumed, nothing to compute 
+    tmart.AEC.make_parameters_LUT(LUT_dir, 'S2A_B8', axes, wl = 833, cell_size = 180, window_size = 5)
+    assert len(n_runs) == 32
+    
+    # No run from the LUT 
+    R = tmart.AEC.lookup_parameters(LUT_dir, 'S2A_B8', **kwargs)
+    assert len(n_runs) == 32
+    expected = linear_parameters(**kwargs)
+    for k, v in expected.items():
+        assert np.shape(R[k]) == np.shape(v) and np.allclose(R[k], v, rtol=1e-12), k
+    
+    # On the axes with one value, ozone 300 and saa 270 
+    R = tmart.AEC.lookup_parameters(LUT_dir, 'S2A_B8', **{**kwargs, 'sun_dir': [40, 270], 'aot550': 0.2})
+    assert len(n_runs) == 33
+    assert np.isclose(R['R_atm'], linear_parameters(**{**kwargs, 'sun_dir': [40, 270], 'aot550': 0.2})['R_atm'], rtol=1e-12)
+    
+    # Outside the axes, off an axis with one value, another band, or no LUT: get_parameters runs 
+    tmart.AEC.lookup_parameters(LUT_dir, 'S2A_B8', **{**kwargs, 'aot550': 0.5})
+    tmart.AEC.lookup_parameters(LUT_dir, 'S2A_B8', **{**kwargs, 'atm_profile': {'water_vapour': 12, 'ozone': 280}})
+    tmart.AEC.lookup_parameters(LUT_dir, 'S2A_B8', **{**kwargs, 'sun_dir': [33, 260]})
+    tmart.AEC.lookup_parameters(LUT_dir, 'S2A_B4', **kwargs)
+    tmart.AEC.lookup_parameters(None, 'S2A_B8', **kwargs)
+    assert len(n_runs) == 39
+
+print('LUT interpolation matches')
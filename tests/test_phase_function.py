@@ -0,0 +1,69 @@
+# This file is part of TMart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Compare the tabulated phase function with the cubic interpolation and the rejection sampler it replaces
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import numpy as np
+from scipy.interpolate import interp1d
+from scipy.stats import ks_2samp
+from tmart.Aerosol import find_aerosolSPF
+from tmart.tm_sampling import PhaseFunction
+
+rng = np.random.default_rng(0)
+n = 20_000
+
+# Rejection sampling of the scattering angle, as sample_scattering did before the tabulated CDF 
+def sample_rejection(aerosol_SPF, n):
+    
+    df_angle = aerosol_SPF.Angle.to_numpy()
+    df_value = aerosol_SPF.Value.to_numpy() * np.sin(df_angle * np.pi/180)
+    f2 = interp1d(df_angle, df_value, kind='cubic') 
+    y_max = np.max(df_value)
+    
+    samples = []
+    while len(samples) < n:
+        x = rng.uniform(0, 180, n)
+        y = rng.uniform(0, y_max, n)
+        samples.extend(x[y <= f2(x)])
+    return np.array(samples[:n])
+        
+for aerosol_type, wl in [('Maritime', 550), ('Continental', 443), ('Desert', 865), ('Urban', 2200)]:
+    
+    aerosol_SPF = find_aerosolSPF(aerosol_type, wl)
+    phase_function = PhaseFunction(aerosol_SPF)
+    
+    # Values for local estimates 
+    f2 = interp1d(aerosol_SPF.Angle.to_numpy(), aerosol_SPF.Value.to_numpy(), kind='cubic')
+    angles = rng.uniform(0, 180, n)
+    error = np.max(np.abs(phase_function.value(angles) / f2(angles) - 1))
+    assert error < 1e-3
+    
+    # Sampled scattering angles 
+    angle_rejection = sample_rejection(aerosol_SPF, n)
+    angle_CDF = phase_function.sample(rng.random(n))
+    p_value = ks_2samp(angle_rejection, angle_CDF).pvalue
+    assert p_value > 0.001
+    
+    # Asymmetry parameter 
+    g_rejection = np.mean(np.cos(np.radians(angle_rejection)))
+    g_CDF = np.mean(np.cos(np.radians(angle_CDF)))
+    assert abs(g_rejection - g_CDF) < 5 * np.std(np.cos(np.radians(angle_CDF))) / np.sqrt(n) * np.sqrt(2)
+    
+    print(aerosol_type, wl, 'max relative error of values: {:.2e}, KS p-value: {:.3f}, g: {:.4f} {:.4f}'.format(
+        error, p_value, g_rejection, g_CDF))
@@ -0,0 +1,86 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Photons traced once for several wavelengths should agree with separate runs within Monte Carlo error
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+from Py6S.Params.atmosprofile import AtmosProfile
+
+# Specify wavelengths in nm
+wls = [450, 550, 700]
+
+### DEM and reflectance, land on the left and water on the right ###
+image_DEM = np.array([[0,0],[0,0]]) # in meters
+image_isWater = np.array([[0,1],[0,1]]) # 1 is water, 0 is land
+reflectance = [np.array([[0.05,0],[0.05,0]]), 
+               np.array([[0.1,0],[0.1,0]]), 
+               np.array([[0.2,0],[0.2,0]])]
+bg_ref = [[0.05,0], [0.1,0], [0.2,0]]
+
+# Synthesize a surface object
+my_surface = tmart.Surface(DEM = image_DEM,
+                           reflectance = reflectance[0],
+                           isWater = image_isWater,
+                           cell_size = 10_000)
+my_surface.set_background(bg_ref        = bg_ref[0], # background reflectance
+                          bg_isWater    = [0,1], # if is water
+                          bg_elevation  = 0, # elevation of both background
+                          bg_coords     = [[10_000,0],[10_000,10]]) # a line dividing the two background
+
+### Atmosphere ###
+atm_profile = AtmosProfile.PredefinedType(AtmosProfile.MidlatitudeSummer)
+my_atm = tmart.Atmosphere(atm_profile, aot550 = 0.2, aerosol_type = 'Maritime')
+
+### Running T-Mart ###
+my_tmart = tmart.Tmart(Surface = my_surface, Atmosphere= my_atm, shadow=False)
+my_tmart.set_wind(wind_speed=3, wind_azi_avg = True)
+my_tmart.set_geometry(sensor_coords=[51,50,130_000],
+                      target_pt_direction=[170,0],
+                      sun_dir=[30,0])
+
+n_photon = 20_000
+n_group = 10
+
+def R_and_error(results):
+    # Standard error from groups of photons 
+    R = tmart.calc_ref(results, n_photon=n_photon)
+    group = results['pt_id'] % n_group
+    R_groups = [tmart.calc_ref(results[group==i], n_photon=n_photon/n_group) for i in range(n_group)]
+    error = {k: np.std([Rg[k] for Rg in R_groups], ddof=1) / np.sqrt(n_group) for k in ['R_atm', 'R_dir', 'R_env', 'R_total']}
+    return R, error
+
+### Multiprocessing needs to be wrapped in 'if __name__ == "__main__":' for Windows systems.
+if __name__ == "__main__":
+    
+    results_spectral = my_tmart.run_spectral(wls=wls, n_photon=n_photon, reflectance=reflectance, 
+                                             bg_ref=bg_ref, seed=1)
+    assert len(results_spectral) == len(wls)
+    
+    for i, wl in enumerate(wls):
+        my_surface.reflectance = reflectance[i]
+        my_surface.set_background(bg_ref=bg_ref[i], bg_isWater=[0,1], bg_elevation=0, bg_coords=[[10_000,0],[10_000,10]])
+        results_single = my_tmart.run(wl=wl, n_photon=n_photon, seed=2)
+        
+        R_spectral, error_spectral = R_and_error(results_spectral[i])
+        R_single, error_single = R_and_error(results_single)
+        print(wl, {k: (R_spectral[k], R_single[k]) for k in ['R_atm', 'R_dir', 'R_env', 'R_total']})
+        for k in ['R_atm', 'R_dir', 'R_env', 'R_total']:
+            sigma = np.hypot(error_spectral[k], error_single[k])
+            assert abs(R_spectral[k] - R_single[k]) < 4 * sigma, (wl, k, R_spectral[k], R_single[k], sigma)
@@ -0,0 +1,81 @@
+# This file is part of TMart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+### Typed photon records: conversion to and from the 13-column array and calc_ref on both 
+
+
+# Go up by 2 directory and import
+
+import sys
+import os.path as path
+two_up =  path.abspath(path.join(__file__ ,"../.."))
+sys.path.append(two_up)
+
+
+import tmart
+import numpy as np
+from tmart.tm_tally import tally_from_array, tally_to_array, TALLY_DTYPE
+
+rng = np.random.default_rng(0)
+n_photon = 1000
+
+# Random records: pt_id, movement, 6 local estimates, xyz, shadowed, if_env, type 
+array = np.column_stack([np.repeat(np.arange(n_photon), 3), 
+                         np.tile(np.arange(3), n_photon),
+                         rng.random((3*n_photon, 9)),
+                         rng.integers(0, 2, (3*n_photon, 2)),
+                         rng.integers(0, 5, 3*n_photon)])
+
+records = tally_from_array(array)
+assert records.dtype == TALLY_DTYPE
+assert np.array_equal(tally_to_array(records), array[:,0:13])
+print('Bytes per record: ' + str(TALLY_DTYPE.itemsize))
+
+R_records = tmart.calc_ref(records, n_photon=n_photon, detail=True)
+R_array = tmart.calc_ref(array[:,0:13], n_photon=n_photon, detail=True)
+R_vstack = tmart.calc_ref(np.vstack(records), detail=True) # results used to be stacked in some scripts 
+
+for k in R_records.keys():
+    assert np.isclose(R_records[k], R_array[k]) and np.isclose(R_records[k], R_vstack[k])
+    print(k, '     ' , R_records[k])
+
+### Streaming mode: sums of parts are the sums of the whole 
+
+from tmart.tm_tally import tally_sum, tally_merge
+
+bins = [np.linspace(0, 1, 11), np.linspace(0, 1, 6)]
+tally_whole = tally_sum(records, bins)
+# parts must not share photons, 3 records per photon 
+tally_parts = tally_merge([tally_sum(records[3*ids[0]:3*ids[-1]+3], bins) for ids in np.array_split(np.arange(n_photon), 7)])
+
+assert tally_whole['n_photon'] == n_photon
+for k in ['L_atm', 'L_dir', 'L_env', 'image_env']:
+    assert np.allclose(tally_whole[k], tally_parts[k])
+
+env = array[:,12] == 1
+image_env, _, _ = np.histogram2d(array[env,9], array[env,8], bins=bins, weights=array[env,2:6].sum(axis=1))
+assert np.allclose(image_env, tally_whole['image_env'])
+
+R_streaming = tmart.calc_ref(tally_parts, detail=True)
+for k in R_records.keys():
+    assert np.isclose(R_records[k], R_streaming[k])
+print('Streaming sums identical')
+
+### Adaptive mode: relative errors from the jobs agree with the errors of the photons 
+
+from tmart.tm_tally import tally_error
+
+jobs = np.array_split(np.arange(n_photon), 20)
+error = tally_error([tally_sum(records[3*ids[0]:3*ids[-1]+3]) for ids in jobs], [len(ids) for ids in jobs])
+
+L_photon = array[:,2:8].reshape(n_photon, 3, 6).sum(axis=1).sum(axis=1)
+error_photon = L_photon.std(ddof=1) / np.sqrt(n_photon) / L_photon.mean()
+print('Relative error of R_total, jobs: {:.5f}, photons: {:.5f}'.format(error['R_total'], error_photon))
+assert abs(error['R_total'] / error_photon - 1) < 0.5
@@ -12,9 +12,19 @@
 
 def AEC(AEC_band_name, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud, mask_all, n_photon, njobs):
     
+    band = AEC_read(AEC_band_name, metadata, config, mask_all)
+    AEC_parameters = AEC_get_parameters(band, AEC_band_6S, wl, AOT, metadata, config, anci, n_photon, njobs)
+    AEC_write(band, AEC_parameters, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud)
+
+
+# The three stages of AEC, the parameters from T-Mart can run while other bands are read or written 
+
+# Read a band, fill no_data and reshape to AEC resolution 
+def AEC_read(AEC_band_name, metadata, config, mask_all):
+    
     import tmart
-    import rasterio, sys, time, gc
-    from scipy import signal
+    import rasterio, os, tempfile
+    from rasterio.windows import Window
     import numpy as np
     import math
     
@@ -26,54 +36,135 @@ def AEC(AEC_band_name, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud,
     
     # Resolution of this particular band 
     res_band = int(abs(band_ds.transform[0]))
-    res_AEC = int( metadata['resolution'] * metadata['reshape_factor'])
     
     # Full resolution to AEC resolution (padded resolution)
     height_reshaped = int( metadata['AEC_height'] / metadata['reshape_factor']) 
     width_reshaped = int( metadata['AEC_width'] / metadata['reshape_factor']) 
 
-    # Number of columns and rows to pad
-    pad_columns = metadata['AEC_width'] - metadata['width'] 
-    pad_rows = metadata['AEC_height'] - metadata['height'] 
-    pad_rows_tmp = int(pad_rows/(res_band/metadata['resolution']))
-    pad_columns_tmp = int(pad_columns/(res_band/metadata['resolution']))
-    
     # Scaling
     scale_mult = metadata[str(AEC_band_name) + '_mult']
     scale_add = metadata[str(AEC_band_name) + '_add']
+
+    # Rows of the band processed at a time, a multiple of the reshape factor so that AEC cells are not split 
+    reshape_factor_tmp = int(metadata['reshape_factor'] * metadata['resolution']/res_band)
+    tile_rows = max(int(config.get('tile_rows', 1024)) // reshape_factor_tmp, 1) * reshape_factor_tmp
+    height_file, width_file = band_ds.height, band_ds.width
+    height_band = height_reshaped * reshape_factor_tmp 
+    width_band = width_reshaped * reshape_factor_tmp 
+    tiles = [(row0, min(row0 + tile_rows, height_band)) for row0 in range(0, height_band, tile_rows)]
+    
+    mask_band = mask_all[str(res_band) + 'm']
+    
+    # Read rows of the band, padded with 0
+    def read_raw(row0, row1):
+        raw = np.zeros((row1 - row0, width_band), dtype=band_ds.dtypes[0])
+        if row0 < height_file:
+            n_rows = min(row1, height_file) - row0
+            raw[:n_rows, :width_file] = band_ds.read(1, window=Window(0, row0, width_file, n_rows))
+        return raw
+    
+    # Read rows of the image as TOA reflectance, no_data as nan 
+    def read_image(row0, row1):
+        image = read_raw(row0, row1)
+        is_nan = image==0
+        image = image * scale_mult + scale_add
+        
+        # L8 solar zenith correction: https://www.usgs.gov/landsat-missions/using-usgs-landsat-level-1-data-product
+        if sensor =='L8' or sensor == 'L9': image = image / math.cos(metadata['sza']/180*math.pi)
+            
+        # Turn negative TOA to 0 
+        image[image<0] = 0
+    
+        # Mask no_data
+        image[is_nan] = np.nan
+        return image
     
-    # Read image
-    image = band_ds.read(1)
-    image = np.pad(image, ((0, pad_rows_tmp), (0, pad_columns_tmp)), mode='constant', constant_values=0)
-    is_nan = image==0
-    image = image * scale_mult + scale_add
+    # Reshape a tile to AEC resolution
+    def reshape_tile(tile):
+        return tile.reshape([tile.shape[0] // reshape_factor_tmp, reshape_factor_tmp, 
+                             width_reshaped, reshape_factor_tmp])
     
-    # L8 solar zenith correction: https://www.usgs.gov/landsat-missions/using-usgs-landsat-level-1-data-product
-    if sensor =='L8' or sensor == 'L9': image = image / math.cos(metadata['sza']/180*math.pi)
+    # The filled image is kept on disk 
+    temp_dir = tempfile.mkdtemp()
+    image = np.lib.format.open_memmap(os.path.join(temp_dir, 'image.npy'), mode='w+', 
+                                      dtype=np.float64, shape=(height_band, width_band))
+    image_AEC = np.zeros((height_reshaped, width_reshaped))
+    image_water_AEC = np.zeros((height_reshaped, width_reshaped))
+    n_water_AEC = np.zeros((height_reshaped, width_reshaped))
+    
+    for row0, row1 in tiles:
+        rows_AEC = slice(row0 // reshape_factor_tmp, row1 // reshape_factor_tmp)
+        
+        # Fill nan with closest values
+        tile = tmart.AEC.fillnan_rows(read_image, row0, row1, height_band)
+        image[row0:row1] = tile
         
-    # Turn negative TOA to 0 
-    image[image<0] = 0
+        # Reshape
+        image_AEC[rows_AEC] = reshape_tile(tile).mean(3).mean(1)
+        
+        # Water only, for smoothing the edges 
+        if reshape_factor_tmp>1:
+            tile_water = np.where(mask_band[row0:row1], np.nan, tile)
+            n_water_AEC[rows_AEC] = reshape_tile(~mask_band[row0:row1]).sum(3).sum(1)
+            
+            # np.nanmean without the warning of mean of empty slice, warning filters are not thread-safe 
+            def nanmean(a, axis):
+                with np.errstate(invalid='ignore'):
+                    return np.nansum(a, axis) / np.sum(~np.isnan(a), axis)
+            image_water_AEC[rows_AEC] = nanmean(nanmean(reshape_tile(tile_water),3),1)
+
+    band = {'AEC_band_name': AEC_band_name, 'band_ds': band_ds, 'image': image, 'temp_dir': temp_dir, 'median': tmart.AEC.median_rows(image, tile_rows),
+            'image_AEC': image_AEC, 'image_water_AEC': image_water_AEC, 'n_water_AEC': n_water_AEC, 
+            'res_band': res_band, 'mask_band': mask_band, 'reshape_factor_tmp': reshape_factor_tmp, 'tile_rows': tile_rows, 'tiles': tiles, 
+            'scale_mult': scale_mult, 'scale_add': scale_add}
+    return band
 
-    # Mask no_data
-    image[is_nan] = np.nan
+
+# Calculate AEC parameters 
+def AEC_get_parameters(band, AEC_band_6S, wl, AOT, metadata, config, anci, n_photon, njobs):
+    
+    import tmart
     
-    # Fill nan with closest values
-    image = tmart.AEC.fillnan(image)
+    res_AEC = int( metadata['resolution'] * metadata['reshape_factor'])
     
-    # Reshape_factor specific to this resolution 
-    reshape_factor_tmp = int(metadata['reshape_factor'] * metadata['resolution']/res_band)
+    # From the LUT of this band if there is one 
+    LUT_dir = config.get('LUT_dir', 'None')
+    LUT_dir = None if LUT_dir == 'None' else LUT_dir
+    LUT_name = metadata['sensor'] + '_' + band['AEC_band_name']
     
-    # Reshape
-    image_AEC = image.reshape([height_reshaped, reshape_factor_tmp, 
-                               width_reshaped, reshape_factor_tmp]).mean(3).mean(1)
+    AEC_parameters = tmart.AEC.lookup_parameters(LUT_dir, LUT_name, n_photon = n_photon, SR = band['median'], wl = wl, band = AEC_band_6S, 
+                                                 target_pt_direction=metadata['tm_pt_dir'], sun_dir=metadata['tm_sun_dir'],
+                                                 atm_profile = anci,
+                                                 aerosol_type = anci['r_maritime'], aot550 = AOT,
+                                                 cell_size = res_AEC,
+                                                 window_size = metadata['window_size'], isWater = 0, njobs=njobs)
+    return AEC_parameters
+
 
-    # Calculate AEC parameters 
-    AEC_parameters = tmart.AEC.get_parameters(n_photon = n_photon, SR = np.nanmedian(image), wl = wl, band = AEC_band_6S, 
-                                              target_pt_direction=metadata['tm_pt_dir'], sun_dir=metadata['tm_sun_dir'], 
-                                              atm_profile = anci, 
-                                              aerosol_type = anci['r_maritime'], aot550 = AOT, 
-                                              cell_size = res_AEC,
-                                              window_size = metadata['window_size'], isWater = 0, njobs=njobs)
+# Correct the band and write it 
+def AEC_write(band, AEC_parameters, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud):
+    
+    import tmart
+    import time, shutil
+    from rasterio.windows import Window
+    from scipy import signal
+    import numpy as np
+    import math
+    
+    sensor = metadata['sensor']
+    band_ds = band['band_ds']
+    image = band['image']
+    res_band = band['res_band']
+    res_AEC = int( metadata['resolution'] * metadata['reshape_factor'])
+    height_reshaped, width_reshaped = band['image_AEC'].shape
+    height_file, width_file = band_ds.height, band_ds.width
+    height_band = image.shape[0]
+    reshape_factor_tmp, tile_rows, tiles = band['reshape_factor_tmp'], band['tile_rows'], band['tiles']
+    scale_mult, scale_add = band['scale_mult'], band['scale_add']
+    mask_band = band['mask_band']
+    hp_cloud_contribution = float(config['cloud_contribution'])
+    hp_AE_land = config['AE_land'] == 'True'
+    image_AEC, image_water_AEC, n_water_AEC = band['image_AEC'], band['image_water_AEC'], band['n_water_AEC']
     
     conv_window_1   = AEC_parameters['conv_window_1']
     F_correction    = AEC_parameters['F_correction']
@@ -87,10 +178,6 @@ def AEC(AEC_band_name, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud,
     # Turn negative to 0
     image_R_surf[image_R_surf<0] = 0
     
-    # Read AEC parameters 
-    hp_cloud_contribution = float(config['cloud_contribution'])
-    hp_AE_land = config['AE_land'] == 'True'
-    
     # Reduce contribution of clouds according to setting 
     image_R_surf[mask_cloud[str(res_AEC) + 'm']] = image_R_surf[mask_cloud[str(res_AEC) + 'm']] * hp_cloud_contribution
     
@@ -98,20 +185,11 @@ def AEC(AEC_band_name, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud,
     start_time = time.time()
     print("\nConvolution started ")
     filter_kernel = np.flip(conv_window_1) # it's flipped in convolve by default
-    R_conv = signal.convolve2d(image_R_surf, filter_kernel, mode='same', boundary='fill', fillvalue=image_R_surf.mean())
+    R_conv = tmart.AEC.convolve_fft(image_R_surf, filter_kernel, fillvalue=image_R_surf.mean())
     print("Convolution completed: %s seconds " % (time.time() - start_time))
     
     # Smoothing the edges 
     if reshape_factor_tmp>1 and not hp_AE_land:
-        image_water = np.where(mask_all[str(res_band) + 'm'], np.nan, image)
-        
-        # Suppress warning of mean of empty slice 
-        import warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            image_water_AEC = image_water.reshape([height_reshaped, reshape_factor_tmp, width_reshaped, reshape_factor_tmp])
-            image_water_AEC = np.nanmean(image_water_AEC,3)
-            image_water_AEC = np.nanmean(image_water_AEC,1)
     
         # with non-water as nan 
         image_water_R_surf = image_water_AEC - R_atm
@@ -124,89 +202,164 @@ def AEC(AEC_band_name, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud,
     R_correction = (R_conv - image_R_surf) * F_correction 
     print('\nNumber of pixels where R_correction > R_surf: ' + str(np.sum(R_correction>image_R_surf)) + '/' + str(height_reshaped * width_reshaped))
     
-    # Back to the original size 
-    R_correction_original_shape = np.repeat(np.repeat(R_correction, reshape_factor_tmp, axis=0), reshape_factor_tmp, axis=1)
+    # Back to the original size, rows of R_correction_original_shape 
+    def read_correction(row0, row1):
+        rows = np.repeat(R_correction[row0 // reshape_factor_tmp : (row1 - 1) // reshape_factor_tmp + 1], reshape_factor_tmp, axis=0)
+        rows = rows[row0 % reshape_factor_tmp : row0 % reshape_factor_tmp + row1 - row0]
+        return np.repeat(rows, reshape_factor_tmp, axis=1)
     
-    # Smoothing the gridline artifacts 
-    if reshape_factor_tmp>1: 
+    # Keep only water, short name for R_correction_original_shape_water
+    def read_RC_water(row0, row1):
+        return np.where(mask_band[row0:row1], np.nan, read_correction(row0, row1))
     
-        # Keep only water, short name for R_correction_original_shape_water
-        RC_water = np.where(mask_all[str(res_band) + 'm'], np.nan, R_correction_original_shape)
-        RC_water_fill_nan = tmart.AEC.fillnan(RC_water)
-        
-        filter_size = 3
-        filter_kernel = np.full((filter_size,filter_size), 1/(filter_size**2))
-        
-        RC_water_smooth = signal.convolve2d(RC_water_fill_nan, filter_kernel,
-                                                  mode='same', boundary='fill', fillvalue=np.nanmean(RC_water))
+    # Mean of RC_water, from the number of water pixels in each cell 
+    if reshape_factor_tmp>1:
+        with np.errstate(invalid='ignore'):
+            RC_water_mean = np.sum(R_correction * n_water_AEC) / np.sum(n_water_AEC)
+    
+    filter_size = 3
+    filter_kernel = np.full((filter_size,filter_size), 1/(filter_size**2))
+    
+    for row0, row1 in tiles:
+        R_correction_original_shape = read_correction(row0, row1)
         
-        # place RC_water_smooth in R_correction_original_shape where there's water
-        R_correction_original_shape = np.where(mask_all[str(res_band) + 'm'], R_correction_original_shape, RC_water_smooth)
+        # Smoothing the gridline artifacts, only affects water pixels and their neighbours 
+        top, bottom = max(row0 - filter_size//2, 0), min(row1 + filter_size//2, height_band)
+        if reshape_factor_tmp>1 and not mask_band[top:bottom].all(): 
+            RC_water_fill_nan = tmart.AEC.fillnan_rows(read_RC_water, top, bottom, height_band, 
+                                                       halo=filter_size, max_distance=filter_size//2 + 1)
+            RC_water_smooth = signal.convolve2d(RC_water_fill_nan, filter_kernel,
+                                                mode='same', boundary='fill', fillvalue=RC_water_mean)
+            RC_water_smooth = RC_water_smooth[row0-top:row1-top]
+            
+            # place RC_water_smooth in R_correction_original_shape where there's water
+            R_correction_original_shape = np.where(mask_band[row0:row1], R_correction_original_shape, RC_water_smooth)
+    
+        # remove AE from TOA reflectance 
+        image[row0:row1] = image[row0:row1] - R_correction_original_shape - R_atm
     
-    # remove AE from TOA reflectance 
-    temp_SR = image - R_correction_original_shape - R_atm
+    # Now surface reflectance
+    temp_SR = image
     
     # Correcting for non-linearity of the ratio of environmental irradiance to surface reflectance for homogeneous Lambertian surfaces
     # This is implemented for water only
     # Input has to include land, because the function uses the env irradiance of the average reflectance across the scene
     print("\nIrradiance correction: ")
-    temp_SR_water = tmart.AEC.irradiance_correction(image = temp_SR, wl_RC = wl/1000, band = AEC_band_6S,
-                                                    tm_vza = metadata['vza'], tm_vaa = metadata['vaa'], 
-                                                    tm_sza = metadata['sza'], tm_saa = metadata['saa'],
-                                                    atm_profile = anci, 
-                                                    aerosol_type = anci['r_maritime'], aot550 = AOT)
-    
-    # If land correction is needed 
-    if hp_AE_land:
-        temp_out = np.where(mask_all[str(res_band) + 'm'], temp_SR, temp_SR_water)
+    median_SR = tmart.AEC.median_rows(temp_SR, tile_rows)
+    fit = tmart.AEC.irradiance_fit(wl_RC = wl/1000, band = AEC_band_6S,
+                                   tm_vza = metadata['vza'], tm_vaa = metadata['vaa'], 
+                                   tm_sza = metadata['sza'], tm_saa = metadata['saa'],
+                                   atm_profile = anci, 
+                                   aerosol_type = anci['r_maritime'], aot550 = AOT)
+    max_correction = 1
+    
+    for row0, row1 in tiles:
+        if row0 >= height_file: break
         
         # Back to original dimension 
-        if pad_rows_tmp>0: temp_out = temp_out[:-pad_rows_tmp]
-        if pad_columns_tmp>0: temp_out = temp_out[:, :-pad_columns_tmp]
+        n_rows = min(row1, height_file) - row0
+        window = Window(0, row0, width_file, n_rows)
+        raw = band_ds.read(1, window=window)
+        temp_SR_tile = temp_SR[row0:row0+n_rows, :width_file]
         
-        # Negative to 0, this ensures the lowest TOA reflectance is no lower than R_atm
-        # temp_out[temp_out<0] = 0
+        temp_SR_water = tmart.AEC.irradiance_correction(image = temp_SR_tile, wl_RC = wl/1000, 
+                                                        median_image = median_SR, fit = fit, print_on = False)
+        max_correction = min(max_correction, np.min(np.minimum(fit(temp_SR_tile) / fit(median_SR), 1)))
         
-        # Scaling
-        temp_out = temp_out + R_atm # TOA reflectance
+        # If land correction is needed 
+        if hp_AE_land:
+            temp_out = np.where(mask_band[row0:row0+n_rows, :width_file], temp_SR_tile, temp_SR_water)
+            
+            # Negative to 0, this ensures the lowest TOA reflectance is no lower than R_atm
+            # temp_out[temp_out<0] = 0
+            
+            # Scaling
+            temp_out = temp_out + R_atm # TOA reflectance
+            
+            if sensor =='L8' or sensor == 'L9':
+                temp_out = np.maximum(((temp_out * math.cos(metadata['sza']/180*math.pi) - scale_add) / scale_mult),1).astype(int)
+            else:
+                temp_out = np.maximum(((temp_out - scale_add) / scale_mult),1).astype(int)
         
-        if sensor =='L8' or sensor == 'L9':
-            temp_out = np.maximum(((temp_out * math.cos(metadata['sza']/180*math.pi) - scale_add) / scale_mult),1).astype(int)
+        # If only water correction 
         else:
-            temp_out = np.maximum(((temp_out - scale_add) / scale_mult),1).astype(int)
+            # Negative to 0
+            # temp_SR_water[temp_SR_water<0] = 0
+            
+            temp_out = temp_SR_water + R_atm # TOA reflectance
+            temp_mask = mask_band[row0:row0+n_rows, :width_file]
+            
+            # Scaling
+            if sensor =='L8' or sensor == 'L9':
+                temp_out = np.where(temp_mask,    raw,  np.maximum(((temp_out * math.cos(metadata['sza']/180*math.pi) - scale_add) / scale_mult),1).astype(int) )
+            else:
+                temp_out = np.where(temp_mask,    raw,  np.maximum(((temp_out - scale_add) / scale_mult),1).astype(int) )
     
-    # If only water correction 
-    else:
-        # Negative to 0
-        # temp_SR_water[temp_SR_water<0] = 0
-        
-        temp_out = temp_SR_water + R_atm # TOA reflectance
-        temp_mask = mask_all[str(res_band) + 'm']
-        
-        # back to original dimension 
-        if pad_rows_tmp>0: 
-            temp_out = temp_out[:-pad_rows_tmp]
-            temp_mask = temp_mask[:-pad_rows_tmp]
-        if pad_columns_tmp>0: 
-            temp_out = temp_out[:, :-pad_columns_tmp]
-            temp_mask = temp_mask[:, :-pad_columns_tmp]
-        
-        # Scaling
-        if sensor =='L8' or sensor == 'L9':
-            temp_out = np.where(temp_mask,    band_ds.read(1),  np.maximum(((temp_out * math.cos(metadata['sza']/180*math.pi) - scale_add) / scale_mult),1).astype(int) )
-        else:
-            temp_out = np.where(temp_mask,    band_ds.read(1),  np.maximum(((temp_out - scale_add) / scale_mult),1).astype(int) )
-
-    # Convert nan back to 0
-    temp_is_nan = is_nan
-    if pad_rows_tmp>0: temp_is_nan = temp_is_nan[:-pad_rows_tmp]
-    if pad_columns_tmp>0: temp_is_nan = temp_is_nan[:, :-pad_columns_tmp]
+        # Convert nan back to 0
+        temp_out[raw==0] = 0
+    
+        # Make edits to the file
+        band_ds.write(temp_out, 1, window=window)
+    
+    max_correction_percent = str(round((1 - max_correction)*100, 2))
+    print('Maximum change in pixel value: ' + max_correction_percent + '%')
     
-    temp_out[temp_is_nan] = 0
-
-    # Make edits to the file
-    band_ds.write(temp_out, 1)
     band_ds.close()
     
-    del band_ds, image, image_AEC, image_R_surf, is_nan, R_conv, R_correction, R_correction_original_shape, temp_SR, temp_SR_water, temp_is_nan, temp_out
-    gc.collect()
+    temp_dir = band['temp_dir']
+    del band_ds, image, temp_SR
+    band.clear()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+# AEC for a list of bands, overlapping the stages of different bands 
+def AEC_bands(bands, AOT, metadata, config, anci, mask_cloud, mask_all, n_photon, njobs, on_done = None):
+    '''AEC for bands of (AEC_band_name, AEC_band_6S, wl). Bands are read and written in threads while the parameters of 
+    the next band are calculated. The number of bands in memory at a time is limited by memory_budget in config.txt (MB). 
+    on_done(AEC_band_name) is called after each band is written, in the order of bands.
+    '''
+    
+    from concurrent.futures import ThreadPoolExecutor
+    
+    # Memory of a band in progress: a few float64 copies of a strip of rows with halo, at the finest resolution 
+    tile_rows = int(config.get('tile_rows', 1024))
+    memory_band = 8 * 8 * (tile_rows + 2 * 64) * metadata['AEC_width']
+    memory_budget = float(config.get('memory_budget', 4096)) * 2**20
+    n_bands = int(max(1, min(len(bands), memory_budget // memory_band)))
+    print('\nBands processed at a time: {}'.format(n_bands))
+    
+    if n_bands == 1:
+        for AEC_band_name, AEC_band_6S, wl in bands:
+            print('\n============= AEC: {} ==================='.format(AEC_band_name))
+            AEC(AEC_band_name, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud, mask_all, n_photon, njobs)
+            if on_done is not None: on_done(AEC_band_name)
+        return
+    
+    with ThreadPoolExecutor(max_workers=n_bands) as executor:
+        reading = [] # futures of AEC_read
+        writing = [] # (AEC_band_name, future of AEC_write)
+        
+        # Wait for the oldest band to be written 
+        def finish_oldest():
+            AEC_band_name, future = writing.pop(0)
+            future.result()
+            if on_done is not None: on_done(AEC_band_name)
+        
+        for i, (AEC_band_name, AEC_band_6S, wl) in enumerate(bands):
+            
+            # Read ahead as far as the memory budget allows 
+            while len(reading) < len(bands) and (len(reading) <= i or len(reading) - i + len(writing) < n_bands):
+                if len(reading) - i + len(writing) >= n_bands: finish_oldest()
+                reading.append(executor.submit(AEC_read, bands[len(reading)][0], metadata, config, mask_all))
+            
+            band = reading[i].result()
+            reading[i] = None
+            print('\n============= AEC: {} ==================='.format(AEC_band_name))
+            AEC_parameters = AEC_get_parameters(band, AEC_band_6S, wl, AOT, metadata, config, anci, n_photon, njobs)
+            writing.append((AEC_band_name, executor.submit(AEC_write, band, AEC_parameters, AEC_band_6S, wl, AOT, 
+                                                           metadata, config, anci, mask_cloud)))
+            
+            # Report bands already written 
+            while writing and writing[0][1].done(): finish_oldest()
+        
+        while writing: finish_oldest()
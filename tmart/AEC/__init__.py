@@ -7,30 +7,57 @@
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
 
-from .AEC import *
-from .anci_download import *
-from .anci_get_AER import *
-from .anci_get_OWV import *
-from .anci_list_files import *
-from .compute_gas_transmittance import *
-from .compute_masks import *
-from .fillnan import *
-from .get_ancillary import *
-from .get_AOT import *
-from .get_parameters import *
-from .identify_input import *
-from .identify_sensor import *
-from .irradiance_correction import *
-from .plot_water_extent import *
-from .read_config import *
-from .read_metadata_Landsat import *
-from .read_metadata_S2 import *
-from .read_PRISMA_vaa import *
-from .read_PRISMA_north import *
-from .read_xml_S2_scene import *
-from .read_xml_S2 import *
-from .run_acoliteL1R import *
-from .run_regular import *
-from .run import *
-from .unzip import *
-from .write_atm_info import *
+# Functions are imported from their modules on first access, e.g. tmart.AEC.run(...), 
+# to keep 'import tmart' fast. Each module has a function of the same name 
+_MODULES = {name: name for name in [
+    'AEC',
+    'anci_download',
+    'anci_get_AER',
+    'anci_get_OWV',
+    'anci_list_files',
+    'compute_gas_transmittance',
+    'compute_masks',
+    'convolve_fft',
+    'fillnan',
+    'get_ancillary',
+    'get_AOT',
+    'get_parameters',
+    'identify_input',
+    'identify_sensor',
+    'irradiance_correction',
+    'plot_water_extent',
+    'read_config',
+    'read_metadata_Landsat',
+    'read_metadata_S2',
+    'read_PRISMA_vaa',
+    'read_PRISMA_north',
+    'read_xml_S2_scene',
+    'read_xml_S2',
+    'run_acoliteL1R',
+    'run_regular',
+    'run',
+    'unzip',
+    'write_atm_info',
+]}
+_MODULES.update({name: 'AEC' for name in ['AEC_read', 'AEC_get_parameters', 'AEC_write', 'AEC_bands']})
+_MODULES['normal_distribution'] = 'compute_gas_transmittance'
+_MODULES['calculate_heights'] = 'compute_gas_transmittance'
+_MODULES['irradiance_fit'] = 'irradiance_correction'
+_MODULES.update({name: 'parameters_LUT' for name in ['make_parameters_LUT', 'read_parameters_LUT', 'lookup_parameters']})
+_MODULES['fillnan_rows'] = 'tiles'
+_MODULES['median_rows'] = 'tiles'
+
+def __getattr__(name):
+    if name in _MODULES:
+        import importlib
+        module = importlib.import_module('.' + _MODULES[name], __name__)
+        
+        # The import binds the submodule to the package, replace it with the functions 
+        for k, v in _MODULES.items():
+            if v == _MODULES[name]:
+                globals()[k] = getattr(module, k)
+        return globals()[name]
+    raise AttributeError("module 'tmart.AEC' has no attribute '{}'".format(name))
+
+def __dir__():
+    return sorted(list(globals()) + list(_MODULES))
@@ -0,0 +1,69 @@
+# This file is part of T-Mart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# T-Mart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+# Spectra of convolution kernels, reused across blocks and across bands that share a window 
+_kernel_spectra = {}
+N_KERNEL_SPECTRA = 8
+
+
+def convolve_fft(image, kernel, fillvalue=0, block_size=2048):
+    '''Same output as scipy.signal.convolve2d(image, kernel, mode='same', boundary='fill', fillvalue=fillvalue), 
+    computed by overlap-add of FFT blocks, O(N log N) instead of O(N K^2) for an N-pixel image and a KxK kernel. 
+    
+    Outside the image is filled with fillvalue: the image minus fillvalue is convolved with zero padding, 
+    then fillvalue times the sum of the kernel is added back. 
+    
+    Arguments:
+
+    * ``image`` -- 2D numpy array.
+    * ``kernel`` -- 2D numpy array, convolution kernel.
+    * ``fillvalue`` -- Value outside the image, e.g. the mean of the image.
+    * ``block_size`` -- Rows and columns of the image blocks transformed at a time, limits memory use. 
+
+    '''
+    
+    import numpy as np
+    from scipy import fft
+    import hashlib
+    
+    image = np.asarray(image, dtype=float)
+    kernel = np.asarray(kernel, dtype=float)
+    
+    height, width = image.shape
+    k_height, k_width = kernel.shape
+    b_height, b_width = min(block_size, height), min(block_size, width)
+    
+    # FFT size of a block 
+    fshape = (fft.next_fast_len(b_height + k_height - 1, real=True), 
+              fft.next_fast_len(b_width + k_width - 1, real=True))
+    
+    # Spectrum of the kernel 
+    key = (hashlib.sha1(kernel.tobytes()).hexdigest(), kernel.shape, fshape)
+    if key not in _kernel_spectra:
+        _kernel_spectra[key] = fft.rfft2(kernel, fshape)
+        while len(_kernel_spectra) > N_KERNEL_SPECTRA:
+            _kernel_spectra.pop(next(iter(_kernel_spectra)))
+    spectrum = _kernel_spectra[key]
+    
+    # Overlap-add of the blocks into the full convolution 
+    image_0 = image - fillvalue
+    full = np.zeros((height + k_height - 1, width + k_width - 1))
+    
+    for i in range(0, height, b_height):
+        for j in range(0, width, b_width):
+            block = image_0[i:i+b_height, j:j+b_width]
+            h, w = block.shape
+            conv = fft.irfft2(fft.rfft2(block, fshape) * spectrum, fshape)
+            full[i:i+h+k_height-1, j:j+w+k_width-1] += conv[:h+k_height-1, :w+k_width-1]
+    
+    # Centre of the full convolution, as in mode='same' 
+    row_0, col_0 = (k_height - 1) // 2, (k_width - 1) // 2
+    
+    return full[row_0:row_0+height, col_0:col_0+width] + fillvalue * kernel.sum()
@@ -10,14 +10,18 @@
 
 # Calculate AOT 550 value by identifying zero-water-leaving-reflectance pixels 
 
-def get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon):
+# Maximum number of T-Mart runs in the search of AOT after the two ends 
+AOT_SEARCH_MAX_ITERATIONS = 6
+
+def get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon, njobs=100):
     
     import tmart, Py6S
     import numpy as np
     import rasterio
     import time 
-    from scipy import signal
     from scipy.interpolate import interp1d
+    from scipy import stats
+    from concurrent.futures import ThreadPoolExecutor
     
     sensor = metadata['sensor']
     
@@ -86,24 +90,43 @@ def get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon):
     image_AEC = image.reshape([height_reshaped, reshape_factor_tmp, 
                                width_reshaped, reshape_factor_tmp]).mean(3).mean(1)
     
-    # Loop through AOTs
-    AOTs = [0.0, 0.1, 0.3]
-
-    # Record lowest R at each of the AOTs
-    R_lowest = []
+    # Shared by all AOTs 
+    SR_median = np.nanmedian(image)
+    hp_cloud_contribution = float(config['cloud_contribution'])
+    hp_AE_land = config['AE_land'] == 'True'
+    
+    # User specified minimum R of water in NIR 
+    min_R_NIR = float(config['min_R_NIR'])
+    
+    # Water only, for smoothing the edges 
+    if reshape_factor_tmp>1 and not hp_AE_land: 
+        image_water = np.where(mask_all[str(res_band) + 'm'], np.nan, image)
+        
+        # np.nanmean without the warning of mean of empty slice, warning filters are not thread-safe 
+        def nanmean(a, axis):
+            with np.errstate(invalid='ignore'):
+                return np.nansum(a, axis) / np.sum(~np.isnan(a), axis)
+        image_water_AEC = image_water.reshape([height_reshaped, reshape_factor_tmp, width_reshaped, reshape_factor_tmp])
+        image_water_AEC = nanmean(nanmean(image_water_AEC,3),1)
+        del image_water
     
-    for AOT in AOTs:
+    # From the LUT of this band if there is one 
+    LUT_dir = config.get('LUT_dir', 'None')
+    LUT_dir = None if LUT_dir == 'None' else LUT_dir
+    LUT_name = sensor + '_' + ('B5' if sensor == 'L8' else 'B8A')
     
-        AEC_parameters = tmart.AEC.get_parameters(n_photon = n_photon, SR = np.nanmedian(image), wl = wl, band = band, 
-                                                  target_pt_direction=metadata['tm_pt_dir'], sun_dir=metadata['tm_sun_dir'], 
-                                                  atm_profile = anci, 
-                                                  aerosol_type = anci['r_maritime'], aot550 = AOT, 
-                                                  cell_size = res_AEC,
-                                                  window_size = metadata['window_size'], isWater = 1)
+    # Lowest residual water-leaving reflectance after AEC at an AOT 
+    def find_R_lowest(AOT):
+    
+        AEC_parameters = tmart.AEC.lookup_parameters(LUT_dir, LUT_name, n_photon = n_photon, SR = SR_median, wl = wl, band = band, 
+                                                     target_pt_direction=metadata['tm_pt_dir'], sun_dir=metadata['tm_sun_dir'], 
+                                                     atm_profile = anci, 
+                                                     aerosol_type = anci['r_maritime'], aot550 = AOT, 
+                                                     cell_size = res_AEC,
+                                                     window_size = metadata['window_size'], isWater = 1, njobs = njobs)
     
         conv_window_1   = AEC_parameters['conv_window_1']
         F_correction    = AEC_parameters['F_correction']
-        F_captured      = AEC_parameters['F_captured']
         R_atm           = AEC_parameters['R_atm']
         R_glint         = AEC_parameters['R_glint']
         
@@ -112,37 +135,22 @@ def get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon):
         
         # image_R_surf: reshaped 
         image_R_surf = image_AEC - R_atm
-        print('\nNumber of negative R_surf pixels: ' + str(np.sum(image_R_surf < 0)) + '/' + str(height_reshaped * width_reshaped))
+        print('\nAOT550 {}, number of negative R_surf pixels: '.format(AOT) + str(np.sum(image_R_surf < 0)) + '/' + str(height_reshaped * width_reshaped))
         
         # Turn negative to 0
         image_R_surf[image_R_surf<0] = 0
-    
-        # Read AEC parameters 
-        hp_cloud_contribution = float(config['cloud_contribution'])
-        hp_AE_land = config['AE_land'] == 'True'
         
         # Reduce contribution of clouds according to setting 
         image_R_surf[mask_cloud[str(res_AEC) + 'm']] = image_R_surf[mask_cloud[str(res_AEC) + 'm']] * hp_cloud_contribution
         
         # Convolution 
         start_time = time.time()
-        print("\nConvolution started ")
         filter_kernel = np.flip(conv_window_1) # it's flipped in convolve by default
-        R_conv = signal.convolve2d(image_R_surf, filter_kernel,
-                                         mode='same', boundary='fill', fillvalue=image_R_surf.mean())
-        print("Convolution completed: %s seconds " % (time.time() - start_time))
+        R_conv = tmart.AEC.convolve_fft(image_R_surf, filter_kernel, fillvalue=image_R_surf.mean())
+        print("AOT550 {}, convolution completed: {} seconds ".format(AOT, time.time() - start_time))
         
         # Smoothing the edges 
         if reshape_factor_tmp>1 and not hp_AE_land: 
-            image_water = np.where(mask_all[str(res_band) + 'm'], np.nan, image)
-            
-            # Suppress warning of mean of empty slice 
-            import warnings
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", category=RuntimeWarning)
-                image_water_AEC = image_water.reshape([height_reshaped, reshape_factor_tmp, width_reshaped, reshape_factor_tmp])
-                image_water_AEC = np.nanmean(image_water_AEC,3)
-                image_water_AEC = np.nanmean(image_water_AEC,1)
     
             # with non-water as nan 
             image_water_R_surf = image_water_AEC - R_atm
@@ -152,7 +160,7 @@ def get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon):
             image_R_surf = np.where(np.isnan(image_water_R_surf), image_R_surf, image_water_R_surf)   
     
         R_correction = (R_conv - image_R_surf) * F_correction 
-        print('\nNumber of pixels where R_correction > R_surf : ' + str(np.sum(R_correction>image_R_surf)) + '/' + str(height_reshaped * width_reshaped))
+        print('AOT550 {}, number of pixels where R_correction > R_surf : '.format(AOT) + str(np.sum(R_correction>image_R_surf)) + '/' + str(height_reshaped * width_reshaped))
         
         # Back to the original size 
         R_correction_original_shape = np.repeat(np.repeat(R_correction, reshape_factor_tmp, axis=0), 
@@ -160,16 +168,13 @@ def get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon):
         
         # Skipping smoothing the gridline artifacts 
         
-        # User specified minimum R of water in NIR 
-        min_R_NIR = float(config['min_R_NIR'])
-        
         # remove AE from TOA reflectance 
         temp_SR = image - R_correction_original_shape - R_atm
+        del R_correction_original_shape
         
         # Correcting for non-linearity of the ratio of environmental irradiance to surface reflectance for homogeneous Lambertian surfaces
         # This is implemented for water only
         # Input has to include land, because the function uses the env irradiance of the average reflectance across the scene
-        print("\nIrradiance correction: ")
         temp_SR_water = tmart.AEC.irradiance_correction(image = temp_SR, wl_RC = wl/1000, band = band,
                                                         tm_vza = metadata['vza'], tm_vaa = metadata['vaa'], 
                                                         tm_sza = metadata['sza'], tm_saa = metadata['saa'],
@@ -179,72 +184,93 @@ def get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon):
         # Residual water-leaving reflectance, we want the darkest pixels to be near 0
         temp_SR_water = temp_SR_water - R_glint - min_R_NIR
         
-        # Add nan back 
-        temp_SR_water[is_nan] = np.nan
-        
-        # Flatten the 2D array to a 1D array for plotting
-        flattened_data = temp_SR_water.flatten()
-        
-        sorted_data = np.sort(flattened_data)
-        smallest_values = sorted_data[:10_000]
-        
-        
-        
-        
+        # The 10_000 smallest values without nan, sorted 
         ### Consider an adaptive number instead of 10_000 
         # Either by area or correlation coefficient
-        
-        
+        values = temp_SR_water[~is_nan]
+        n_smallest = min(10_000, values.size)
+        smallest_values = np.sort(np.partition(values, n_smallest - 1)[:n_smallest])
         
         # Create an array of indices for the smallest values
-        indices = np.arange(10_000)
-        
-        
-        '''
-        ### Scatter plot 
-        
-        from matplotlib import pyplot as plt
-        
-        # Create a scatter plot
-        plt.scatter(indices, smallest_values, marker='o', s=10)  # Adjust marker and size as needed
-        plt.xlabel('Index')
-        plt.ylabel('Value')
-        plt.title('Scatter Plot of Smallest Values, AOT550: ' + str(AOT))
-        plt.grid(True)
-        
-        # Show the plot
-        plt.show()
-        '''
-            
+        indices = np.arange(n_smallest)
     
         # Regression 
-        from scipy import stats
         slope, intercept, r_value, p_value, std_err = stats.linregress(indices, smallest_values)
-        print('\nLowest reflectance: ' + str(intercept))
-        R_lowest.append(intercept)
+        print('\nAOT550 {}, lowest reflectance: '.format(AOT) + str(intercept))
+        return intercept
     
-    print('\nAOTs: ' + str(AOTs))
-    print('R_lowest: ' + str(R_lowest))
+    # 6S outputs of the band do not depend on AOT, run 6S once before the threads of the AOTs 
+    if LUT_dir is None:
+        tmart.Atmosphere(anci, aot550 = 0, aerosol_type = anci['r_maritime']).prewarm_cache([band])
     
-    # Interpolate AOT
-    if min(R_lowest) > 0: interpolated_AOT = max(AOTs)
-    elif max(R_lowest) < 0: interpolated_AOT = min(AOTs)
-    else:
-        # prioritize the first two values, in case the line crosses 0 twice 
-        if R_lowest[1] < 0:    
-            AOTs = AOTs[ : -1]
-            R_lowest = R_lowest[ : -1]
+    # Photon runs of several AOTs at the same time, jobs of all AOTs share the pool of workers 
+    def find_R_lowest_all(AOTs):
+        with ThreadPoolExecutor(max_workers=len(AOTs)) as executor:
+            return list(executor.map(find_R_lowest, AOTs))
+    
+    AOT_search = config.get('AOT_search', 'sweep')
+    
+    # Secant search between 0 and 0.3 until the lowest reflectance is close to 0 
+    if AOT_search == 'bisection':
+        AOT_tolerance = float(config.get('AOT_tolerance', 0.0005))
+        AOTs = [0.0, 0.3]
+        R_lowest = find_R_lowest_all(AOTs)
         
-        # Create an interpolation function
-        f = interp1d(R_lowest, AOTs, kind='linear')
+        if min(R_lowest) > 0: interpolated_AOT = max(AOTs)
+        elif max(R_lowest) < 0: interpolated_AOT = min(AOTs)
+        else:
+            (a, R_a), (b, R_b) = zip(AOTs, R_lowest)
+            interpolated_AOT = None
+            side = 0
+            for i in range(AOT_SEARCH_MAX_ITERATIONS):
+                
+                # Zero of the line through the two ends
+                c = b - R_b * (b - a) / (R_b - R_a)
+                R_c = find_R_lowest(c)
+                AOTs.append(c)
+                R_lowest.append(R_c)
+                if abs(R_c) < AOT_tolerance: 
+                    interpolated_AOT = c
+                    break
+                
+                # Keep the ends on both sides of 0, halving an end kept twice (Illinois method) 
+                if np.sign(R_c) == np.sign(R_a):
+                    a, R_a = c, R_c
+                    if side == -1: R_b = R_b / 2
+                    side = -1
+                else:
+                    b, R_b = c, R_c
+                    if side == 1: R_a = R_a / 2
+                    side = 1
+            
+            if interpolated_AOT is None:
+                interpolated_AOT = b - R_b * (b - a) / (R_b - R_a)
+    
+    # AOTs 0, 0.1 and 0.3
+    else:
+        AOTs = [0.0, 0.1, 0.3]
+        R_lowest = find_R_lowest_all(AOTs)
         
-        # Find x when y is 0
-        interpolated_AOT = f(0)
+        # Interpolate AOT
+        if min(R_lowest) > 0: interpolated_AOT = max(AOTs)
+        elif max(R_lowest) < 0: interpolated_AOT = min(AOTs)
+        else:
+            # prioritize the first two values, in case the line crosses 0 twice 
+            if R_lowest[1] < 0:    
+                AOTs = AOTs[ : -1]
+                R_lowest = R_lowest[ : -1]
+            
+            # Create an interpolation function
+            f = interp1d(R_lowest, AOTs, kind='linear')
+            
+            # Find x when y is 0
+            interpolated_AOT = f(0)
+    
+    print('\nAOTs: ' + str(AOTs))
+    print('R_lowest: ' + str(R_lowest))
 
     # Limit the range 
     if interpolated_AOT > max(AOTs): interpolated_AOT = max(AOTs)
     if interpolated_AOT < min(AOTs): interpolated_AOT = min(AOTs)
     print('interpolated_AOT: ' + str(interpolated_AOT))
-    return interpolated_AOT 
-
-
+    return interpolated_AOT
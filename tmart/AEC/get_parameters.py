@@ -21,7 +21,6 @@ def get_parameters(n_photon = 10_000, SR = 0.5,
     
     import tmart
     import numpy as np
-    import pandas as pd 
     from Py6S.Params.atmosprofile import AtmosProfile
 
     if window_size is not None: 
@@ -59,7 +58,13 @@ def get_parameters(n_photon = 10_000, SR = 0.5,
                           pixel=[int(window_size_y/2),int(window_size_x/2)], 
                           sun_dir=sun_dir)    
     
-    results = my_tmart.run(wl=wl, band=band, n_photon=n_photon, njobs=njobs)
+    # Bins of the cells, environment contributions are summed in each cell
+    x_bins = np.linspace(0, cell_size * window_size_x, window_size_x + 1)
+    y_bins = np.linspace(0, cell_size * window_size_y, window_size_y + 1)
+    
+    # Streaming: jobs return sums and the histogram instead of the movements of every photon
+    results = my_tmart.run(wl=wl, band=band, n_photon=n_photon, njobs=njobs, 
+                           streaming=True, hist_bins=[y_bins, x_bins])
     # results = my_tmart.run_plot(wl=wl, plot_on=True, plot_range=[0,cell_size*window_size_x,0,cell_size*window_size_x,0,100_000])
     
     # Calculate reflectances using recorded photon information 
@@ -69,40 +74,9 @@ def get_parameters(n_photon = 10_000, SR = 0.5,
         
     ### Computing parameters  
     
-    # column names 
-    columns = ['pt_id', 'movement', 'L_cox-munk', 'L_whitecap', 'L_water', 'L_land', 
-               'L_rayleigh', 'L_mie', 'x', 'y', 'z', 'shadowed', 'if_env']
-    
-    # Action: make this a numpy array to speed up computation 
-    df = pd.DataFrame(results, columns = columns)
-    df_env = df[df.if_env==1].copy()
-    
-    df_env_sum = df_env.iloc[:,2:6].sum(axis=1)
-    df_env['L_surface'] = df_env_sum
-    
-    ### Bin points to convolution matrix  
-    
-    # Old method 
-    
-    # image_env = np.full((window_size_x, window_size_y), 0.0)
-    # for xi in range(window_size_x):
-    #     for yi in range(window_size_y):
-    #         print('xi: ' + str(xi))
-    #         print('yi: ' + str(yi))
-    #         xmin = xi * cell_size 
-    #         xmax = (xi + 1) * cell_size 
-    #         ymin = yi * cell_size
-    #         ymax = (yi + 1) * cell_size
-    #         r_sum = df_env[(df_env.x>xmin) & (df_env.y>ymin) & 
-    #                         (df_env.x<xmax) & (df_env.y<ymax)].L_surface.sum() # .L_land.sum()
-    #         image_env[yi,xi] = r_sum 
-    
-    # Classify df_env rows into cells
-    x_bins = np.linspace(0, cell_size * window_size_x, window_size_x + 1)
-    y_bins = np.linspace(0, cell_size * window_size_y, window_size_y + 1)
-
-    # Use np.histogram2d to compute the sum of values in each cell
-    image_env, _, _ = np.histogram2d(df_env['y'], df_env['x'], bins=[y_bins, x_bins], weights=df_env['L_surface'])
+    # Sum of environment contributions (L_cox-munk, L_whitecap, L_water and L_land) in each cell,
+    # the same as np.histogram2d of the if_env rows on y and x 
+    image_env = results['image_env']
     
     conv_window = image_env.copy()
     
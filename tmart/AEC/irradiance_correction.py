@@ -15,7 +15,8 @@ from Py6S import *
 def irradiance_correction(image, wl_RC, band = None,
                           tm_vza = 0, tm_vaa = 0, tm_sza = 0, tm_saa = 0, 
                           atm_profile = None, 
-                          aerosol_type = 'Maritime', aot550 = 0):
+                          aerosol_type = 'Maritime', aot550 = 0, 
+                          median_image = None, fit = None, print_on = True):
     '''
     
 
@@ -41,6 +42,12 @@ def irradiance_correction(image, wl_RC, band = None,
         DESCRIPTION. The default is 'Maritime'.
     aot550 : TYPE, optional
         DESCRIPTION. The default is 0.
+    median_image : float, optional
+        Median of the whole image when image is a tile. The default is the median of image.
+    fit : numpy poly1d, optional
+        Ratio to surface reflectance from irradiance_fit, skips the 6S runs. The default is None.
+    print_on : bool, optional
+        Print the maximum change. The default is True.
 
     Returns
     -------
@@ -50,12 +57,57 @@ def irradiance_correction(image, wl_RC, band = None,
     '''
     
     import numpy as np
-    import sys
+    
+    if median_image is None:
+        median_image = np.median(image)
+    
+    if fit is None:
+        fit = irradiance_fit(wl_RC, band, tm_vza, tm_vaa, tm_sza, tm_saa, atm_profile, aerosol_type, aot550)
+    p = fit
+    
+    median_ratio = p(median_image)
+    
+    # Ratio of all pixels 
+    ratio = p(image)
+    
+    # Relative to median 
+    correction = ratio / median_ratio
+    
+    # Do not correct pixels brighter than mean 
+    correction[correction>1] = 1
+    image_out = image * correction
+    if print_on:
+        max_correction = correction.min()
+        max_correction_percent = str(round((1 - max_correction)*100, 2))
+        print('Maximum change in pixel value: ' + max_correction_percent + '%')
+    
+    return image_out
+
+
+# Ratio of TOA direct reflectance to surface reflectance, a quadratic polynomial of surface reflectance from 6S 
+def irradiance_fit(wl_RC, band = None,
+                   tm_vza = 0, tm_vaa = 0, tm_sza = 0, tm_saa = 0, 
+                   atm_profile = None, 
+                   aerosol_type = 'Maritime', aot550 = 0):
+    
+    import numpy as np
+    import sys, copy
+    from concurrent.futures import ThreadPoolExecutor
+    from ..tm_cache import cache_key, cache_get, cache_put
     
     # An unknown bug of 6S unable to handle 551nm
     if wl_RC == 0.551: wl_RC = 0.55
     
-    median_image = np.median(image)
+    # Lists of TOA direct reflectance and corresponding surface reflectance 
+    list_SR = [0.25,0.5,0.75,1]
+    
+    # Cached across bands, AOTs and scenes of the same inputs 
+    atm_input = None if atm_profile is None else [atm_profile['water_vapour'], atm_profile['ozone']]
+    key = cache_key('irradiance_fit', wl_RC, str(band), tm_vza, tm_vaa, tm_sza, tm_saa, 
+                    atm_input, aerosol_type, aot550, list_SR)
+    entry = cache_get(key)
+    if entry is not None:
+        return np.poly1d(entry['fit_ratio_SR'])
     
     # SixS
     s = SixS()
@@ -96,35 +148,20 @@ def irradiance_correction(image, wl_RC, band = None,
     else: 
         s.wavelength = band
         
-    # Lists of TOA direct reflectance and corresponding surface reflectance 
-    list_R_dir = []
-    list_SR = [0.25,0.5,0.75,1]
-    
-    for SR in list_SR:
-        s.ground_reflectance = GroundReflectance.HomogeneousLambertian(SR)
-        s.run()
-        list_R_dir.append(s.outputs.values['pixel_reflectance'])
+    # The 6S runs are separate processes, run at the same time 
+    def run_6S(SR):
+        s_SR = copy.deepcopy(s)
+        s_SR.ground_reflectance = GroundReflectance.HomogeneousLambertian(SR)
+        s_SR.run()
+        return s_SR.outputs.values['pixel_reflectance']
     
+    with ThreadPoolExecutor(max_workers=len(list_SR)) as executor:
+        list_R_dir = list(executor.map(run_6S, list_SR))
     
     # Calculate the ratio 
     array_R_dir = np.array(list_R_dir)
     array_SR = np.array(list_SR)
     array_ratio = array_R_dir / array_SR
     fit_ratio_SR = np.polyfit(array_SR , array_ratio, 2)
-    p = np.poly1d(fit_ratio_SR)
-    median_ratio = p(median_image)
-    
-    # Ratio of all pixels 
-    ratio = p(image)
-    
-    # Relative to median 
-    correction = ratio / median_ratio
-    
-    # Do not correct pixels brighter than mean 
-    correction[correction>1] = 1
-    image_out = image * correction
-    max_correction = correction.min()
-    max_correction_percent = str(round((1 - max_correction)*100, 2))
-    print('Maximum change in pixel value: ' + max_correction_percent + '%')
-    
-    return image_out
+    cache_put(key, {'fit_ratio_SR': fit_ratio_SR})
+    return np.poly1d(fit_ratio_SR)
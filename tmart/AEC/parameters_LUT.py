@@ -0,0 +1,196 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+# Look-up tables of AE correction parameters, so that routine scenes skip the T-Mart runs of get_parameters
+
+import functools
+
+# Axes of a LUT, interpolated at run time
+# sza, saa and vza, vaa are sun_dir and target_pt_direction of get_parameters, in T-Mart directions
+LUT_AXES = ['sza', 'saa', 'vza', 'vaa', 'aot550', 'SR', 'r_maritime', 'water_vapour', 'ozone']
+
+# Parameters stored in a LUT
+LUT_PARAMETERS = ['conv_window_1', 'F_correction', 'F_captured', 'R_atm', 'R_glint']
+
+# Relative tolerance of a point on an axis with one value
+LUT_CONSTANT_TOLERANCE = 1e-6
+
+
+# One shard per band, cell size, window size and surface type
+def _LUT_file(LUT_dir, name, cell_size, window_size, isWater):
+    import os
+    return os.path.join(LUT_dir, '{}_{}m_{}_{}.npz'.format(name, int(cell_size), int(window_size), int(isWater)))
+
+
+def make_parameters_LUT(LUT_dir, name, axes, wl = 833, band = None,
+                        cell_size = 100, window_size = 201, isWater = 0,
+                        n_photon = 10_000, njobs = 100):
+    '''Precompute AEC parameters of get_parameters on a grid and save them as a shard of the LUT.
+    An unfinished shard with the same axes is resumed.
+
+    Arguments:
+
+    * ``LUT_dir`` -- String. Directory of the LUT, one .npz file per band, cell size, window size and surface type.
+    * ``name`` -- String. Name of the band, e.g. 'S2A_B2', or of the wavelength.
+    * ``axes`` -- Dictionary. Grid values of 'sza', 'saa', 'vza', 'vaa' (sun_dir and target_pt_direction in T-Mart directions), 'aot550', 'SR' (surface reflectance), 'r_maritime', 'water_vapour' (kg/m2) and 'ozone' (DU). An axis with one value is taken as constant, the LUT is only used for points with that value.
+    * ``wl``, ``band``, ``cell_size``, ``window_size``, ``isWater``, ``n_photon``, ``njobs`` -- As in get_parameters.
+
+    Output:
+
+    * Path to the file of the shard.
+
+    Example usage::
+
+      axes = {'sza': [20, 40, 60], 'saa': [0, 90, 180, 270, 360], 'vza': [170, 180], 'vaa': [0, 90, 180, 270, 360],
+              'aot550': [0, 0.1, 0.2, 0.4], 'SR': [0.02, 0.1, 0.3],
+              'r_maritime': [0, 0.5, 1], 'water_vapour': [5, 20, 50], 'ozone': [250, 300, 350]}
+      tmart.AEC.make_parameters_LUT('LUT', 'S2A_B2', axes, wl=492, band=Wavelength.S2A_MSI_02, cell_size=180)
+
+    '''
+
+    import tmart
+    import numpy as np
+    import os, sys, itertools
+
+    missing = [axis for axis in LUT_AXES if axis not in axes]
+    if len(missing) > 0: sys.exit('Warning: LUT axes missing: ' + str(missing))
+    grid = [np.sort(np.asarray(axes[axis], dtype=float)) for axis in LUT_AXES]
+    shape = tuple(len(values) for values in grid)
+
+    os.makedirs(LUT_dir, exist_ok=True)
+    file = _LUT_file(LUT_dir, name, cell_size, window_size, isWater)
+
+    # Resume
+    LUT = None
+    if os.path.exists(file):
+        with np.load(file) as saved:
+            if all(np.array_equal(saved[axis], values) for axis, values in zip(LUT_AXES, grid)):
+                LUT = {k: saved[k].copy() for k in LUT_PARAMETERS + ['done']}
+                print('\nResuming LUT {}: {}/{} done'.format(file, LUT['done'].sum(), LUT['done'].size))
+    if LUT is None:
+        LUT = {k: np.full(shape, np.nan) for k in LUT_PARAMETERS if k != 'conv_window_1'}
+        LUT['conv_window_1'] = np.full(shape + (window_size, window_size), np.nan)
+        LUT['done'] = np.zeros(shape, dtype=bool)
+
+    for index in itertools.product(*[range(n) for n in shape]):
+        if LUT['done'][index]: continue
+        point = {axis: values[i] for axis, values, i in zip(LUT_AXES, grid, index)}
+        print('\nLUT {}: {}'.format(name, point))
+
+        AEC_parameters = tmart.AEC.get_parameters(n_photon = n_photon, SR = point['SR'], wl = wl, band = band,
+                                                  target_pt_direction = [point['vza'], point['vaa']],
+                                                  sun_dir = [point['sza'], point['saa']],
+                                                  atm_profile = {'water_vapour': point['water_vapour'], 'ozone': point['ozone']},
+                                                  aerosol_type = point['r_maritime'], aot550 = point['aot550'],
+                                                  cell_size = cell_size, window_size = window_size,
+                                                  isWater = isWater, njobs = njobs)
+        for k in LUT_PARAMETERS:
+            LUT[k][index] = AEC_parameters[k]
+        LUT['done'][index] = True
+
+        # Saved after every point, the T-Mart runs take much longer
+        np.savez(file + '.tmp.npz', **dict(zip(LUT_AXES, grid)), **LUT)
+        os.replace(file + '.tmp.npz', file)
+
+    _read_LUT.cache_clear()
+    return file
+
+
+# Loaded shards are kept for the following bands and scenes 
+@functools.lru_cache(maxsize=16)
+def _read_LUT(file):
+    import numpy as np
+    from scipy.interpolate import RegularGridInterpolator
+
+    with np.load(file) as saved:
+        if not saved['done'].all():
+            return None
+        grid = [saved[axis] for axis in LUT_AXES]
+
+        # Axes with one value are constant
+        varying = [i for i, values in enumerate(grid) if len(values) > 1]
+        interpolators = {}
+        for k in LUT_PARAMETERS:
+            values = saved[k].reshape(tuple(len(grid[i]) for i in varying) + saved[k].shape[len(LUT_AXES):])
+            if len(varying) == 0:
+                interpolators[k] = lambda xi, values=values: values
+            else:
+                interpolators[k] = lambda xi, f=RegularGridInterpolator([grid[i] for i in varying], values): f(xi)[0]
+    return grid, varying, interpolators
+
+
+def read_parameters_LUT(LUT_dir, name, point, cell_size = 100, window_size = 201, isWater = 0):
+    '''AEC parameters interpolated from a LUT of make_parameters_LUT, the same dictionary as get_parameters.
+    Returns None if the LUT is missing or unfinished, or the point is outside its axes or differs from the value of an axis 
+    with one value, in which case get_parameters should run.
+
+    Arguments:
+
+    * ``LUT_dir``, ``name``, ``cell_size``, ``window_size``, ``isWater`` -- As in make_parameters_LUT.
+    * ``point`` -- Dictionary of a value for each of the LUT axes.
+
+    '''
+
+    import os
+    import numpy as np
+
+    file = _LUT_file(LUT_dir, name, cell_size, window_size, isWater)
+    if not os.path.exists(file):
+        print('\nNo LUT of AEC parameters: ' + file)
+        return None
+
+    LUT = _read_LUT(file)
+    if LUT is None:
+        print('\nLUT of AEC parameters unfinished: ' + file)
+        return None
+    grid, varying, interpolators = LUT
+
+    # No extrapolation, axes with one value have to match it
+    for i, values in enumerate(grid):
+        value = point[LUT_AXES[i]]
+        if i in varying:
+            if not values[0] <= value <= values[-1]:
+                print('\n{} = {} outside the LUT of AEC parameters: [{}, {}]'.format(LUT_AXES[i], value, values[0], values[-1]))
+                return None
+        elif not np.isclose(value, values[0], rtol=LUT_CONSTANT_TOLERANCE, atol=LUT_CONSTANT_TOLERANCE):
+            print('\n{} = {} differs from the LUT of AEC parameters: {}'.format(LUT_AXES[i], value, values[0]))
+            return None
+
+    print('\nAEC parameters from LUT: ' + file)
+    xi = np.array([point[LUT_AXES[i]] for i in varying], dtype=float)
+    AEC_parameters = {k: interpolators[k](xi) for k in LUT_PARAMETERS}
+    for k in LUT_PARAMETERS[1:]:
+        AEC_parameters[k] = float(AEC_parameters[k])
+
+    return AEC_parameters
+
+
+def lookup_parameters(LUT_dir, name, **kwargs):
+    '''get_parameters with the same keyword arguments, interpolated from the LUT in LUT_dir if possible. 
+    get_parameters runs if LUT_dir is None, there is no LUT for the arguments, or they are outside its axes.
+    '''
+
+    import tmart
+
+    atm_profile = kwargs.get('atm_profile')
+    aerosol_type = kwargs.get('aerosol_type', 'Maritime')
+
+    # A LUT is for user water vapour and ozone, and a ratio of maritime aerosols 
+    if LUT_dir is not None and atm_profile is not None and not isinstance(aerosol_type, str):
+        point = {'sza': kwargs['sun_dir'][0], 'saa': kwargs['sun_dir'][1],
+                 'vza': kwargs['target_pt_direction'][0], 'vaa': kwargs['target_pt_direction'][1],
+                 'aot550': kwargs['aot550'], 'SR': kwargs.get('SR', 0.5), 'r_maritime': aerosol_type,
+                 'water_vapour': atm_profile['water_vapour'], 'ozone': atm_profile['ozone']}
+        AEC_parameters = read_parameters_LUT(LUT_dir, name, point, cell_size = kwargs['cell_size'],
+                                             window_size = kwargs['window_size'], isWater = kwargs.get('isWater', 0))
+        if AEC_parameters is not None:
+            return AEC_parameters
+
+    return tmart.AEC.get_parameters(**kwargs)
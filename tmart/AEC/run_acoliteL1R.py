@@ -116,15 +116,19 @@ def run_acoliteL1R(file, username, password, AOT, AOT_offset, n_photon, AEC_reco
     list_F_correction   = []
     list_F_captured     = []
     list_R_atm          = []
+    
+    # From the LUT of each wavelength if there is one 
+    LUT_dir = config.get('LUT_dir', 'None')
+    LUT_dir = None if LUT_dir == 'None' else LUT_dir
         
     for tm_wl_interp in tm_wls_interp: 
         wl = tm_wl_interp
-        AEC_parameters = tmart.AEC.get_parameters(n_photon = n_photon, wl = wl, 
-                                                  target_pt_direction=[180,0], sun_dir=sun_dir, 
-                                                  atm_profile = anci, 
-                                                  aerosol_type = anci['r_maritime'], aot550 = AOT, 
-                                                  cell_size = 30*reshape_factor,
-                                                  window_size = window_size, njobs=njobs)
+        AEC_parameters = tmart.AEC.lookup_parameters(LUT_dir, 'wl' + str(wl), n_photon = n_photon, wl = wl, 
+                                                     target_pt_direction=[180,0], sun_dir=sun_dir, 
+                                                     atm_profile = anci, 
+                                                     aerosol_type = anci['r_maritime'], aot550 = AOT, 
+                                                     cell_size = 30*reshape_factor,
+                                                     window_size = window_size, njobs=njobs)
         
         conv_window_1   = AEC_parameters['conv_window_1']
         F_correction    = AEC_parameters['F_correction']
@@ -212,7 +216,7 @@ def run_acoliteL1R(file, username, password, AOT, AOT_offset, n_photon, AEC_reco
         start_time = time.time()
         print("\nConvolution started ")
         filter_kernel = np.flip(conv_window_1) # it's flipped in convolve by default
-        R_conv = signal.convolve2d(image_R_surf, filter_kernel, mode='same', boundary='fill', fillvalue=image_R_surf.mean())
+        R_conv = tmart.AEC.convolve_fft(image_R_surf, filter_kernel, fillvalue=image_R_surf.mean())
         print("Convolution completed: %s seconds " % (time.time() - start_time))
         
         
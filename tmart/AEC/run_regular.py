@@ -53,7 +53,7 @@ def run_regular(file, username, password, AOT, AOT_offset, n_photon, AEC_record,
     # AOT
     if AOT == 'NIR':
         print('\nEstimating AOT from the NIR band: ')
-        AOT = tmart.AEC.get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon)
+        AOT = tmart.AEC.get_AOT(metadata, config, anci, mask_cloud, mask_all, n_photon, njobs)
     elif AOT == 'MERRA2':
         AOT = anci['AOT_MERRA2']
         print('\nUsing AOT550 from MERRA2: ' + str(AOT))
@@ -71,15 +71,13 @@ def run_regular(file, username, password, AOT, AOT_offset, n_photon, AEC_record,
     file_AEC_record = open(AEC_record,"w")
     file_AEC_record.flush()
     
-    # AEC for each of the specified bands 
-    for i in range(len(metadata['AEC_bands_name'])):
-        AEC_band_name = metadata['AEC_bands_name'][i] 
-        AEC_band_6S = metadata['AEC_bands_6S'][i]
-        wl = metadata['AEC_bands_wl'][i]
-        print('\n============= AEC: {} ==================='.format(AEC_band_name))
-        tmart.AEC.AEC(AEC_band_name, AEC_band_6S, wl, AOT, metadata, config, anci, mask_cloud, mask_all, n_photon, njobs)
+    # AEC for each of the specified bands, recorded when written 
+    def record_band(AEC_band_name):
         file_AEC_record.write(str(AEC_band_name) + '\n')
         file_AEC_record.flush()
+    
+    bands = list(zip(metadata['AEC_bands_name'], metadata['AEC_bands_6S'], metadata['AEC_bands_wl']))
+    tmart.AEC.AEC_bands(bands, AOT, metadata, config, anci, mask_cloud, mask_all, n_photon, njobs, on_done=record_band)
         
     # close AEC record 
     file_AEC_record.close()
@@ -0,0 +1,99 @@
+# This file is part of TMart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# TMart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+# Processing large rasters in strips of rows, so that only a few rows are in memory at a time
+
+import numpy as np
+
+
+def fillnan_rows(read_rows, row0, row1, height, halo = 64, max_distance = np.inf):
+    '''Rows row0 to row1 of an image with nan filled by the closest values, same as fillnan on the whole image.
+
+    Parameters
+    ----------
+    read_rows : function
+        read_rows(top, bottom) returns rows top to bottom of the image.
+    row0, row1 : int
+        First and last (exclusive) row to return.
+    height : int
+        Number of rows in the image.
+    halo : int, optional
+        Number of rows read above and below as a start, doubled until the closest values are found. The default is 64.
+    max_distance : float, optional
+        Only nan pixels closer than this to a value need to be exact, others are filled with any nearby value. The default is np.inf.
+
+    Returns
+    -------
+    Array of rows row0 to row1 without nan.
+
+    '''
+
+    from scipy.ndimage import distance_transform_edt
+
+    while True:
+        top = max(row0 - halo, 0)
+        bottom = min(row1 + halo, height)
+        data = read_rows(top, bottom)
+        is_nan = np.isnan(data)
+        if not is_nan.any():
+            return data[row0-top:row1-top]
+
+        distance, ind = distance_transform_edt(is_nan, return_indices=True)
+        distance = distance[row0-top:row1-top]
+        data = data[tuple(ind)][row0-top:row1-top]
+        if top == 0 and bottom == height:
+            return data
+
+        # Rows not read are at least this far away
+        rows = np.arange(row0, row1)[:, None]
+        margin = np.full(rows.shape, np.inf)
+        if top > 0: margin = np.minimum(margin, rows - top + 1)
+        if bottom < height: margin = np.minimum(margin, bottom - rows)
+
+        # A value not read could be closer
+        if np.all((distance < margin) | (distance >= max_distance)) and not np.all(is_nan):
+            return data
+        halo = halo * 2
+
+
+def median_rows(image, tile_rows = 1024, n_bins = 2**16):
+    '''Median of an image, e.g. a memory-mapped array, read in strips of rows. Same as np.median.
+
+    A histogram of all values finds the bins of the middle values, only values in these bins are sorted.
+
+    '''
+
+    height = image.shape[0]
+    strips = [slice(row0, row0 + tile_rows) for row0 in range(0, height, tile_rows)]
+
+    v_min = min(np.min(image[s]) for s in strips)
+    v_max = max(np.max(image[s]) for s in strips)
+    if np.isnan(v_min) or np.isnan(v_max): return np.nan
+    if v_min == v_max: return v_min
+
+    def find_bin(values):
+        return np.clip(((values - v_min) / (v_max - v_min) * n_bins).astype(int), 0, n_bins - 1)
+
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for s in strips:
+        counts += np.bincount(find_bin(image[s]).ravel(), minlength=n_bins)
+    counts = np.cumsum(counts)
+
+    # The two middle values, the same one when the size is odd
+    n = counts[-1]
+    middle = []
+    for k in [(n - 1) // 2, n // 2]:
+        i_bin = np.searchsorted(counts, k, side='right')
+        k_bin = k - (counts[i_bin - 1] if i_bin > 0 else 0)
+        values = np.concatenate([image[s][find_bin(image[s]) == i_bin] for s in strips])
+        middle.append(np.partition(values, k_bin)[k_bin])
+
+    return np.mean(middle)
+
@@ -8,7 +8,6 @@
 # (at your option) any later version.
 
 import numpy as np
-import pandas as pd
 import os.path
 
 # Aerosol SPF
@@ -47,6 +46,7 @@ def find_aerosolSPF(aerosol_type,wl):
     aerosolSPF = np.genfromtxt(file_aerosolSPF, delimiter=',')
     aerosolSPF_wl = np.array([np.interp(wl, wls, aerosolSPF[i,:]) for i in range(np.shape(aerosolSPF)[0])])
     aerosolSPF_wl = aerosolSPF_wl[0:n_angles]
+    import pandas as pd
     df = pd.DataFrame({'Angle':angles, 'Value':aerosolSPF_wl}).sort_values('Angle').reset_index()
     
     return df
@@ -11,13 +11,8 @@
 # Atmosphere object  
 
 import numpy as np
-import pandas as pd
-from scipy.interpolate import interp1d
-
-import Py6S
-from Py6S.Params.atmosprofile import AtmosProfile
-from Py6S.Params.aeroprofile import AeroProfile
 from .Aerosol import find_aerosolSPF
+from .tm_cache import cache_key, cache_get, cache_put
 import os.path
 
 
@@ -86,6 +81,8 @@ class Atmosphere():
     # Return a table of OTs at different heights  +  aerosol_SPF
     def _wavelength(self, wl, band=None): 
         
+        import pandas as pd
+        
         self.wl = wl
         
         # Find bottom, mean and top altitudes of layers 
@@ -138,9 +135,54 @@ class Atmosphere():
         
         return atm_OT, aerosol_SPF
     
+    # Pre-compute the 6S outputs of a set of bands or wavelengths, e.g. the bands of a sensor 
+    def prewarm_cache(self, bands):
+        '''Run 6S for a set of bands or wavelengths and store the outputs in the cache, later runs at these bands skip 6S.
+        
+        Arguments:
+
+        * ``bands`` -- A list of bands from Py6S.Wavelength, or wavelengths in nm. 
+        
+        Example usage::
+        
+          my_atm.prewarm_cache([Py6S.Wavelength(Py6S.PredefinedWavelengths.S2A_MSI_02),
+                                Py6S.Wavelength(Py6S.PredefinedWavelengths.S2A_MSI_03)])
+          print(tmart.cache_stats())
+        '''
+        
+        for band in bands:
+            if isinstance(band, tuple): # Py6S band, take the central wavelength 
+                self._wavelength((band[1] + band[2]) / 2 * 1000, band)
+            else:
+                self._wavelength(band)
+    
+    # 6S inputs identifying a run at this wavelength or band 
+    def _6S_wavelength_input(self, band):
+        import Py6S
+        if band is not None:
+            return str(band)
+        else:
+            return str(Py6S.Wavelength(self.wl/1000))
+    
+    # Cached molecular profile at one wavelength 
+    def _atm_profile_wl(self,band): 
+        
+        key = cache_key('atm_profile', self.atm_profile, self._6S_wavelength_input(band), 
+                        self.layers_alts_top.tolist())
+        entry = cache_get(key)
+        
+        if entry is None:
+            layers_ot_molecule, layers_ot_rayleigh = self._atm_profile_wl_6S(band)
+            entry = cache_put(key, {'ot_molecule': layers_ot_molecule, 'ot_rayleigh': layers_ot_rayleigh})
+        
+        return entry['ot_molecule'].copy(), entry['ot_rayleigh'].copy()
+    
     # Extract the molecular profile at one wavelength 
     # Return two lists: ot_molecule and ot_rayleigh 
-    def _atm_profile_wl(self,band): 
+    def _atm_profile_wl_6S(self,band): 
+        
+        import Py6S
+        from Py6S.Params.aeroprofile import AeroProfile
 
         layers_ot_molecule = []
         layers_ot_rayleigh = []
@@ -228,21 +270,37 @@ class Atmosphere():
     # Find the spectral dependence of AOT and then apply it to AOT550
     def _aerosol_wl(self, band):
         
-        # Initiate an SixS object
-        s = Py6S.SixS()
+        # 6S outputs do not depend on AOT550, which is applied after 
+        key = cache_key('aerosol', self.atm_profile, self._6S_wavelength_input(band), 
+                        self._aero_profile())
+        entry = cache_get(key)
         
-        # Band and wavelength 
-        s.wavelength = Py6S.Wavelength(self.wl/1000)   
-        if band is not None:
-            s.wavelength = band
+        if entry is None:
+            aerosol_EXT_r550, aerosol_SSA = self._aerosol_wl_6S(band)
+            entry = cache_put(key, {'EXT_r550': aerosol_EXT_r550, 'SSA': aerosol_SSA})
         
-        # Other parameters 
-        s.atmos_profile = self.atm_profile        
-        s.geometry = Py6S.Geometry.User()
-        s.geometry.solar_z, s.geometry.solar_a = 0, 0
-        s.geometry.view_z, s.geometry.view_a = 0, 0
-        s.altitudes.set_target_custom_altitude(0)
-        s.altitudes.set_sensor_satellite_level()
+        aerosol_EXT_r550 = float(entry['EXT_r550']) # ratio, relative to 550
+        
+        aerosol_EXT = self.aot550 * aerosol_EXT_r550 # total extinction 
+        aerosol_SSA = float(entry['SSA']) # single scattering albedo 
+        
+        ot_mie = aerosol_EXT * aerosol_SSA # scattering by aerosols 
+        ot_aerosol = aerosol_EXT - ot_mie  # absorption by aerosols 
+        
+        # Concentration at mean altitudes, make integrated area???
+        conc_relative = np.exp(-self.layers_alts_mean/self.aerosol_scale_height)
+        conc_normalized = conc_relative / np.sum(conc_relative)        
+
+        # Divide optical thickness into layers, weighted by concentration at mean heights 
+        layers_ot_mie = ot_mie * conc_normalized
+        layers_ot_aerosol = ot_aerosol * conc_normalized # aerosol absorption
+  
+        return layers_ot_mie, layers_ot_aerosol # scattering and absorption by aerosol, respectively
+    
+    # Aerosol profile in 6S 
+    def _aero_profile(self):
+        
+        from Py6S.Params.aeroprofile import AeroProfile
         
         aerosol_dict = {"NoAerosols": 0,
                         "Continental" : 1,
@@ -253,31 +311,41 @@ class Atmosphere():
                         "Stratospheric" : 7}
         
         if isinstance(self.aerosol_type, str):  
-            s.aero_profile = AeroProfile.PredefinedType(aerosol_dict[self.aerosol_type])
+            return AeroProfile.PredefinedType(aerosol_dict[self.aerosol_type])
         
         else: # ADD self-defined aerosol 
             r_mar = self.aerosol_type
             r_con = 1 - r_mar
-            s.aero_profile = AeroProfile.User(soot = 0.01*r_con, water = 0.05*r_mar + 0.29*r_con, 
-                                              oceanic = 0.95*r_mar, dust = 0.7*r_con)
+            return AeroProfile.User(soot = 0.01*r_con, water = 0.05*r_mar + 0.29*r_con, 
+                                    oceanic = 0.95*r_mar, dust = 0.7*r_con)
+    
+    # Spectral dependence of AOT and single scattering albedo from 6S
+    def _aerosol_wl_6S(self, band):
+        
+        import Py6S
+        
+        # Initiate an SixS object
+        s = Py6S.SixS()
+        
+        # Band and wavelength 
+        s.wavelength = Py6S.Wavelength(self.wl/1000)   
+        if band is not None:
+            s.wavelength = band
+        
+        # Other parameters 
+        s.atmos_profile = self.atm_profile        
+        s.geometry = Py6S.Geometry.User()
+        s.geometry.solar_z, s.geometry.solar_a = 0, 0
+        s.geometry.view_z, s.geometry.view_a = 0, 0
+        s.altitudes.set_target_custom_altitude(0)
+        s.altitudes.set_sensor_satellite_level()
+        
+        s.aero_profile = self._aero_profile()
         
         s.aot550 = 1
         s.run()
         
         aerosol_EXT_r550 = s.outputs.optical_depth_total.aerosol # ratio, relative to 550
-        
-        aerosol_EXT = self.aot550 * aerosol_EXT_r550 # total extinction 
         aerosol_SSA = s.outputs.single_scattering_albedo.aerosol # single scattering albedo 
         
-        ot_mie = aerosol_EXT * aerosol_SSA # scattering by aerosols 
-        ot_aerosol = aerosol_EXT - ot_mie  # absorption by aerosols 
-        
-        # Concentration at mean altitudes, make integrated area???
-        conc_relative = np.exp(-self.layers_alts_mean/self.aerosol_scale_height)
-        conc_normalized = conc_relative / np.sum(conc_relative)        
-
-        # Divide optical thickness into layers, weighted by concentration at mean heights 
-        layers_ot_mie = ot_mie * conc_normalized
-        layers_ot_aerosol = ot_aerosol * conc_normalized # aerosol absorption
-  
-        return layers_ot_mie, layers_ot_aerosol # scattering and absorption by aerosol, respectively 
+        return aerosol_EXT_r550, aerosol_SSA
@@ -12,9 +12,8 @@
 # Surface object
 
 import numpy as np
-import pandas as pd
-from scipy.interpolate import interp1d
 import os.path
+from .tm_intersect import build_DEM_grid
 
 class SpectralSurface():
     '''Create an object to capture the spectral reflectance of surfaces when looping wavelengths. This can be used as input to reflectance in the Surface object.
@@ -40,6 +39,9 @@ class SpectralSurface():
     '''
     def __init__(self,land_cover):
         
+        import pandas as pd
+        from scipy.interpolate import interp1d
+        
         file_name = os.path.join(os.path.dirname(__file__), 'ancillary', str(land_cover) + '.csv')
         
         try:
@@ -101,6 +103,14 @@ class Surface():
         # Triangulated DEM, two sets of three dimensional triangles 
         self.DEM_triangulated = None
         
+        # Heightfield grid of the triangles with per-cell z-bounds, for intersections 
+        self.DEM_grid = None
+        self.DEM_max = None
+        
+        # Elevation if the DEM and background are flat, (reflectance, isWater) if they are uniform, otherwise None 
+        self.flat_elevation = None
+        self.homogeneous = None
+        
         self.set_background() # tested March 12, 2022
         self._triangulate_DEM()
         
@@ -258,3 +268,17 @@ class Surface():
             ref_tri2 = np.array([ref_tri_p1, ref_tri_p4, ref_tri_p3])
             
             self.DEM_triangulated = [ref_tri1,ref_tri2]
+            self.DEM_grid = build_DEM_grid(self.DEM_triangulated)
+            self.DEM_max = self.DEM.max()
+            
+            # Flat DEM and background: closed-form intersections with a plane, see intersect_line_surface 
+            self.flat_elevation = float(self.bg_elevation) if np.all(self.DEM == self.bg_elevation) else None
+            
+            # Homogeneous reflectance and water, including background: no lookups at collisions 
+            ref, isWater = self.reflectance.flat[0], self.isWater.flat[0]
+            if (np.all(self.reflectance == ref) and np.all(self.isWater == isWater) and 
+                self.bg_ref[0] == ref and self.bg_ref[1] == ref and 
+                self.bg_isWater[0] == isWater and self.bg_isWater[1] == isWater):
+                self.homogeneous = (ref, isWater)
+            else:
+                self.homogeneous = None
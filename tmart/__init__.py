@@ -10,8 +10,19 @@
 from .Surface import Surface, SpectralSurface
 from .Atmosphere import Atmosphere
 from .tmart import Tmart
+from .tm_pool import TmartPool
 from .tm_calcref import calc_ref 
 from .tm_geometry import dirP_to_coord
+from .tm_cache import cache_stats, cache_clear, set_cache_dir
 
-from tmart import AEC
-from tmart import surface_rho
+# Subpackages are imported on first access, e.g. tmart.AEC.run(...), to keep 'import tmart' fast 
+_SUBPACKAGES = ['AEC', 'surface_rho']
+
+def __getattr__(name):
+    if name in _SUBPACKAGES:
+        import importlib
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module 'tmart' has no attribute '{}'".format(name))
+
+def __dir__():
+    return sorted(list(globals()) + _SUBPACKAGES)
@@ -9,43 +9,55 @@
 
 import numpy as np
 
-# Calculate the absorption optical thickness between two points 
-def find_OT(q0,q1,atm_profile):
- 
-    topP = max(q0[2],q1[2])
-    bottomP = min(q0[2],q1[2])
-    
-    # Full layers to include 
-    top_below_topP = atm_profile[:,1] <= topP/1000
-    bottom_above_bottomP = atm_profile[:,0] >= bottomP/1000 
-    full_layers = top_below_topP & bottom_above_bottomP
-    tao_abs = sum(atm_profile[full_layers,2])
-
-    # TopP 
-    bottom_below_topP = atm_profile[:,0] < topP/1000 # bottom of layer is lower than z 
-    top_above_topP = atm_profile[:,1] > topP/1000 # top of layer is above z 
-    within_topP = bottom_below_topP & top_above_topP
+# Cumulative optical thickness of an atmospheric profile, built once per wavelength 
+class OTProfile():
+    '''
+    Optical thickness between altitudes by linear interpolation of the cumulative OT 
+    over the layer boundaries, altitudes are in meters and can be numbers or arrays.
     
-    # BottomP 
-    bottom_below_bottomP = atm_profile[:,0] < bottomP/1000 
-    top_above_bottomP = atm_profile[:,1] > bottomP/1000 
-    within_bottomP = bottom_below_bottomP & top_above_bottomP
-    
-    # Same layer 
-    if np.any(within_topP) and np.any(within_bottomP) and np.all(within_topP == within_bottomP):
+    Parameters
+    ----------
+    atm_profile : pandas DataFrame or numpy array
+        atmospheric profile of a wavelength, columns: Alt_bottom, Alt_top (km), ot_abs, ot_rayleigh, ot_mie... 
         
-        remain_ratio = (topP-bottomP)/1000 / atm_profile[within_topP,6][0]
-        tao_abs = atm_profile[within_topP,2][0] * remain_ratio
+    '''
     
-    else:
-        # Top remain
-        if np.any(within_topP):
-            remain_ratio = (topP/1000 - atm_profile[within_topP,0][0]) / atm_profile[within_topP,6][0] # remain / total height
-            tao_abs = tao_abs + atm_profile[within_topP,2][0] * remain_ratio
-            
-        # Bottom remain 
-        if np.any(within_bottomP):
-            remain_ratio = (atm_profile[within_bottomP,1][0] - bottomP/1000  ) / atm_profile[within_bottomP,6][0]
-            tao_abs = tao_abs + atm_profile[within_bottomP,2][0] * remain_ratio
+    def __init__(self, atm_profile):
+        
+        # numpy atmospheric profile, layers from the bottom 
+        if hasattr(atm_profile, 'sort_values'):
+            atm_profile = atm_profile.sort_values('Alt_bottom').to_numpy()
+        self.atm_profile = atm_profile
+        
+        # Layer boundaries and OT from the bottom of the atmosphere to each boundary 
+        self.alts = np.concatenate(([atm_profile[0,0]], atm_profile[:,1])) * 1000
+        self.cum_abs = np.concatenate(([0], np.cumsum(atm_profile[:,2])))
+        self.cum_ext = np.concatenate(([0], np.cumsum(atm_profile[:,2] + atm_profile[:,3] + atm_profile[:,4])))
+        
+        # Scattering OT for photon movements 
+        self.cum_scatt = np.concatenate(([0], np.cumsum(atm_profile[:,5])))
+        self.cum_rayleigh = np.concatenate(([0], np.cumsum(atm_profile[:,3])))
+        self.cum_mie = np.concatenate(([0], np.cumsum(atm_profile[:,4])))
+        self.cum_path = np.stack([self.cum_abs, self.cum_rayleigh, self.cum_mie])
         
-    return tao_abs
+        # Lists for photons traced one at a time 
+        self.alts_list = self.alts.tolist()
+        self.cum_scatt_list = self.cum_scatt.tolist()
+        self.cum_path_list = self.cum_path.tolist()
+        
+    def abs_between(self, z0, z1):
+        '''Absorption OT between altitudes z0 and z1.'''
+        return np.abs(np.interp(z0, self.alts, self.cum_abs) - np.interp(z1, self.alts, self.cum_abs))
+    
+    def ext_to_TOA(self, z):
+        '''Extinction (absorption and scattering) OT between altitude z and TOA.'''
+        return self.cum_ext[-1] - np.interp(z, self.alts, self.cum_ext)
+
+
+# Calculate the absorption optical thickness between two points 
+def find_OT(q0,q1,atm_profile):
+    
+    if not isinstance(atm_profile, OTProfile):
+        atm_profile = OTProfile(atm_profile)
+    
+    return float(atm_profile.abs_between(q0[2], q1[2]))
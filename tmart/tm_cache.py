@@ -0,0 +1,113 @@
+# This file is part of T-Mart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# T-Mart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+# Content-addressed cache of 6S outputs, in memory and in a local directory
+# Entries are dictionaries of numpy arrays, keyed on a hash of the 6S inputs
+
+import numpy as np
+import hashlib
+import os
+import threading
+
+# Bump when the content of the cached entries changes
+CACHE_VERSION = 1
+
+# Default directory, can be changed with the TMART_CACHE_DIR environment variable
+# or set_cache_dir, an empty string or None keeps the cache in memory only
+_cache_dir = os.environ.get('TMART_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.tmart', 'cache'))
+
+_memory = {}
+
+_stats = {'hits_memory': 0, 'hits_disk': 0, 'misses': 0, 'writes': 0}
+
+
+def set_cache_dir(cache_dir):
+    '''Set the directory of the on-disk cache, None to keep the cache in memory only.
+    '''
+    global _cache_dir
+    _cache_dir = cache_dir
+
+
+def cache_stats():
+    '''Statistics of the 6S cache: hits in memory, hits on disk, misses, writes to disk,
+    number of entries in memory and the directory of the on-disk cache.
+    '''
+    stats = dict(_stats)
+    stats['entries_memory'] = len(_memory)
+    stats['cache_dir'] = _cache_dir
+    return stats
+
+
+def cache_clear(disk=False):
+    '''Clear the in-memory cache and reset the statistics, also delete the on-disk entries if disk is True.
+    '''
+    _memory.clear()
+    for k in _stats: _stats[k] = 0
+
+    if disk and _cache_dir and os.path.isdir(_cache_dir):
+        for file in os.listdir(_cache_dir):
+            if file.endswith('.npz'):
+                os.remove(os.path.join(_cache_dir, file))
+
+
+def cache_key(*parts):
+    '''Hash the inputs into a key, parts are converted to text.
+    '''
+    text = '|'.join([str(CACHE_VERSION)] + [str(part) for part in parts])
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def cache_get(key):
+    '''Return the entry of key, or None if missing.
+    '''
+
+    if key in _memory:
+        _stats['hits_memory'] += 1
+        return _memory[key]
+
+    if _cache_dir:
+        file = os.path.join(_cache_dir, key + '.npz')
+        if os.path.isfile(file):
+            try:
+                with np.load(file) as data:
+                    entry = {k: data[k] for k in data.files}
+            except Exception as e:
+                print('WARNING: cannot read 6S cache file {}: {}'.format(file, e))
+            else:
+                _memory[key] = entry
+                _stats['hits_disk'] += 1
+                return entry
+
+    _stats['misses'] += 1
+    return None
+
+
+def cache_put(key, entry):
+    '''Store entry, a dictionary of numpy arrays, in memory and on disk.
+    '''
+
+    entry = {k: np.asarray(v) for k, v in entry.items()}
+    _memory[key] = entry
+
+    if _cache_dir:
+        file = os.path.join(_cache_dir, key + '.npz')
+
+        # write to a temporary file then rename, other processes and threads never see partial files
+        file_tmp = file[:-4] + '.{}.{}.tmp.npz'.format(os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(_cache_dir, exist_ok=True)
+            np.savez(file_tmp, **entry)
+            os.replace(file_tmp, file)
+            _stats['writes'] += 1
+        except OSError as e:
+            print('WARNING: cannot write 6S cache file {}: {}'.format(file, e))
+
+    return entry
+
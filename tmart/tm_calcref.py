@@ -8,9 +8,9 @@
 # (at your option) any later version.
 
 import numpy as np 
-import pandas as pd
 import sys
 from copy import copy
+from .tm_tally import tally_sum
 
 # Analyze the output of TMart and differentiate direct, env and atm intrinsic reflectances  
 def calc_ref(df, n_photon = None, detail = False):
@@ -18,7 +18,7 @@ def calc_ref(df, n_photon = None, detail = False):
     
     Arguments:
 
-    * ``df`` -- Results from T-Mart runs
+    * ``df`` -- Results from T-Mart runs: typed records, a numpy array with the 13 columns of earlier versions, or the tally of ``run(..., streaming=True)``
     * ``n_photon`` -- Specify the number of photons in the run when firing the photon upwards. If not specified, the number of unique pt_id will be used. This can lead to errors when photons were fired upwards because some photons will not have pt_id.
     * ``detail`` -- Boolean. Differentiate Cox-Munk, whitecap, water-leaving and land contributions
 
@@ -39,25 +39,21 @@ def calc_ref(df, n_photon = None, detail = False):
     
     # Columes: 0 pt_id, 1 movement, 2 L_cox-munk, 3 L_whitecap, 4 L_water, 5 L_land, 
     # 6 L_rayleigh, 7 L_mie, 8 9 10 surface xyz, 11 shadowed, 12 if_env
+    # Reduced to sums, unless results are already sums from the streaming mode 
+    if not isinstance(df, dict):
+        df = tally_sum(df)
     
     if n_photon == None:
-        n_photon = np.unique(df[:,0]).shape[0]
+        n_photon = df['n_photon']
     
-    R_atm = np.sum(df[:,6:8]) / n_photon
-    R_dir = np.sum(df[df[:,12] == 0 ,2:6]) / n_photon # if_env == 1 and all surface reflectance 
-    R_env = np.sum(df[df[:,12] == 1 ,2:6]) / n_photon # if_env == 0 and all surface reflectance 
+    R_atm = np.sum(df['L_atm']) / n_photon
+    R_dir = np.sum(df['L_dir']) / n_photon # if_env == 0 and all surface reflectance 
+    R_env = np.sum(df['L_env']) / n_photon # if_env == 1 and all surface reflectance 
     R_total = R_atm + R_dir + R_env
     
     if detail:
-        R_dir_coxmunk   = np.sum(df[df[:,12] == 0 ,2]) / n_photon
-        R_dir_whitecap  = np.sum(df[df[:,12] == 0 ,3]) / n_photon
-        R_dir_water     = np.sum(df[df[:,12] == 0 ,4]) / n_photon
-        R_dir_land      = np.sum(df[df[:,12] == 0 ,5]) / n_photon
-        
-        R_env_coxmunk   = np.sum(df[df[:,12] == 1 ,2]) / n_photon
-        R_env_whitecap  = np.sum(df[df[:,12] == 1 ,3]) / n_photon
-        R_env_water     = np.sum(df[df[:,12] == 1 ,4]) / n_photon
-        R_env_land      = np.sum(df[df[:,12] == 1 ,5]) / n_photon        
+        R_dir_coxmunk, R_dir_whitecap, R_dir_water, R_dir_land = df['L_dir'] / n_photon
+        R_env_coxmunk, R_env_whitecap, R_env_water, R_env_land = df['L_env'] / n_photon
         
         R_output = {'R_atm':R_atm,
                     'R_dir':R_dir,
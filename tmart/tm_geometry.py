@@ -135,3 +135,63 @@ def dirC_to_coord (direction,q0,linear_length):
               q0[2]+(direction[2]) * scale]
     
     return scaled
+
+
+# Vectorized versions for the batch engine, each row is a photon 
+
+def dirP_to_coord_batch(distance, zenith, azimuth):
+    '''
+    convert arrays of polar directions in degrees to XYZ coordinates, returns an n*3 array 
+    
+    '''
+    zenith = np.radians(zenith)
+    azimuth = np.radians(azimuth)
+    
+    coords = np.empty((np.size(zenith),3))
+    coords[:,0] = distance * np.sin(zenith) * np.cos(azimuth)
+    coords[:,1] = distance * np.sin(zenith) * np.sin(azimuth)
+    coords[:,2] = distance * np.cos(zenith)
+    return coords
+
+def rotate_batch(axis, theta, v):
+    '''
+    Rotate each row of v counterclockwise about the matching row of axis by theta radians, 
+    same as np.dot(rotation_matrix(axis, theta), v) row by row (Rodrigues' rotation formula) 
+    
+    '''
+    axis = np.asarray(axis, dtype=float)
+    axis = axis / np.linalg.norm(axis, axis=1)[:,None]
+    cos_t = np.cos(theta)[:,None]
+    sin_t = np.sin(theta)[:,None]
+    
+    k_dot_v = np.sum(axis * v, axis=1)[:,None]
+    return v * cos_t + np.cross(axis, v) * sin_t + axis * k_dot_v * (1 - cos_t)
+
+def scatter_direction_batch(direction_C, cos_scat, azimuth_scat):
+    '''
+    Turn unit moving directions by scattering angles (given as cosines) and azimuths in radians, 
+    returns unit vectors 
+    
+    '''
+    ux, uy, uz = direction_C[:,0], direction_C[:,1], direction_C[:,2]
+    
+    sin_scat = np.sqrt(np.maximum(0, 1 - cos_scat**2))
+    cos_phi = np.cos(azimuth_scat)
+    sin_phi = np.sin(azimuth_scat)
+    
+    new = np.empty_like(direction_C)
+    
+    # Close to vertical, the general formula divides by ~0 
+    vertical = np.abs(uz) > 0.99999
+    general = ~vertical
+    
+    s = np.sqrt(1 - uz[general]**2)
+    new[general,0] = sin_scat[general] * (ux[general]*uz[general]*cos_phi[general] - uy[general]*sin_phi[general]) / s + ux[general]*cos_scat[general]
+    new[general,1] = sin_scat[general] * (uy[general]*uz[general]*cos_phi[general] + ux[general]*sin_phi[general]) / s + uy[general]*cos_scat[general]
+    new[general,2] = -sin_scat[general] * cos_phi[general] * s + uz[general]*cos_scat[general]
+    
+    new[vertical,0] = sin_scat[vertical] * cos_phi[vertical]
+    new[vertical,1] = sin_scat[vertical] * sin_phi[vertical]
+    new[vertical,2] = np.sign(uz[vertical]) * cos_scat[vertical]
+    
+    return new / np.linalg.norm(new, axis=1)[:,None]
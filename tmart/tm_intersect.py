@@ -7,10 +7,10 @@
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
 
-import pandas as pd
+import math
 import numpy as np
 import sys
-from .tm_geometry import angle_3d, linear_distance
+from .tm_geometry import angle_3d, linear_distance, dirP_to_coord
 from copy import copy
 
 # intersect photon with atmosphere 
@@ -142,6 +142,8 @@ def intersect_line_DEMtri2(q0, q1, DEM_tri, print_on = False):
             crossing_xy = np.logical_or(crossing_x,crossing_y) 
             crossing = np.logical_and(crossing_z, crossing_xy)
 
+    import pandas as pd
+    
     # intersecting triangles 
     intersect_tri = pd.DataFrame() 
     
@@ -189,6 +191,361 @@ def intersect_line_DEMtri2(q0, q1, DEM_tri, print_on = False):
     intersect_tri.reset_index(drop=True, inplace=True)
     return intersect_tri
 
+# Heightfield grid of the triangulated DEM, built once in Surface._triangulate_DEM
+def build_DEM_grid(DEM_tri):
+    '''
+    Arrange the triangulated DEM into a uniform grid of cells, each cell 
+    holds the two triangles of one quad and the z-bounds of its corners. 
+
+    Parameters
+    ----------
+    DEM_tri : list
+        two np arrays, ref_tri1[point0-2, xyz:0-2, row, column].
+
+    Returns
+    -------
+    DEM_grid : dict
+        origin, cell size and shape of the grid, per-cell z_min/z_max 
+        and the triangles indexed as tri[row, column, triangle0-1, point0-2, xyz].
+
+    '''
+    
+    ref_tri1, ref_tri2 = DEM_tri
+    
+    x0 = float(ref_tri1[0,0,0,0])
+    y0 = float(ref_tri1[0,1,0,0])
+    cell_size = float(ref_tri1[2,0,0,0] - ref_tri1[0,0,0,0])
+    
+    # point 0 and 2 are shared, point 1 differs between the two triangles 
+    corners_z = np.array([ref_tri1[0,2], ref_tri1[1,2], ref_tri1[2,2], ref_tri2[1,2]]).astype(float)
+    
+    tri = np.array([ref_tri1, ref_tri2]).astype(float) # [triangle, point, xyz, row, column]
+    tri = np.ascontiguousarray(np.transpose(tri, (3,4,0,1,2)))
+    
+    DEM_grid = {'x0': x0,
+                'y0': y0,
+                'cell_size': cell_size,
+                'n_row': ref_tri1.shape[2],
+                'n_col': ref_tri1.shape[3],
+                'z_min': corners_z.min(axis=0),
+                'z_max': corners_z.max(axis=0),
+                # slab of the whole DEM, same margin as intersect_line_DEMtri2 
+                'slab_min': float(corners_z.min()) - 0.1,
+                'slab_max': float(corners_z.max()) + 0.1,
+                'tri': tri}
+    
+    return DEM_grid
+
+def intersect_line_DEMgrid(q0, q1, DEM_grid):
+    '''
+    Closest intersection between a line and the triangulated DEM, walking 
+    the cells crossed by the line with a 2D DDA. Only cells whose z-bounds 
+    overlap the line are tested, so the cost grows with the number of cells 
+    crossed and not with the size of the DEM. 
+
+    Parameters
+    ----------
+    q0 : list
+        starting point of the line.
+    q1 : list
+        ending point.
+    DEM_grid : dict
+        output of build_DEM_grid.
+
+    Returns
+    -------
+    np array or None
+        X, Y, Z of the collision, direction normal to the surface (N_X, N_Y, N_Z) 
+        and linear distance to the starting point, None if no intersection.
+
+    '''
+    
+    q0x, q0y, q0z = float(q0[0]), float(q0[1]), float(q0[2])
+    dx, dy, dz = float(q1[0]) - q0x, float(q1[1]) - q0y, float(q1[2]) - q0z
+    
+    x0, y0, CZ = DEM_grid['x0'], DEM_grid['y0'], DEM_grid['cell_size']
+    n_row, n_col = DEM_grid['n_row'], DEM_grid['n_col']
+    
+    # Clip the line to the slab of the DEM and to the extent of the grid 
+    t_min, t_max = 0.0, 1.0
+    for q, d, low, high in ((q0z, dz, DEM_grid['slab_min'], DEM_grid['slab_max']),
+                            (q0x, dx, x0, x0 + n_col*CZ),
+                            (q0y, dy, y0, y0 + n_row*CZ)):
+        if d == 0:
+            if q < low or q > high: return None
+        else:
+            ta, tb = (low - q) / d, (high - q) / d
+            if ta > tb: ta, tb = tb, ta
+            if ta > t_min: t_min = ta
+            if tb < t_max: t_max = tb
+        if t_min > t_max: return None
+    
+    # Starting cell 
+    col = min(max(int((q0x + t_min*dx - x0) // CZ), 0), n_col - 1)
+    row = min(max(int((q0y + t_min*dy - y0) // CZ), 0), n_row - 1)
+    
+    # t of the next cell boundaries in x and y, and t to cross one cell 
+    if dx > 0:
+        step_col, t_next_x, t_delta_x = 1, (x0 + (col+1)*CZ - q0x) / dx, CZ / dx
+    elif dx < 0:
+        step_col, t_next_x, t_delta_x = -1, (x0 + col*CZ - q0x) / dx, -CZ / dx
+    else:
+        step_col, t_next_x, t_delta_x = 0, np.inf, np.inf
+        
+    if dy > 0:
+        step_row, t_next_y, t_delta_y = 1, (y0 + (row+1)*CZ - q0y) / dy, CZ / dy
+    elif dy < 0:
+        step_row, t_next_y, t_delta_y = -1, (y0 + row*CZ - q0y) / dy, -CZ / dy
+    else:
+        step_row, t_next_y, t_delta_y = 0, np.inf, np.inf
+    
+    z_min, z_max, tri = DEM_grid['z_min'], DEM_grid['z_max'], DEM_grid['tri']
+    t_enter = t_min
+    
+    while True:
+        t_exit = min(t_next_x, t_next_y, t_max)
+        
+        # z range of the line within this cell 
+        za, zb = q0z + t_enter*dz, q0z + t_exit*dz
+        if za > zb: za, zb = zb, za
+        
+        if za <= z_max[row,col] and zb >= z_min[row,col]:
+            
+            hit = None
+            for p in tri[row,col].tolist():
+                t = _intersect_line_triangle_t(q0x, q0y, q0z, dx, dy, dz, p)
+                if t is not None and (hit is None or t < hit[0]):
+                    hit = (t, p)
+            
+            # the first cell with an intersection has the closest one 
+            if hit is not None:
+                t, p = hit
+                intersect = np.array([q0x + t*dx, q0y + t*dy, q0z + t*dz])
+                p0, p1, p2 = np.array(p)
+                N = np.cross(p1-p0, p2-p0)
+                
+                # normal in the same direction as the incoming line 
+                if np.dot(N, np.array([q0x, q0y, q0z]) - intersect) < 0: N = -N
+                
+                distance = t * (dx*dx + dy*dy + dz*dz)**0.5
+                return np.concatenate([intersect, N, [distance]])
+        
+        if t_exit >= t_max: return None
+        
+        # move to the next cell 
+        if t_next_x <= t_next_y:
+            col += step_col
+            t_enter = t_next_x
+            t_next_x += t_delta_x
+        else:
+            row += step_row
+            t_enter = t_next_y
+            t_next_y += t_delta_y
+            
+        if col < 0 or col >= n_col or row < 0 or row >= n_row: return None
+
+def intersect_line_plane(q0, q1, DEM_grid, z0):
+    '''
+    Intersection between a line and a flat DEM at elevation z0, in closed 
+    form. Same output as intersect_line_DEMgrid when the DEM and the 
+    background are all at z0, see Surface.flat_elevation. 
+
+    Returns
+    -------
+    np array or None
+        X, Y, Z of the collision, direction normal to the surface (N_X, N_Y, N_Z) 
+        and linear distance to the starting point, None if no intersection.
+
+    '''
+    
+    q0x, q0y, q0z = float(q0[0]), float(q0[1]), float(q0[2])
+    dx, dy, dz = float(q1[0]) - q0x, float(q1[1]) - q0y, float(q1[2]) - q0z
+    if dz == 0: return None # parallel 
+    
+    t = (z0 - q0z) / dz
+    if t < 0 or t > 1: return None
+    
+    # Within the extent of the grid 
+    x, y = q0x + t*dx, q0y + t*dy
+    x0, y0, CZ = DEM_grid['x0'], DEM_grid['y0'], DEM_grid['cell_size']
+    if x < x0 or x > x0 + DEM_grid['n_col']*CZ or y < y0 or y > y0 + DEM_grid['n_row']*CZ: return None
+    
+    # Normal as the cross product of triangle edges, towards the starting point 
+    N_z = CZ*CZ if q0z > z0 else -CZ*CZ
+    distance = t * (dx*dx + dy*dy + dz*dz)**0.5
+    return np.array([x, y, z0, 0.0, 0.0, N_z, distance])
+
+def intersect_line_plane_batch(q0, q1, DEM_grid, z0):
+    '''
+    intersect_line_plane of many lines, q0 and q1 are arrays of shape (n,3). 
+    Returns if each line intersects, the collision points and the normals. 
+    '''
+    
+    d = q1 - q0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (z0 - q0[:,2]) / d[:,2]
+    hit = (d[:,2] != 0) & (t >= 0) & (t <= 1)
+    
+    q = q0 + t[:,None] * d
+    q[:,2] = z0
+    x0, y0, CZ = DEM_grid['x0'], DEM_grid['y0'], DEM_grid['cell_size']
+    hit = (hit & (q[:,0] >= x0) & (q[:,0] <= x0 + DEM_grid['n_col']*CZ) & 
+           (q[:,1] >= y0) & (q[:,1] <= y0 + DEM_grid['n_row']*CZ))
+    
+    N = np.zeros_like(q)
+    N[:,2] = np.where(q0[:,2] > z0, CZ*CZ, -CZ*CZ)
+    return hit, q, N
+
+def intersect_line_surface(q0, q1, Surface):
+    '''
+    Closest intersection between a line and the surface, in closed form 
+    if the surface is flat, otherwise walking the DEM grid. 
+    '''
+    
+    if Surface.flat_elevation is not None:
+        return intersect_line_plane(q0, q1, Surface.DEM_grid, Surface.flat_elevation)
+    return intersect_line_DEMgrid(q0, q1, Surface.DEM_grid)
+
+class HorizonMap():
+    '''
+    Elevation of each cell of a DEM grid above which points see the sun, for shadow tests. 
+    The first intersection of a line going up with the DEM can only be on a triangle facing away 
+    from the line, so points above the highest of these triangles that the line can reach, 
+    lowered by the rise of the line, are lit. Points below are tested with intersect_line_surface. 
+    Built for a DEM grid and a sun direction, and rebuilt when either changes. 
+
+    '''
+    
+    def __init__(self, DEM_grid, sun_dir):
+        
+        self.DEM_grid = DEM_grid
+        self.sun_dir = list(sun_dir)
+        
+        x0, y0, CZ = DEM_grid['x0'], DEM_grid['y0'], DEM_grid['cell_size']
+        n_row, n_col = DEM_grid['n_row'], DEM_grid['n_col']
+        self.x0, self.y0, self.cell_size, self.n_row, self.n_col = x0, y0, CZ, n_row, n_col
+        
+        sun = dirP_to_coord(1, sun_dir)
+        horizontal = math.hypot(sun[0], sun[1])
+        
+        # Sun at or below the horizon: nothing is known to be lit 
+        if sun[2] <= 0:
+            self.horizon = np.full((n_row, n_col), np.inf)
+            self.horizon_max = np.inf
+            return
+        
+        # Cells with a triangle facing away from the sun, normals pointing up 
+        tri = DEM_grid['tri']
+        N = np.cross(tri[:,:,:,1] - tri[:,:,:,0], tri[:,:,:,2] - tri[:,:,:,0])
+        N = N * np.sign(N[...,2:3])
+        back = N @ sun <= 1e-9 * np.linalg.norm(N, axis=-1)
+        
+        # Top of the triangles facing away in each cell 
+        z_back = np.max(np.where(back, tri[...,2].max(axis=-1), -np.inf), axis=2)
+        self.horizon = np.full((n_row, n_col), -np.inf)
+        
+        if back.any():
+            
+            # Rise of the line per horizontal distance, lines are blocked within this distance 
+            rise = sun[2] / horizontal if horizontal > 0 else np.inf
+            reach = (z_back.max() - DEM_grid['z_min'].min()) / rise
+            
+            # Offsets of cells a line from any point of a cell can cross, and the shortest horizontal distance to them 
+            offsets = _horizon_offsets(sun[0] / max(horizontal, 1e-300), sun[1] / max(horizontal, 1e-300), 
+                                       CZ, reach, n_row, n_col, horizontal > 0)
+            
+            for d_row, d_col, distance in offsets:
+                drop = distance * rise if distance > 0 else 0
+                r0, r1 = max(0, -d_row), min(n_row, n_row - d_row)
+                c0, c1 = max(0, -d_col), min(n_col, n_col - d_col)
+                if r0 >= r1 or c0 >= c1: continue
+                view = self.horizon[r0:r1, c0:c1]
+                np.maximum(view, z_back[r0+d_row:r1+d_row, c0+d_col:c1+d_col] - drop, out=view)
+        
+        # Margin for rounding 
+        self.horizon = self.horizon + 1e-6
+        self.horizon_max = float(self.horizon.max())
+    
+    def lit(self, q):
+        '''True if the sun is visible from point q above the surface, False if it is not known.'''
+        
+        if q[2] > self.horizon_max: return True
+        col = int((q[0] - self.x0) // self.cell_size)
+        row = int((q[1] - self.y0) // self.cell_size)
+        if col < 0 or col >= self.n_col or row < 0 or row >= self.n_row: return False
+        return q[2] > self.horizon[row, col]
+    
+    def lit_batch(self, q):
+        '''lit of an array of points of shape (n,3).'''
+        
+        col = np.floor((q[:,0] - self.x0) / self.cell_size)
+        row = np.floor((q[:,1] - self.y0) / self.cell_size)
+        inside = (col >= 0) & (col < self.n_col) & (row >= 0) & (row < self.n_row)
+        horizon = np.full(len(q), self.horizon_max)
+        horizon[inside] = self.horizon[row[inside].astype(int), col[inside].astype(int)]
+        return (q[:,2] > horizon) | (q[:,2] > self.horizon_max)
+
+def _horizon_offsets(u_x, u_y, CZ, reach, n_row, n_col, moving):
+    '''
+    Row and column offsets of the cells that a horizontal line in direction (u_x, u_y) from any 
+    point of a cell crosses within reach, and the shortest distance along the line to each of them. 
+    '''
+    
+    # A vertical line only stays in its cell 
+    if not moving: 
+        return [(0, 0, 0.0)]
+    
+    n = int(min(math.ceil(reach / CZ) + 1, max(n_row, n_col)))
+    d_row, d_col = np.meshgrid(np.arange(-n, n+1), np.arange(-n, n+1), indexing='ij')
+    d_row, d_col = d_row.ravel(), d_col.ravel()
+    
+    # The line enters the square of the differences between points of the two cells 
+    s_enter, s_exit = np.zeros(d_row.size), np.full(d_row.size, np.inf)
+    for d, u in ((d_col, u_x), (d_row, u_y)):
+        low, high = (d - 1) * CZ, (d + 1) * CZ
+        if abs(u) < 1e-12:
+            s_exit[(low > 0) | (high < 0)] = -np.inf
+        else:
+            a, b = low / u, high / u
+            s_enter = np.maximum(s_enter, np.minimum(a, b))
+            s_exit = np.minimum(s_exit, np.maximum(a, b))
+    
+    keep = (s_enter <= s_exit) & (s_enter <= reach)
+    return list(zip(d_row[keep].tolist(), d_col[keep].tolist(), s_enter[keep].tolist()))
+
+def _intersect_line_triangle_t(q0x, q0y, q0z, dx, dy, dz, p):
+    '''
+    Moller-Trumbore intersection of the line q0 + t * d (0 <= t <= 1) and 
+    the triangle p (three points), in plain floats. 
+
+    Returns
+    -------
+    t of the intersection, or None if they don't intersect.
+
+    '''
+    
+    (ax, ay, az), (bx, by, bz), (cx, cy, cz) = p
+    e1x, e1y, e1z = bx-ax, by-ay, bz-az
+    e2x, e2y, e2z = cx-ax, cy-ay, cz-az
+    
+    hx, hy, hz = dy*e2z - dz*e2y, dz*e2x - dx*e2z, dx*e2y - dy*e2x
+    det = e1x*hx + e1y*hy + e1z*hz
+    if det == 0: return None # parallel 
+    
+    f = 1.0 / det
+    sx, sy, sz = q0x-ax, q0y-ay, q0z-az
+    u = f * (sx*hx + sy*hy + sz*hz)
+    if u < 0 or u > 1: return None
+    
+    kx, ky, kz = sy*e1z - sz*e1y, sz*e1x - sx*e1z, sx*e1y - sy*e1x
+    v = f * (dx*kx + dy*ky + dz*kz)
+    if v < 0 or u + v > 1: return None
+    
+    t = f * (e2x*kx + e2y*ky + e2z*kz)
+    if t < 0 or t > 1: return None
+    
+    return t
+
 def _intersect_line_triangle(q1,q2,p1,p2,p3):
     '''
 
@@ -343,6 +700,8 @@ def intersect_line_boundary(q0,q1,atm_profile,print_on=False):
 
     '''
     
+    import pandas as pd
+    
     z0, z1 = q0[2]/1000,q1[2]/1000
     
     if z0==z1:
@@ -404,3 +763,59 @@ def intersect_line_boundary(q0,q1,atm_profile,print_on=False):
             intersect_b['out'] = True
     
     return intersect_b 
+
+
+# Vectorized versions for the batch engine, each row of q is a photon 
+
+# Scattering OTs of the layers the points are in 
+def find_atm2_batch(atm_profile,q1):
+    
+    z = q1[:,2]/1000
+    
+    # index of minimum positive difference between the top of the layer and z 
+    idx = np.clip(np.searchsorted(atm_profile[:,1], z, side='left'), 0, len(atm_profile)-1)
+    
+    ot_rayleigh = atm_profile[idx,3]
+    ot_mie = atm_profile[idx,4]
+    
+    return ot_rayleigh, ot_mie
+
+def intersect_background_batch(q0,q1,bg_elevation):
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (q0[:,2]-bg_elevation) / (q0[:,2]-q1[:,2])
+    
+    q = q0 - (q0-q1) * ratio[:,None]
+    q[:,2] = bg_elevation
+    return q
+
+def reflectance_background_batch(q_collision,bg_ref, bg_coords):
+    
+    b1_a, b1_b = np.array(bg_coords[0]), np.array(bg_coords[1])
+    line = b1_a - b1_b
+    slope = line[1]/line[0]  # y = slope * x + x_intercept 
+    x_intercept = b1_a[1] - slope *b1_a[0]  
+    
+    above_line = q_collision[:,1] >= (q_collision[:,0] * slope + x_intercept) 
+    
+    # below the line is b1 when x_intercept>=0 
+    if x_intercept>=0:
+        return np.where(above_line, bg_ref[1], bg_ref[0])
+    else:
+        return np.where(above_line, bg_ref[0], bg_ref[1])
+
+def reflectance_intersect_batch(q_collision, image_reflectance, cell_size, bg_ref, bg_coords):
+    
+    image_shape = image_reflectance.shape
+    
+    triangle_y = np.floor(q_collision[:,1] / cell_size).astype(int)
+    triangle_x = np.floor(q_collision[:,0] / cell_size).astype(int)
+    
+    # if on the padding triangles 
+    padding = ((triangle_y < 0) | (triangle_x < 0) | 
+               (triangle_y >= image_shape[0]) | (triangle_x >= image_shape[1]))
+    
+    triangle_reflectance = reflectance_background_batch(q_collision, bg_ref, bg_coords).astype(float)
+    triangle_reflectance[~padding] = image_reflectance[triangle_y[~padding], triangle_x[~padding]]
+    
+    return triangle_reflectance
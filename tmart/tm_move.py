@@ -14,16 +14,128 @@
 import numpy as np
 import math
 import sys
+import bisect
 
 from .tm_geometry import dirC_to_coord, dirP_to_coord
+from .tm_OT import OTProfile
       
         
+def free_path(OT_profile,z0,mu,sampled_tao):
+    '''
+    Free paths of photons, each element is a photon. The stopping altitude is found with one 
+    searchsorted on the cumulative scattering OT along the vertical, the inputs are not modified. 
+
+    Parameters
+    ----------
+    OT_profile : OTProfile
+        Cumulative OTs of the atmosphere, from tm_OT.
+    z0 : numpy array
+        Altitudes of the starting points in m.
+    mu : numpy array
+        Cosines of the zenith angles of the moving directions.
+    sampled_tao : numpy array
+        The scattering optical thickness to move in space.
+
+    Returns
+    -------
+    traveled_distance : numpy array
+        Distance along the moving directions in m.
+    tao_abs, ot_rayleigh, ot_mie : numpy array
+        Absorption, Rayleigh and Mie OT along the paths.
+    out : numpy array
+        Boolean, if out of atmosphere after the movement.
+
+    '''
+    
+    alts = OT_profile.alts
+    cum_scatt = OT_profile.cum_scatt
+    n_alts = len(alts)
+    
+    z0 = np.asarray(z0, dtype=float)
+    mu = np.asarray(mu, dtype=float)
+    sampled_tao = np.asarray(sampled_tao, dtype=float)
+    
+    # Layers of the starting points and fractions of the layers below them 
+    i0 = np.clip(np.searchsorted(alts, z0, side='right') - 1, 0, n_alts-2)
+    f0 = np.clip((z0 - alts[i0]) / (alts[i0+1] - alts[i0]), 0, 1)
+    
+    # Cumulative scattering OT at the starting and stopping points 
+    s0 = cum_scatt[i0] + f0 * (cum_scatt[i0+1] - cum_scatt[i0])
+    target = s0 + sampled_tao * mu 
+    
+    out = (mu > 0) & (target > cum_scatt[-1]) # penetrate through TOA 
+    ground = (mu < 0) & (target < 0) # penetrate to 10m underground 
+    
+    # Layers of the stopping points 
+    i1 = np.clip(np.searchsorted(cum_scatt, target, side='left') - 1, 0, n_alts-2)
+    ds = cum_scatt[i1+1] - cum_scatt[i1]
+    f1 = np.clip(np.divide(target - cum_scatt[i1], ds, out=np.zeros(len(ds)), where=ds>0), 0, 1)
+    z1 = alts[i1] + f1 * (alts[i1+1] - alts[i1])
+    z1[ground] = -10
+    
+    # OTs along the paths within the atmosphere, rows: absorption, Rayleigh, Mie 
+    cum_path = OT_profile.cum_path
+    ot_0 = cum_path[:,i0] + f0 * (cum_path[:,i0+1] - cum_path[:,i0])
+    ot_1 = cum_path[:,i1] + f1 * (cum_path[:,i1+1] - cum_path[:,i1])
+    
+    moving = mu != 0
+    abs_mu = np.where(moving, np.abs(mu), 1)
+    traveled_distance = np.abs(z0 - z1) / abs_mu
+    tao_abs, ot_rayleigh, ot_mie = np.abs(ot_1 - ot_0) / abs_mu
+    
+    ### Travel parallel to the layers, this should be rare 
+    if not np.all(moving):
+        flat = ~moving
+        atm_profile = OT_profile.atm_profile
+        n_within = i0[flat]
+        ot_scatt = atm_profile[n_within,5]
+        
+        traveled_distance[flat] = sampled_tao[flat] / (ot_scatt / atm_profile[n_within,6]) * 1000 # ot_scatt / layer_height in km
+        tao_abs[flat] = sampled_tao[flat] * atm_profile[n_within,2] / ot_scatt
+        ot_rayleigh[flat] = sampled_tao[flat] * atm_profile[n_within,3] / ot_scatt
+        ot_mie[flat] = sampled_tao[flat] * atm_profile[n_within,4] / ot_scatt
+    
+    return traveled_distance, tao_abs, ot_rayleigh, ot_mie, out
+
+
+# free_path for one photon in plain Python, numpy calls cost more than the arithmetic for a single photon 
+def _free_path_single(OT_profile,z0,mu,sampled_tao):
+    
+    # Travel parallel to the layers 
+    if mu == 0:
+        return free_path(OT_profile, [z0], [mu], [sampled_tao])
+    
+    alts = OT_profile.alts_list
+    cum_scatt = OT_profile.cum_scatt_list
+    n_alts = len(alts)
+    
+    i0 = min(max(bisect.bisect_right(alts, z0) - 1, 0), n_alts-2)
+    f0 = min(max((z0 - alts[i0]) / (alts[i0+1] - alts[i0]), 0), 1)
+    
+    s0 = cum_scatt[i0] + f0 * (cum_scatt[i0+1] - cum_scatt[i0])
+    target = s0 + sampled_tao * mu 
+    
+    out = mu > 0 and target > cum_scatt[-1]
+    ground = mu < 0 and target < 0
+    
+    i1 = min(max(bisect.bisect_left(cum_scatt, target) - 1, 0), n_alts-2)
+    ds = cum_scatt[i1+1] - cum_scatt[i1]
+    f1 = min(max((target - cum_scatt[i1]) / ds, 0), 1) if ds > 0 else 0
+    z1 = -10 if ground else alts[i1] + f1 * (alts[i1+1] - alts[i1])
+    
+    abs_mu = abs(mu)
+    ots = [abs((c[i1] + f1 * (c[i1+1] - c[i1])) - (c[i0] + f0 * (c[i0+1] - c[i0]))) / abs_mu 
+           for c in OT_profile.cum_path_list]
+    
+    return [abs(z0 - z1) / abs_mu], [ots[0]], [ots[1]], [ots[2]], [out]
+
+
 def pt_move(atm_profile,q0,pt_direction,sampled_tao):        
     '''
     
     Parameters
     ----------
-    atm_profile : TYPE
+    atm_profile : OTProfile or numpy array
         Scattering and absorptions coefficients in the atmosphere.
     q0 : TYPE
         Starting point.
@@ -40,13 +152,6 @@ def pt_move(atm_profile,q0,pt_direction,sampled_tao):
         If out of atmosphere after the movement.
 
     '''
-        
-    # If the photon is out of the atmosphere after the movement 
-    out = False
-    n_layers = len(atm_profile)
-    
-    # Percentage traveled in each layer 
-    atm_profile[:,7] = 0
     
     if pt_direction[0]<0 or pt_direction[0] > 180:
         print('pt_direction: ' + str(pt_direction))
@@ -54,188 +159,53 @@ def pt_move(atm_profile,q0,pt_direction,sampled_tao):
     
     ### In case zenith = 90, this should be impossible but we'll process it 
     elif pt_direction[0]==90:
-        
         print ('Photon travel exactly parallel to the atm layers, check absorption...')
-
-        # Identify layers 
-        bottom_below = atm_profile[:,0] < q0[2]/1000 # bottom of layer is lower than z 
-        top_above = atm_profile[:,1] > q0[2]/1000 # top of layer is above z 
-        within = bottom_below & top_above       
-        
-        # layer the photon is in 
-        n_within = np.where(within)[0][0] 
-        c = atm_profile[n_within,5] / atm_profile[n_within,6]  # ot_scatt / layer_height in km
-        
-        traveled_distance = sampled_tao / c    * 1000  # convert to m 
-        
-        q1 = dirC_to_coord (dirP_to_coord(1, pt_direction),q0,traveled_distance)
-        
-        tao_abs =       sampled_tao * ( atm_profile[n_within,2] / atm_profile[n_within,5] ) # ot_abs / layer_height 
-        ot_rayleigh =   sampled_tao * ( atm_profile[n_within,3] / atm_profile[n_within,5] ) 
-        ot_mie =        sampled_tao * ( atm_profile[n_within,4] / atm_profile[n_within,5] ) 
-        
-        return q1, tao_abs, ot_rayleigh, ot_mie, out 
-        
+        mu = 0
+    else:
+        mu = math.cos(pt_direction[0]/180*math.pi)
     
-    ### Move down if > 90
-    elif pt_direction[0]>90:
+    if not isinstance(atm_profile, OTProfile):
+        atm_profile = OTProfile(atm_profile)
     
-        travel_angle = 180 - pt_direction[0] # relative to parallel plane
-        
-        # Identify layers 
-        top_below = atm_profile[:,1] <= q0[2]/1000  # top of layer is equal or lower than z
-        bottom_below = atm_profile[:,0] < q0[2]/1000 # bottom of layer is lower than z 
-        top_above = atm_profile[:,1] > q0[2]/1000 # top of layer is above z 
-        within = bottom_below & top_above  
-    
-        # If movement within a layer
-        if np.any(within):
-            
-            # Layer the photon is in 
-            n_within = np.where(within)[0][0] 
-            
-            # The bottom of the layer within 
-            within_bottom = atm_profile[within,0][0] 
- 
-            # leftover_height / layer height
-            leftover_height_ratio = (q0[2]/1000 - within_bottom) /  atm_profile[within,6][0] 
-       
-            atm_profile[within,7] = leftover_height_ratio / math.cos(travel_angle/180*math.pi)
-        
-        atm_profile[top_below,7] = 1 / math.cos(travel_angle/180*math.pi)      
-        
-        # Sum of ot_scatt * percentage 
-        tao_sum = sum(atm_profile[:,5]*atm_profile[:,7]) 
+    traveled_distance, tao_abs, ot_rayleigh, ot_mie, out = _free_path_single(atm_profile, q0[2], mu, sampled_tao)
+    
+    q1 = dirC_to_coord (dirP_to_coord(1, pt_direction),q0,traveled_distance[0])
+    q1 = np.array(q1)
+    
+    return q1, tao_abs[0], ot_rayleigh[0], ot_mie[0], bool(out[0])
 
-        # If traveled tao is larger than what's there, AKA crossing layers 
-        if sampled_tao > tao_sum:
-            z = -10 # penetrate to 10m underground 
-            tao_abs =       sum(atm_profile[:,2]*atm_profile[:,7])
-            ot_rayleigh =   sum(atm_profile[:,3]*atm_profile[:,7])
-            ot_mie =        sum(atm_profile[:,4]*atm_profile[:,7])
-            
-        # If movement happened within the layer 
-        else: 
-            
-            ## Remove layers one by one until we reach the sampled_tao
-            for i in range(0,n_layers): # remove layer i
-            
-                # From i+1 to last layer  
-                atm_profile_temp = atm_profile[ range(i+1,n_layers)  ,:]   
-                
-                # Recalculate tao_sum
-                tao_sum = sum(atm_profile_temp[:,5]*atm_profile_temp[:,7])
-                
-                # Once we find the layer 
-                if sampled_tao > tao_sum:
-                    
-                    tao_lastLayer = sampled_tao - tao_sum  
-                    
-                    # If movement within a layer
-                    if np.any(within):
-                        if i  == n_within: 
-                            tao_lastLayer_ratio = tao_lastLayer / (atm_profile[i,5] / math.cos(travel_angle/180*math.pi) ) 
-                            
-                            z = q0[2] - atm_profile[i,6] * tao_lastLayer_ratio * 1000
-                            tao_abs =       atm_profile[i,2] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                            ot_rayleigh =   atm_profile[i,3] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                            ot_mie =        atm_profile[i,4] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                            
-                            break
-                    
-                    tao_lastLayer_ratio = tao_lastLayer / (atm_profile[i,5] * atm_profile[i,7]) 
-                    z = atm_profile[i,1] - atm_profile[i,6] * tao_lastLayer_ratio # top of the layer - proportion in the last layer 
-                    z = z * 1000
-                    
-                    tao_abs =       sum(atm_profile_temp[:,2]*atm_profile_temp[:,7]) + atm_profile[i,2] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                    ot_rayleigh =   sum(atm_profile_temp[:,3]*atm_profile_temp[:,7]) + atm_profile[i,3] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                    ot_mie =        sum(atm_profile_temp[:,4]*atm_profile_temp[:,7]) + atm_profile[i,4] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                    
-                    break # stop removing layers 
-    
-    ### Move up if < 90
-    elif pt_direction[0]<90: 
-    
-        travel_angle = pt_direction[0] # relative to parallel plane
-        
-        # Identify layers 
-        bottom_above = atm_profile[:,0] >= q0[2]/1000 # bottom of layer is equal or above z     
-        bottom_below = atm_profile[:,0] < q0[2]/1000 # bottom of layer is lower than z 
-        top_above = atm_profile[:,1] > q0[2]/1000 # top of layer is above z 
-        within = bottom_below & top_above  
 
-        # If movement within a layer
-        if np.any(within):
+def pt_move_batch(OT_profile,q0,pt_direction_C,sampled_tao):
+    '''
+    Vectorized pt_move for the batch engine, each row is a photon. 
 
-            # Layer the photon is in 
-            n_within = np.where(within)[0][0]         
-            
-            # The top of the layer within 
-            within_top = atm_profile[within,1][0] 
-            
-            # leftover_height / layer height
-            leftover_height_ratio = (within_top - q0[2]/1000 ) /  atm_profile[within,6][0] 
-            
-            atm_profile[within,7] = leftover_height_ratio / math.cos(travel_angle/180*math.pi)
-            
-        atm_profile[bottom_above,7] = 1 / math.cos(travel_angle/180*math.pi)
-      
-        # Sum of ot_scatt * percentage 
-        tao_sum = sum(atm_profile[:,5]*atm_profile[:,7]) 
-        
-        # If traveled tao is larger than what's there, AKA crossing layers 
-        if sampled_tao > tao_sum:
-            z = max(atm_profile[:,1]) * 1000  # penetrate through TOA 
-            tao_abs =       sum(atm_profile[:,2]*atm_profile[:,7])
-            ot_rayleigh =   sum(atm_profile[:,3]*atm_profile[:,7])
-            ot_mie =        sum(atm_profile[:,4]*atm_profile[:,7]) 
-            out = True
-             
-        # If movement happened within the layer    
-        else: 
-        
-            ## Remove layers one by one until we reach the sampled_tao
-            for i in range(0,n_layers): 
+    Parameters
+    ----------
+    OT_profile : OTProfile
+        Cumulative OTs of the atmosphere, from tm_OT.
+    q0 : numpy array
+        n*3 starting points.
+    pt_direction_C : numpy array
+        n*3 unit moving directions in XYZ.
+    sampled_tao : numpy array
+        The optical thickness to move in space.
 
-                # From i+1 to last layer   
-                atm_profile_temp = atm_profile[ range(0,n_layers-1-i) ,:]  
-                
-                # Recalculate tao_sum
-                tao_sum = sum(atm_profile_temp[:,5]*atm_profile_temp[:,7])
-                
-                # Once we find the layer
-                if sampled_tao > tao_sum:
+    Returns
+    -------
+    q1 : numpy array
+        End points of the movements.
+    tao_abs : numpy array
+        Absorption OT along the movements.
+    out : numpy array
+        Boolean, if out of atmosphere after the movement.
 
-                    layer_index = n_layers-i-1
-                    tao_lastLayer = sampled_tao - tao_sum 
-                    
-                    # If movement within a layer
-                    if np.any(within):
-                        if layer_index  == n_within: 
-                            tao_lastLayer_ratio = tao_lastLayer / (atm_profile[layer_index,5] / math.cos(travel_angle/180*math.pi) ) 
-                            
-                            z = q0[2] + atm_profile[layer_index,6] * tao_lastLayer_ratio * 1000
-                            tao_abs =       atm_profile[layer_index,2] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                            ot_rayleigh =   atm_profile[layer_index,3] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                            ot_mie =        atm_profile[layer_index,4] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                            
-                            break
-                        
-                    tao_lastLayer_ratio = tao_lastLayer / (atm_profile[layer_index,5] * atm_profile[layer_index,7]) 
-                    z = atm_profile[layer_index,0] + atm_profile[layer_index,6] * tao_lastLayer_ratio # bottom of the layer + proportion in the last layer 
-                    z = z * 1000
-                    
-                    tao_abs =       sum(atm_profile_temp[:,2]*atm_profile_temp[:,7]) + atm_profile[layer_index,2] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)   
-                    ot_rayleigh =   sum(atm_profile_temp[:,3]*atm_profile_temp[:,7]) + atm_profile[layer_index,3] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                    ot_mie =        sum(atm_profile_temp[:,4]*atm_profile_temp[:,7]) + atm_profile[layer_index,4] * tao_lastLayer_ratio / math.cos(travel_angle/180*math.pi)
-                    
-                    break # stop removing layers 
-           
-    traveled_distance = abs(q0[2] - z) / math.cos(travel_angle/180*math.pi)
-    q1 = dirC_to_coord (dirP_to_coord(1, pt_direction),q0,traveled_distance)
-    q1 = np.array(q1)
+    '''
+    
+    traveled_distance, tao_abs, ot_rayleigh, ot_mie, out = free_path(OT_profile, q0[:,2], pt_direction_C[:,2], sampled_tao)
+    
+    q1 = q0 + pt_direction_C * traveled_distance[:,None]
     
-    return q1, tao_abs, ot_rayleigh, ot_mie, out
+    return q1, tao_abs, out
         
 
 # if __name__=='__main__':  
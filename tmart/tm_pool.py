@@ -0,0 +1,143 @@
+# This file is part of T-Mart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# T-Mart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+# Persistent pool of worker processes shared by Tmart.run calls
+# The Tmart object (scene, atmosphere and geometry) is shipped to the workers once per run through a file,
+# tasks only carry the key of the scene and a range of photon IDs
+
+import hashlib
+import tempfile
+import shutil
+import os
+import itertools
+import atexit
+import threading
+from multiprocessing import cpu_count
+
+# Scenes kept on disk by a pool and in memory by a worker
+N_SCENES_DISK = 16
+N_SCENES_WORKER = 4
+
+_pool_ids = itertools.count()
+
+
+class TmartPool():
+    '''Create a pool of worker processes that persists across runs. Pass it to ``Tmart.run`` to avoid starting processes and sending the whole Tmart object with every job. Without it, ``Tmart.run`` uses a default pool that is kept for later runs.
+
+    Arguments:
+
+    * ``nc`` -- number of CPU cores to use, default automatic.
+
+    Example usage::
+
+      with tmart.TmartPool(nc=4) as pool:
+          for wl in [443, 550, 665]:
+              results = my_tmart.run(wl=wl, n_photon=10_000, pool=pool)
+
+    '''
+
+    def __init__(self, nc='auto'):
+
+        from pathos.pools import ProcessPool
+
+        if nc=='auto':
+            nc = cpu_count()
+        self.nc = nc
+
+        # A private pathos pool, not shared with other ProcessPools of the same size
+        self._pool = ProcessPool(nodes=nc, id='tmart_pool_{}_{}'.format(os.getpid(), next(_pool_ids)))
+        self._dir = tempfile.mkdtemp(prefix='tmart_pool_')
+        self._shipped = []
+        self._ship_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Stop the worker processes and delete the shipped scenes.'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool.clear()
+            self._pool = None
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def ship(self, scene):
+        '''Write a pickled scene once, return its key.'''
+
+        import dill
+
+        data = dill.dumps(scene)
+        key = hashlib.sha1(data).hexdigest()
+
+        # Runs in several threads may ship to the same pool
+        with self._ship_lock:
+            if key not in self._shipped:
+                file = os.path.join(self._dir, key)
+                with open(file + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(file + '.tmp', file)
+                self._shipped.append(key)
+
+                # remove old scenes
+                while len(self._shipped) > N_SCENES_DISK:
+                    os.remove(os.path.join(self._dir, self._shipped.pop(0)))
+
+        return key
+
+    def amap(self, key, tasks):
+        '''Run tasks asynchronously on the scene of key, each task is a tuple of arguments of Tmart._run_task.'''
+        return self._pool.amap(_run_task, [(self._dir, key) + tuple(task) for task in tasks])
+
+
+# Default pool of Tmart.run, replaced when the number of cores changes
+# Runs in several threads, e.g. AOT candidates in get_AOT, create and share one pool 
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_pool(nc):
+    global _default_pool
+
+    if nc=='auto':
+        nc = cpu_count()
+
+    with _default_pool_lock:
+        if _default_pool is None or _default_pool.nc != nc or _default_pool._pool is None:
+            if _default_pool is not None:
+                _default_pool.close()
+            _default_pool = TmartPool(nc)
+
+        return _default_pool
+
+@atexit.register
+def _close_default_pool():
+    if _default_pool is not None:
+        _default_pool.close()
+
+
+# Worker side: scenes loaded by this process
+_scenes = {}
+
+def _run_task(args):
+
+    scene_dir, key = args[0], args[1]
+
+    if key not in _scenes:
+        import dill
+        with open(os.path.join(scene_dir, key), 'rb') as f:
+            _scenes[key] = dill.loads(f.read())
+        while len(_scenes) > N_SCENES_WORKER:
+            _scenes.pop(next(iter(_scenes)))
+
+    return _scenes[key]._run_task(*args[2:])
+
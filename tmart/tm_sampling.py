@@ -11,64 +11,96 @@ import random
 import math
 import numpy as np
 
-from .tm_geometry import dirP_to_coord, rotation_matrix, dirC_to_dirP
-from scipy.interpolate import interp1d
+from .tm_geometry import dirP_to_coord, rotation_matrix, dirC_to_dirP, scatter_direction_batch
+
+# Aerosol scattering phase function at one wavelength, built once in Tmart._init_atm 
+class PhaseFunction():
+    '''
+    Tabulated aerosol SPF: a fine table of values for local estimates and 
+    a CDF over the scattering angle for inverse-CDF sampling. Both use the 
+    same cubic interpolation of the SPF as the rejection sampler it replaces. 
+
+    Parameters
+    ----------
+    aerosol_SPF : pandas dataframe
+        Angle (0-180 degrees) and Value of the SPF, from find_aerosolSPF.
+    n_grid : int
+        number of angles in the tables, default 0.01 degree spacing.
+
+    '''
+    
+    def __init__(self, aerosol_SPF, n_grid=18001):
+        
+        from scipy.interpolate import interp1d
+        
+        df_angle = aerosol_SPF.Angle.to_numpy()
+        df_value = aerosol_SPF.Value.to_numpy()
+        
+        if np.min(df_angle)!=0 or np.max(df_angle)!=180:
+            print('WARNING: Angle has to be between 0 and 180') # csv problem
+        
+        f2 = interp1d(df_angle, df_value, kind='cubic') 
+        
+        self.angles = np.linspace(0, 180, n_grid)
+        self.values = f2(self.angles)
+        
+        # sin correction, negative values of the interpolation are never sampled 
+        pdf = np.maximum(self.values, 0) * np.sin(np.radians(self.angles))
+        cdf = np.concatenate(([0], np.cumsum((pdf[1:] + pdf[:-1]) / 2)))
+        self.cdf = cdf / cdf[-1]
+        
+        # Integral of the sampled SPF over all directions, 4 pi if normalized 
+        self.norm = 2 * np.pi * cdf[-1] * np.radians(self.angles[1] - self.angles[0])
+        
+    def sample(self, u):
+        '''Scattering angles in degrees of uniform random numbers u, a number or an array'''
+        return np.interp(u, self.cdf, self.angles)
+    
+    def value(self, angle):
+        '''SPF at scattering angles in degrees, a number or an array'''
+        return np.interp(angle, self.angles, self.values)
+
+def _as_phase_function(aerosol_SPF):
+    if isinstance(aerosol_SPF, PhaseFunction):
+        return aerosol_SPF
+    else: # SPF dataframe 
+        return PhaseFunction(aerosol_SPF)
+
 
 # Sampling 
+# rng: a numpy Generator, or None for the random module 
 
 # Sample a direction from an isotropic distribution 
-def sample_Lambertian():
-    zenith = math.acos(math.sqrt(random.random())) *180/math.pi
-    azimuthal = random.uniform(0,360)
+def sample_Lambertian(rng=None):
+    if rng is None: rng = random
+    zenith = math.acos(math.sqrt(rng.random())) *180/math.pi
+    azimuthal = rng.uniform(0,360)
     coord = dirP_to_coord(1,[zenith, azimuthal])
     
     # a list of two lists, coord & direction 
     return [coord, [zenith, azimuthal]] 
 
 # Sample a scattering direction based on existing direction 
-def sample_scattering(ot_mie,ot_rayleigh,pt_direction,aerosol_SPF, print_on=False): 
+def sample_scattering(ot_mie,ot_rayleigh,pt_direction,aerosol_SPF, print_on=False, rng=None): 
+    
+    if rng is None: rng = random
     
     # sum of scattering 
     ot_sum = ot_mie + ot_rayleigh
 
     ### Determine if mie or rayleigh 
     
-    ot_random = random.uniform(0,ot_sum)
+    ot_random = rng.uniform(0,ot_sum)
     
     # Mie 
     if ot_random <= ot_mie:
         if print_on: print ('\nMie scattering')
         type_scat = 'M'
-        df_angle = aerosol_SPF.Angle.to_numpy()
-        
-        # sin correction 
-        df_value = aerosol_SPF.Value.to_numpy() * np.sin(df_angle * math.pi/180)
-        
-        x_min = np.min(df_angle)
-        x_max = np.max(df_angle)
-        
-        if x_min!=0 or x_max!=180:
-            print('WARNING: Angle has to be between 0 and 180') # csv problem
- 
-        f2 = interp1d(df_angle, df_value, kind='cubic') 
-        
-        '''
-        #visualize the interpolation 
-        xnew = np.linspace(0, 180, num=800, endpoint=True)
-        import matplotlib.pyplot as plt
-        plt.plot(df_angle, df_value, 'o', xnew, f(xnew), '-', xnew, f2(xnew), '--')
-        plt.legend(['data', 'linear', 'cubic'], loc='best')
-        plt.show()
-        '''
         
-        y_max = np.max(df_value)
-        y=y_max
-        y_calculated=0
-        
-        while y>y_calculated:
-            y=random.uniform(0,y_max)
-            x=random.uniform(0,180)
-            y_calculated = f2(x).item() # interpolate 
+        # Inverse CDF 
+        phase_function = _as_phase_function(aerosol_SPF)
+        x = phase_function.sample(rng.random()).item()
+        intensity = phase_function.value(x).item() 
                 
     # Rayleigh   
     else:
@@ -87,16 +119,16 @@ def sample_scattering(ot_mie,ot_rayleigh,pt_direction,aerosol_SPF, print_on=Fals
         #     y_calculated = y_calculated * math.sin(x/180*math.pi)
         
         # Rayleigh scattering phase function from libRadtran, line 4539 in mystic.c
-        P = random.random()
+        P = rng.random()
         q = 8.0 * P - 4.0
         u =  (-q / 2.0 + math.sqrt (1.0 + q * q / 4.0))**(1/3)
         v = -1.0 / u
         mu = u + v
         x = math.acos(mu) * 180 / math.pi # sampled scattering angle 
-        y_calculated = (3/4)*(1+(math.cos(x/180*math.pi))**2) # scattering intensity 
+        intensity = (3/4)*(1+(math.cos(x/180*math.pi))**2) # scattering intensity 
 
     # print(x) # azimuthal direction 
-    sampled_direction = [x, random.uniform(0,360)]
+    sampled_direction = [x, rng.uniform(0,360)]
     
     if print_on: print("Sampled_direction: " + str(sampled_direction))
     
@@ -126,19 +158,18 @@ def sample_scattering(ot_mie,ot_rayleigh,pt_direction,aerosol_SPF, print_on=Fals
     
     if print_on: print("Rotated_direction: " + str(new_direction)) 
     
-    # intensity at new_direction 
-    intensity = y_calculated  / math.sin(x/180*math.pi)
-    
     if print_on: print ('  intensity: ' + str(intensity))
     
     return new_direction, intensity, type_scat
 
 # Importance sampling 
-def weight_impSampling(ot_mie,ot_rayleigh,angle_impSampling,aerosol_SPF, print_on=False): 
+def weight_impSampling(ot_mie,ot_rayleigh,angle_impSampling,aerosol_SPF, print_on=False, rng=None): 
+    
+    if rng is None: rng = random
     
     # sum of scattering 
     ot_sum = ot_mie + ot_rayleigh
-    ot_random = random.uniform(0,ot_sum)
+    ot_random = rng.uniform(0,ot_sum)
     
     ### Determine if mie or rayleigh 
     
@@ -146,18 +177,7 @@ def weight_impSampling(ot_mie,ot_rayleigh,angle_impSampling,aerosol_SPF, print_o
     if ot_random <= ot_mie:
         if print_on: print ('\nMie scattering importance sampling')
         
-        df_angle = aerosol_SPF.Angle.to_numpy()
-        df_value = aerosol_SPF.Value.to_numpy() 
-        
-        x_min = np.min(df_angle)
-        x_max = np.max(df_angle)
-        
-        if x_min!=0 or x_max!=180:
-            print('WARNING: Angle has to be between 0 and 180') # csv problem
-
-        # Interpolate 
-        f2 = interp1d(df_angle, df_value, kind='cubic') 
-        y_calculated = f2(angle_impSampling).item() 
+        y_calculated = _as_phase_function(aerosol_SPF).value(angle_impSampling).item() 
                 
     # Rayleigh   
     else:
@@ -178,17 +198,7 @@ def weight_impSampling2(ot_mie,ot_rayleigh,angle_impSampling,aerosol_SPF, print_
     ot_sum = ot_mie + ot_rayleigh
     
     # Mie 
-    df_angle = aerosol_SPF.Angle.to_numpy()
-    df_value = aerosol_SPF.Value.to_numpy() 
-    
-    x_min = np.min(df_angle)
-    x_max = np.max(df_angle)
-    
-    if x_min!=0 or x_max!=180:
-        print('WARNING: Angle has to be between 0 and 180') # csv problem
-
-    f2 = interp1d(df_angle, df_value, kind='cubic') 
-    y_calculated_M = f2(angle_impSampling).item() # interpolate 
+    y_calculated_M = _as_phase_function(aerosol_SPF).value(angle_impSampling).item() 
                 
     # Rayleigh   
     y_calculated_R = (3/4)*(1+(math.cos(angle_impSampling/180*math.pi))**2)
@@ -199,3 +209,40 @@ def weight_impSampling2(ot_mie,ot_rayleigh,angle_impSampling,aerosol_SPF, print_
     if print_on: print ('  importance sampling intensity: ' + str(intensity))
 
     return intensity    
+
+
+# Vectorized sampling for the batch engine, rng is a numpy Generator 
+
+# Sample n directions from an isotropic distribution, returns zenith and azimuth in degrees 
+def sample_Lambertian_batch(n, rng):
+    zenith = np.degrees(np.arccos(np.sqrt(rng.random(n))))
+    azimuthal = rng.uniform(0,360,n)
+    return zenith, azimuthal
+
+# Sample scattering directions based on existing directions, returns new unit directions and if Mie  
+def sample_scattering_batch(ot_mie, ot_rayleigh, pt_direction_C, aerosol_SPF, rng):
+    
+    n = len(ot_mie)
+    
+    ### Determine if mie or rayleigh 
+    is_mie = rng.uniform(0,1,n) * (ot_mie + ot_rayleigh) <= ot_mie
+    
+    cos_scat = np.empty(n)
+    
+    # Mie, inverse CDF 
+    n_mie = np.sum(is_mie)
+    if n_mie > 0:
+        x = _as_phase_function(aerosol_SPF).sample(rng.random(n_mie))
+        cos_scat[is_mie] = np.cos(np.radians(x))
+    
+    # Rayleigh scattering phase function from libRadtran, line 4539 in mystic.c
+    n_rayleigh = n - n_mie
+    if n_rayleigh > 0:
+        q = 8.0 * rng.random(n_rayleigh) - 4.0
+        u = np.cbrt(-q / 2.0 + np.sqrt(1.0 + q * q / 4.0))
+        cos_scat[~is_mie] = np.clip(u - 1.0 / u, -1, 1)
+    
+    azimuth_scat = rng.uniform(0, 2*math.pi, n)
+    new_direction = scatter_direction_batch(pt_direction_C, cos_scat, azimuth_scat)
+    
+    return new_direction, is_mie
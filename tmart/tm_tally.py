@@ -0,0 +1,181 @@
+# This file is part of T-Mart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# T-Mart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+
+# Typed records of photon local estimates, one record per movement
+
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
+# Type of collision: W (water leaving), Ws (water specular), L (land), M (mie), R (Rayleigh)
+TYPE_W, TYPE_WS, TYPE_L, TYPE_M, TYPE_R = 0, 1, 2, 3, 4
+TYPE_CODES = {'W': TYPE_W, 'Ws': TYPE_WS, 'L': TYPE_L, 'M': TYPE_M, 'R': TYPE_R}
+
+# Fields, the first 13 are the columns of the old numpy output
+TALLY_DTYPE = np.dtype([('pt_id', np.int64),
+                        ('movement', np.int16),
+                        ('L_cox-munk', np.float64),
+                        ('L_whitecap', np.float64),
+                        ('L_water', np.float64),
+                        ('L_land', np.float64),
+                        ('L_rayleigh', np.float64),
+                        ('L_mie', np.float64),
+                        ('x', np.float64),
+                        ('y', np.float64),
+                        ('z', np.float64),
+                        ('shadowed', np.int8),
+                        ('if_env', np.int8),
+                        ('type', np.int8)])
+
+TALLY_FIELDS = list(TALLY_DTYPE.names)
+L_FIELDS = TALLY_FIELDS[2:8] # local estimates
+
+
+def tally_empty(n):
+    '''Preallocate n records.'''
+    return np.zeros(n, dtype=TALLY_DTYPE)
+
+
+def tally_L(records):
+    '''Local estimates of the records as a float array, columns: L_cox-munk, L_whitecap, L_water, L_land, L_rayleigh, L_mie.'''
+    return structured_to_unstructured(records[L_FIELDS], dtype=np.float64)
+
+
+def tally_from_array(array):
+    '''Records from a float array with the 13 columns of the old output, plus an optional 14th column of type codes.'''
+
+    array = np.asarray(array, dtype=float)
+    records = tally_empty(array.shape[0])
+
+    for i, field in enumerate(TALLY_FIELDS[:array.shape[1]]):
+        records[field] = array[:,i]
+
+    return records
+
+
+def tally_as_records(results):
+    '''Records from records, stacked records or the float array of earlier versions.'''
+
+    if results.dtype.names is None:
+        return tally_from_array(results)
+    else:
+        return results.reshape(-1)
+
+
+def tally_to_array(records):
+    '''Float array with the 13 columns of the old output: pt_id, movement, L_cox-munk, L_whitecap, L_water, L_land,
+    L_rayleigh, L_mie, x, y, z, shadowed, if_env. Arrays that are not records are returned as they are.'''
+
+    if records.dtype.names is None:
+        return records
+
+    return structured_to_unstructured(records.reshape(-1)[TALLY_FIELDS[:13]], dtype=np.float64)
+
+
+
+# Streaming mode of Tmart.run: each job reduces its records into running sums
+
+def tally_sum(results, hist_bins=None):
+    '''
+    Reduce records to the sums calc_ref needs. 
+
+    Parameters
+    ----------
+    results : numpy array
+        records, or the float array of earlier versions.
+    hist_bins : list, optional
+        [y_bins, x_bins] of a 2D histogram of environment contributions 
+        (L_cox-munk + L_whitecap + L_water + L_land of if_env rows), as in np.histogram2d.
+
+    Returns
+    -------
+    tally : dict
+        n_photon: number of photons with records, L_atm: sums of L_rayleigh and L_mie, 
+        L_dir and L_env: sums of L_cox-munk, L_whitecap, L_water and L_land of 
+        if_env == 0 and 1 rows, image_env: the 2D histogram or None.
+
+    '''
+    
+    records = tally_as_records(results)
+    L = tally_L(records)
+    env = records['if_env'] == 1
+    
+    tally = {'n_photon': np.unique(records['pt_id']).shape[0],
+             'L_atm': L[:,4:6].sum(axis=0),
+             'L_dir': L[records['if_env'] == 0, 0:4].sum(axis=0),
+             'L_env': L[env, 0:4].sum(axis=0),
+             'image_env': None}
+    
+    if hist_bins is not None:
+        tally['image_env'] = np.histogram2d(records['y'][env], records['x'][env], bins=hist_bins, 
+                                            weights=L[env, 0:4].sum(axis=1))[0]
+    return tally
+
+
+def tally_merge(tallies):
+    '''Add up a list of tallies from tally_sum, photons must not be shared between tallies.'''
+    
+    tally = {'n_photon': sum(t['n_photon'] for t in tallies),
+             'L_atm': sum(t['L_atm'] for t in tallies),
+             'L_dir': sum(t['L_dir'] for t in tallies),
+             'L_env': sum(t['L_env'] for t in tallies),
+             'image_env': None}
+    
+    if tallies[0]['image_env'] is not None:
+        tally['image_env'] = sum(t['image_env'] for t in tallies)
+        
+    return tally
+
+
+# Adaptive number of photons in Tmart.run: standard errors from the tallies of the jobs
+
+def tally_error(tallies, n_photons):
+    '''
+    Relative standard errors of the reflectances, estimated from the spread of the reflectances of jobs.
+
+    Parameters
+    ----------
+    tallies : list
+        tallies of the jobs from tally_sum.
+    n_photons : list
+        numbers of photons fired in the jobs, jobs without photons are ignored.
+
+    Returns
+    -------
+    error : dict
+        relative standard errors of R_atm, R_dir, R_env and R_total. 0 if a reflectance and 
+        its error are both 0, inf with fewer than 2 jobs or a reflectance of 0 with a non-zero error.
+
+    '''
+    
+    n = np.array(n_photons, dtype=float)
+    L = np.array([[t['L_atm'].sum(), t['L_dir'].sum(), t['L_env'].sum()] for t in tallies])
+    L = np.column_stack([L, L.sum(axis=1)])[n > 0]
+    n = n[n > 0]
+    
+    error = {}
+    for i, name in enumerate(['R_atm', 'R_dir', 'R_env', 'R_total']):
+        if len(n) < 2:
+            error[name] = np.inf
+            continue
+        
+        R = L[:,i].sum() / n.sum()
+        R_jobs = L[:,i] / n
+        
+        # Variance of the mean, jobs weighted by their numbers of photons 
+        se = np.sqrt(np.sum(n * (R_jobs - R)**2) / ((len(n) - 1) * n.sum()))
+        
+        if se == 0: 
+            error[name] = 0.0
+        elif R == 0:
+            error[name] = np.inf
+        else:
+            error[name] = float(se / abs(R))
+    
+    return error
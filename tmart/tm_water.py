@@ -9,10 +9,9 @@
 
 # Water 
 
-import random
 import math
+import functools
 import numpy as np
-import pandas as pd 
 import os.path
 
 if __name__=='__main__':
@@ -24,6 +23,7 @@ else:
 def find_R_wc(wl, wind_speed):
 
     if wind_speed > 6.5: 
+        import pandas as pd
         from scipy.interpolate import interp1d
         
         # interpolate whitecape factor 
@@ -361,8 +361,200 @@ def find_R_cm(pt_direction_op_C, sun_dir, q_collision_N_polar, wind_dir, wind_sp
 
 
 
+# Largest error of GlintTable relative to the peak glint reflectance, checked against find_R_cm_batch at the centres of the cells 
+GLINT_MAX_ERROR = 0.005
+
+# Vectorized find_R_cm for a flat surface, q_collision_N_polar zenith 0 
+def find_R_cm_batch(pt_direction_op_C, sun_dir, wind_dir, wind_speed, water_refraIdx_wl):
+    '''
+    Glint reflectance of find_R_cm on a flat surface, pt_direction_op_C is an n*3 array of directions. 
+
+    '''
+    
+    op = pt_direction_op_C / np.linalg.norm(pt_direction_op_C, axis=1)[:,None]
+    sun_dir_c = dirP_to_coord(1,sun_dir)
+    
+    # Normal needed for the specular reflection, between the photon's incoming direction and the sun 
+    middle_c = op + sun_dir_c
+    middle_c = middle_c / np.linalg.norm(middle_c, axis=1)[:,None]
+    
+    # Corrected for wind direction as in find_eta_P, then slopes 
+    cos_w = math.cos(wind_dir/180*math.pi)
+    sin_w = math.sin(wind_dir/180*math.pi)
+    eta_a = (middle_c[:,0]*cos_w - middle_c[:,1]*sin_w) / middle_c[:,2]
+    eta_c = (middle_c[:,0]*sin_w + middle_c[:,1]*cos_w) / middle_c[:,2]
+    
+    # Fresnel reflectance at half the angle between the photon and the sun 
+    angle_pt_sun = np.degrees(np.arccos(np.clip(op @ sun_dir_c, -1, 1)))
+    R_specular = fresnel_batch(water_refraIdx_wl, angle_pt_sun/2)
+    
+    # cox_munk in slopes 
+    sigma_c = math.sqrt(1.92 * 10**-3 * wind_speed + 0.003)
+    sigma_a = math.sqrt(3.16 * 10**-3 * wind_speed)
+    gc = _gram_charlier(eta_c / sigma_c, eta_a / sigma_a, 0.01 - 0.0086*wind_speed, 0.04 - 0.033*wind_speed)
+    p_cox_munk = np.exp(-0.5 * ((eta_c / sigma_c)**2 + (eta_a / sigma_a)**2)) * gc / (2 * math.pi * sigma_a * sigma_c)
+    
+    solar_zenith = sun_dir[0] /180 * math.pi
+    return math.pi * p_cox_munk * R_specular / (4 * math.cos(solar_zenith) * middle_c[:,2]**4)
+
+
+class GlintTable():
+    '''
+    Glint reflectance of flat water, find_R_cm (averaged with the wind turned by 90 degrees if wind_azi_avg), 
+    interpolated from a table of the zenith and azimuth of pt_direction_op_C. The sun, wind and refractive index 
+    are fixed in a run. The step is halved once if the error at the centres of the cells is above GLINT_MAX_ERROR 
+    of the peak, then find_R_cm is used if it is still above. 
+
+    '''
+    
+    def __init__(self, sun_dir, wind_dir, wind_speed, water_refraIdx_wl, wind_azi_avg, step=0.25):
+        
+        self.args = (sun_dir, wind_dir, wind_speed, water_refraIdx_wl, wind_azi_avg)
+        
+        for i in range(2):
+            n_zenith, n_azimuth = int(round(90 / step)), int(round(180 / step))
+            self.d_zenith, self.d_azimuth = 90 / n_zenith, 360 / n_azimuth
+            
+            zenith, azimuth = np.meshgrid(np.arange(n_zenith + 1) * self.d_zenith, np.arange(n_azimuth + 1) * self.d_azimuth, indexing='ij')
+            self.table = self.exact(zenith, azimuth)
+            peak = np.max(self.table)
+            
+            # Error at the centres of the cells, only where the glint is not negligible 
+            corners = np.maximum(np.maximum(self.table[:-1,:-1], self.table[1:,:-1]), np.maximum(self.table[:-1,1:], self.table[1:,1:]))
+            check = corners > GLINT_MAX_ERROR * peak
+            zenith, azimuth = zenith[:-1,:-1][check] + self.d_zenith/2, azimuth[:-1,:-1][check] + self.d_azimuth/2
+            self.error = np.max(np.abs(self.interpolate(zenith, azimuth) - self.exact(zenith, azimuth)), initial=0) / peak
+            if self.error <= GLINT_MAX_ERROR: 
+                break
+            step = step / 2
+            
+        else:
+            print('WARNING: glint table error {} above {}, using find_R_cm'.format(self.error, GLINT_MAX_ERROR))
+            self.table = None
+        
+        # Rows as lists for value 
+        self._rows = self.table.tolist() if self.table is not None else None
+    
+    # find_R_cm_batch at directions in degrees 
+    def exact(self, zenith, azimuth):
+        
+        sun_dir, wind_dir, wind_speed, water_refraIdx_wl, wind_azi_avg = self.args
+        zenith, azimuth = np.radians(zenith), np.radians(azimuth)
+        op = np.stack([np.sin(zenith) * np.cos(azimuth), np.sin(zenith) * np.sin(azimuth), np.cos(zenith)], axis=-1).reshape(-1,3)
+        
+        R_cm = find_R_cm_batch(op, sun_dir, wind_dir, wind_speed, water_refraIdx_wl)
+        
+        # Average = (regular + wind 90 degrees) / 2
+        if wind_azi_avg:
+            R_cm = (R_cm + find_R_cm_batch(op, sun_dir, wind_dir + 90, wind_speed, water_refraIdx_wl)) / 2
+        return R_cm.reshape(np.shape(zenith))
+    
+    # Bilinear interpolation in the table 
+    def interpolate(self, zenith, azimuth):
+        
+        i = np.clip(zenith / self.d_zenith, 0, self.table.shape[0] - 1)
+        j = np.clip(azimuth / self.d_azimuth, 0, self.table.shape[1] - 1)
+        i0 = np.minimum(i.astype(int), self.table.shape[0] - 2)
+        j0 = np.minimum(j.astype(int), self.table.shape[1] - 2)
+        fi, fj = i - i0, j - j0
+        
+        t = self.table
+        return ((t[i0,j0] * (1-fj) + t[i0,j0+1] * fj) * (1-fi) + 
+                (t[i0+1,j0] * (1-fj) + t[i0+1,j0+1] * fj) * fi)
+    
+    def value_batch(self, pt_direction_op_C):
+        '''Glint reflectance of an n*3 array of directions.'''
+        
+        op = np.asarray(pt_direction_op_C, dtype=float).reshape(-1,3)
+        zenith = np.degrees(np.arccos(np.clip(op[:,2] / np.linalg.norm(op, axis=1), -1, 1)))
+        azimuth = np.degrees(np.arctan2(op[:,1], op[:,0])) % 360
+        
+        if self.table is None:
+            return self.exact(zenith, azimuth)
+        return self.interpolate(zenith, azimuth)
+    
+    def value(self, pt_direction_op_C):
+        '''Glint reflectance of a direction, the same as value_batch without numpy.'''
+        
+        x, y, z = pt_direction_op_C[0], pt_direction_op_C[1], pt_direction_op_C[2]
+        if self._rows is None:
+            sun_dir, wind_dir, wind_speed, water_refraIdx_wl, wind_azi_avg = self.args
+            R_cm = find_R_cm(pt_direction_op_C, sun_dir, [0,0], wind_dir, wind_speed, water_refraIdx_wl, False)
+            if wind_azi_avg:
+                R_cm = (R_cm + find_R_cm(pt_direction_op_C, sun_dir, [0,0], wind_dir + 90, wind_speed, water_refraIdx_wl, False)) / 2
+            return R_cm
+        
+        i = math.acos(max(min(z / math.sqrt(x*x + y*y + z*z), 1), -1)) * 180/math.pi / self.d_zenith
+        j = (math.atan2(y, x) * 180/math.pi % 360) / self.d_azimuth
+        n_i, n_j = len(self._rows) - 2, len(self._rows[0]) - 2
+        i0, j0 = min(int(i), n_i), min(int(j), n_j)
+        fi, fj = min(i - i0, 1), min(j - j0, 1)
+        
+        r0, r1 = self._rows[i0], self._rows[i0+1]
+        return ((r0[j0] * (1-fj) + r0[j0+1] * fj) * (1-fi) + 
+                (r1[j0] * (1-fj) + r1[j0+1] * fj) * fi)
+
+
+# Constants of the facet sampler at a wind speed, computed once 
+@functools.lru_cache(maxsize=16)
+def _cox_munk_sampler(wind_speed):
+    
+    # Slope standard deviations, cross-wind and along-wind, as in cox_munk 
+    sigma_c = math.sqrt(1.92 * 10**-3 * wind_speed + 0.003)
+    sigma_a = math.sqrt(3.16 * 10**-3 * wind_speed)
+    c21 = 0.01 - 0.0086*wind_speed
+    c03 = 0.04 - 0.033*wind_speed
+    constants = (sigma_a, sigma_c, c21, c03)
+    
+    # Normalized slopes are drawn with a standard deviation slightly above 1, so that the ratio is bounded 
+    # where the Gram-Charlier terms grow, the one accepting the most draws 
+    xi, eta = np.meshgrid(np.linspace(-10, 10, 201), np.linspace(-10, 10, 201))
+    best = None
+    for scale in np.arange(1, 1.5, 0.05):
+        ratio_max = np.max(_cox_munk_ratio(xi, eta, *constants, scale)) * 1.02
+        if best is None or ratio_max * scale**2 < best[1] * best[0]**2:
+            best = (scale, ratio_max)
+    
+    return constants + best
+
+
+# Gram-Charlier terms of cox_munk, 0 where negative, for numbers or arrays 
+def _gram_charlier(xi, eta, c21, c03):
+    gc = (1 - 0.5*c21*(xi**2 - 1)*eta - (1/6)*c03*(eta**3 - 3*eta) +
+          (1/24)*0.40 * (xi**4 - 6*xi**2 + 3) + (1/4) * 0.12 *(xi**2 - 1)*(eta**2 - 1) + 
+          (1/24)*0.23*(eta**4 - 6*eta**2 + 3) )
+    return gc * (gc > 0)
+
+
+# Ratio of the distribution sampled by angles to the Gaussian of standard deviation scale, 
+# xi and eta are normalized cross-wind and along-wind slopes 
+def _cox_munk_ratio(xi, eta, sigma_a, sigma_c, c21, c03, scale):
+    
+    gc = _gram_charlier(xi, eta, c21, c03)
+    
+    # Slope angles are drawn with the density of the slopes, d(angle) = d(slope) / (1 + slope**2)
+    jacobian = (1 + (sigma_a*eta)**2) * (1 + (sigma_c*xi)**2)
+    return gc / jacobian * np.exp(-0.5 * (xi**2 + eta**2) * (1 - 1/scale**2))
+
+
+# Facet normals from normalized slopes, rotated to the wind direction 
+def _slopes_to_normal(xi, eta, sigma_a, sigma_c, wind_dir):
+    
+    slope_a = sigma_a * eta # along wind, X before rotation 
+    slope_c = sigma_c * xi  # cross wind, Y before rotation 
+    norm = np.sqrt(1 + slope_a**2 + slope_c**2)
+    
+    cos_w = math.cos(wind_dir/180*math.pi)
+    sin_w = math.sin(wind_dir/180*math.pi)
+    return np.stack([(slope_a*cos_w - slope_c*sin_w) / norm, 
+                     (slope_a*sin_w + slope_c*cos_w) / norm, 
+                     1 / norm], axis=-1)
+
+
+_rng = None
+
 # Sample a random slope, not related to the sun, correct to X direction  
-def sample_cox_munk(wind_speed, wind_dir):
+def sample_cox_munk(wind_speed, wind_dir, rng=None):
     '''
     
     Parameters
@@ -371,6 +563,8 @@ def sample_cox_munk(wind_speed, wind_dir):
         wind speed in m/s.
     wind_dir : TYPE
         wind direction, same as zenith angle.
+    rng : numpy Generator, optional 
+        random numbers, default a generator of the module. 
 
     Returns
     -------
@@ -380,40 +574,54 @@ def sample_cox_munk(wind_speed, wind_dir):
     '''
     
     if wind_speed==0:
-        return[0,0,1]
+        return np.array([0.,0.,1.])
     
-    else:
-        # Find maximum 
-        # maximum is in the downwind direction
-        cm_max = 0
-        for i in range(0,90):
-            
-            eta_a_degree = -i # make it downwind
-            eta_c_degree = 0
-            cm_calc = cox_munk(eta_a_degree, eta_c_degree, wind_speed, unit='degree') 
-
-            if cm_calc >= cm_max:
-                cm_max = cm_calc
-            else:
-                cm_max = cm_max *1.1 # in case we did not find the actual max, to be safe 
-                break
-            
-        # Just to create it and make it greater than calc 
-        cm_rand = cm_calc +1 
-        
-        while cm_calc < cm_rand:
-            eta_a_degree = random.uniform(-90,90)    
-            eta_c_degree = random.uniform(-90,90)    
-            cm_calc = cox_munk(eta_a_degree, eta_c_degree, wind_speed, unit='degree')
-            cm_rand = random.uniform(0,cm_max) 
-        
-        L = eta_to_dirP(eta_a_degree, eta_c_degree)
-        
-        # Correct for wind_direction 
-        L[1] = L[1] + wind_dir
-        if L[1] >=360:
-            L[1] = L[1] - 360
-        
-        coords = dirP_to_coord(1, L[0:2])
-        
-        return coords
+    global _rng
+    if rng is None: 
+        if _rng is None: _rng = np.random.default_rng()
+        rng = _rng
+    
+    # Slopes from the Gaussian of the slope variances, accepted by the ratio of the Cox-Munk distribution 
+    sigma_a, sigma_c, c21, c03, scale, ratio_max = _cox_munk_sampler(wind_speed)
+    while True:
+        xi, eta = (rng.standard_normal(2) * scale).tolist()
+        if rng.random() * ratio_max < _cox_munk_ratio(xi, eta, sigma_a, sigma_c, c21, c03, scale):
+            break
+    
+    return _slopes_to_normal(xi, eta, sigma_a, sigma_c, wind_dir)
+
+
+def sample_cox_munk_batch(n, wind_speed, wind_dir, rng):
+    '''
+    Vectorized sample_cox_munk, n facet normals as an n*3 array. 
+
+    '''
+    
+    if wind_speed==0:
+        return np.tile([0.,0.,1.], (n,1))
+    
+    sigma_a, sigma_c, c21, c03, scale, ratio_max = _cox_munk_sampler(wind_speed)
+    
+    xi, eta = np.empty(n), np.empty(n)
+    pending = np.arange(n)
+    while pending.size > 0:
+        xi[pending], eta[pending] = rng.standard_normal((2, pending.size)) * scale
+        accepted = rng.random(pending.size) * ratio_max < _cox_munk_ratio(xi[pending], eta[pending], sigma_a, sigma_c, c21, c03, scale)
+        pending = pending[~accepted]
+    
+    return _slopes_to_normal(xi, eta, sigma_a, sigma_c, wind_dir)
+
+
+# Vectorized Fresnel reflectance for the batch engine, incident zenith in degrees 
+def fresnel_batch(n_w, zenith_i):
+    
+    z_i = np.radians(zenith_i)
+    
+    # Transmission angle 
+    z_t = np.arcsin(np.sin(z_i) / n_w)
+    
+    R = np.full(np.shape(z_i), ((n_w-1) / (n_w+1))**2)
+    oblique = z_i > 0 
+    a, b = z_i[oblique] - z_t[oblique], z_i[oblique] + z_t[oblique]
+    R[oblique] = 0.5 * ((np.sin(a)/np.sin(b))**2 + (np.tan(a)/np.tan(b))**2)
+    return R
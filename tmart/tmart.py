@@ -11,30 +11,43 @@
 
 # TMart: Topography-adjusted Monte-Carlo Adjacency-effect Radiative Transfer code
 
-from multiprocessing import cpu_count
-from pathos.multiprocessing import ProcessingPool
 import numpy as np
 import time
 import sys
 
 # tmart dependencies 
 from .tm_geometry import dirP_to_coord 
-from .tm_intersect import intersect_line_DEMtri2
+from .tm_intersect import intersect_line_DEMgrid
 from .tm_water import find_R_wc, RefraIdx
+from .tm_sampling import PhaseFunction
+from .tm_OT import OTProfile
+from .tm_tally import tally_empty, tally_sum, tally_merge, tally_error
+from .tm_pool import default_pool
 try: 
     from .tmart2 import Tmart2
 except:
     from .Tmart2 import Tmart2
+from .tmart_batch import TmartBatch
+from .tmart_spectral import TmartSpectral
+
+# Records kept by a job in streaming mode before reducing them to sums 
+STREAMING_BUFFER = 100_000
+
+# With a target error, the first round runs this fraction of the maximum number of photons 
+ADAPTIVE_FIRST_ROUND = 10
+
+# Russian roulette with roulette=True: [weight threshold, survival weight], relative to the initial weight 
+ROULETTE_DEFAULT = [0.01, 0.1]
 
 # Track progress in multiprocessing
 def _track_job(job, update_interval=2):
     while job._number_left > 0:
         print("Jobs remaining = {0}".format(job._number_left * job._chunksize))
-        time.sleep(update_interval)
+        job.wait(update_interval) # returns early when all jobs are done
 
 
 # The main object in TMart
-class Tmart(Tmart2):
+class Tmart(Tmart2, TmartBatch, TmartSpectral):
     '''Create a Tmart object that does radiative transfer modelling. 
     
     Arguments:
@@ -69,7 +82,9 @@ class Tmart(Tmart2):
         # Atmosphere
         self.wl = None
         self.atm_profile_wl = None # single wavelength 
+        self.OT_profile_wl = None # cumulative OT of atm_profile_wl
         self.aerosol_SPF_wl = None 
+        self.SPF_wl = None # tabulated phase function of aerosol_SPF_wl 
         
         # Wind
         self.wind_speed = 3 # default 3 m/s
@@ -85,6 +100,25 @@ class Tmart(Tmart2):
         self.water_temperature = 25      
         self.water_refraIdx_wl = None # refractive index of water at this wavelength 
         
+        # Random numbers of a job, a numpy Generator 
+        self._rng = None
+        
+        # Photon engine, 'scalar' or 'batch'
+        self.engine = 'scalar'
+        self.streaming = False
+        self.hist_bins = None
+        
+        # Horizon of the DEM for shadows, see HorizonMap 
+        self.horizon_map = None
+        
+        # A Tmart of each wavelength in run_spectral 
+        self.spectral_wl = None
+        
+        # Russian roulette, None or [weight threshold, survival weight]
+        self.roulette = None
+        self._n_movement = 0
+        self._n_roulette = 0
+        
         # In development 
         self.output_flux = False # output irradiance reflectance, direct irradiance and diffuse irradiance on the ground, under development 
         
@@ -147,18 +181,15 @@ class Tmart(Tmart2):
             if target_coords[0]==target_coords[1]: target_coords[1]=target_coords[1]+0.0001
             
             # target_coords is 2d, target_coords3d includes elevation
-            target_coords3d = intersect_line_DEMtri2(np.array(target_coords + [120_000]), 
-                                                      np.array(target_coords + [0]), 
-                                                      self.Surface.DEM_triangulated)
+            target_coords3d = intersect_line_DEMgrid(np.array(target_coords + [120_000]), 
+                                                     np.array(target_coords + [0]), 
+                                                     self.Surface.DEM_grid)
             
             # If there is triangle intersection 
-            if target_coords3d.shape[0] > 0:
+            if target_coords3d is not None:
                 
-                # closest intersection # There seems to be only 1?
-                target_coords3d_chosen = target_coords3d.iloc[target_coords3d.linear_distance.idxmin()] 
-                
-                # print(target_coords3d)
-                q_collision = target_coords3d_chosen.tolist()[0:3]  
+                # closest intersection 
+                q_collision = target_coords3d.tolist()[0:3]  
                 q_elevation = q_collision[2]
    
             # Background collision
@@ -227,6 +258,10 @@ class Tmart(Tmart2):
             
             # Atmospheric profile and aerosol SPF
             self.atm_profile_wl, self.aerosol_SPF_wl = self.Atmosphere._wavelength(self.wl,band)
+            self.SPF_wl = PhaseFunction(self.aerosol_SPF_wl)
+            
+            # Cumulative OT of the profile, for OT between altitudes 
+            self.OT_profile_wl = OTProfile(self.atm_profile_wl)
             
             # Fraction and reflectance of whitecaps 
             self.F_wc_wl, self.R_wc_wl = find_R_wc(wl=self.wl, wind_speed = self.wind_speed)
@@ -234,23 +269,35 @@ class Tmart(Tmart2):
             # Water refractive index 
             self.water_refraIdx_wl = RefraIdx(self.water_salinity,self.water_temperature,self.wl)
             # self.water_refraIdx_wl = 1.34
+            
+            # Glint reflectance of flat water, made when needed 
+            self.glint_table_wl = None
 
 
     # User interface 
-    def run(self, wl, band = None, n_photon=10_000, nc='auto', njobs=100, print_on=False, output_flux=False): 
+    def run(self, wl, band = None, n_photon=10_000, nc='auto', njobs=100, print_on=False, output_flux=False, engine='scalar', streaming=False, hist_bins=None, pool=None, seed=None, target_error=None, roulette=None): 
         '''Run with multiple processing 
         
         Arguments:
 
         * ``wl`` -- wavelength in nm.
         * ``band`` -- overwrite ``wl`` with a 6S band object. We still need to specify ``wl`` because it is used in interpolating spectral SPF.
-        * ``n_photon`` -- number of photons to use in MC simulation, default 10,000.
+        * ``n_photon`` -- number of photons to use in MC simulation, default 10,000. The maximum number of photons with ``target_error``. 
         * ``nc`` -- number of CPU cores to use in multiprocessing, default automatic. 
         * ``njobs`` -- dividing the jobs into n portions in multiprocessing, default 80. 
+        * ``engine`` -- 'scalar': trace photons one at a time (default). 'batch': trace all photons of a job together as numpy arrays, faster with larger jobs. Results agree within Monte Carlo error. 
+        * ``streaming`` -- Boolean, default False. If True, each job reduces its movement information into running sums and only the sums are returned, memory does not grow with the number of photons. The output can be used in ``calc_ref``. 
+        * ``seed`` -- Seed of the random numbers, an integer. Each job draws from its own stream spawned from the seed, results are identical with the same seed, ``n_photon`` and ``njobs`` regardless of ``nc``. Default a random seed, printed in the run information. 
+        * ``pool`` -- A TmartPool to run the jobs in, its processes persist across runs. Default a pool kept by T-Mart for runs with the same ``nc``. 
+        * ``hist_bins`` -- Only with ``streaming``. [y_bins, x_bins] of a 2D histogram of environment contributions, as in np.histogram2d, returned as 'image_env'. 
+        * ``target_error`` -- Target relative standard error, e.g. 0.01. A number applies to R_total, a dictionary sets targets of any of 'R_atm', 'R_dir', 'R_env' and 'R_total'. Photons are run in rounds of ``njobs`` jobs, the error is estimated from the spread of the reflectances of the jobs, and the run stops when all targets are reached or after ``n_photon`` photons. Default None, run exactly ``n_photon`` photons. 
+        * ``roulette`` -- Russian roulette of photons of low weight, [weight threshold, survival weight] relative to the initial weight of a photon, or True for [0.01, 0.1]. After each movement, a photon below the threshold continues with a chance of its weight divided by the survival weight and carries the survival weight, otherwise it ends. Results stay unbiased with a little more variance, and fewer movements are traced. The numbers of movements and photons ended are printed, compare them with a run without roulette for the movements saved. Default None, photons end only when they leave the atmosphere. 
         
         Return:
 
-        * Movement information of photons.
+        * Movement information of photons, a numpy structured array with one record per movement, fields: pt_id, movement, L_cox-munk, L_whitecap, L_water, L_land, L_rayleigh, L_mie, x, y, z, shadowed, if_env and type (collision type code, see tm_tally). ``tmart.tm_tally.tally_to_array`` converts it to the float array of earlier versions. 
+        * With ``streaming``, a dictionary of sums: n_photon (photons with movement information), L_atm, L_dir, L_env and image_env, see ``tmart.tm_tally.tally_sum``. 
+        * With ``target_error``, a tuple of the results above and a dictionary: n_photon (number of photons fired, to be used in ``calc_ref``), error (achieved relative standard errors of R_atm, R_dir, R_env and R_total) and converged (whether the targets were reached). 
         
         Example usage::
 
@@ -265,26 +312,61 @@ class Tmart(Tmart2):
         self.print_on = print_on
         self.plot_on = False # don't even try it 
         self.output_flux = output_flux
+        self.streaming = streaming
+        self.hist_bins = hist_bins
         self._init_atm(band)
         
-        
-        if nc=='auto':
-            nc = cpu_count()
-        else:
-            nc = nc
+        if engine not in ['scalar', 'batch']: sys.exit("engine has to be 'scalar' or 'batch'")
+        
+        # Importance sampling is only in the scalar engine 
+        if engine == 'batch' and self.VROOM != 0:
+            print('WARNING: VROOM is not supported by the batch engine, using the scalar engine')
+            engine = 'scalar'
+        self.engine = engine
+        
+        if roulette is True: 
+            roulette = ROULETTE_DEFAULT
+        elif roulette is False: 
+            roulette = None
+        if roulette is not None:
+            if len(roulette) != 2 or not 0 < roulette[0] <= roulette[1]: 
+                sys.exit('roulette has to be [weight threshold, survival weight], 0 < threshold <= survival weight')
+            roulette = [float(roulette[0]), float(roulette[1])]
+        self.roulette = roulette
+        
+        if pool is None:
+            pool = default_pool(nc)
+        nc = pool.nc
             
         print("\n========= Initiating T-Mart =========")
-        print(f"Number of photons: {n_photon}")
+        if target_error is None:
+            print(f"Number of photons: {n_photon}")
+        else:
+            print(f"Maximum number of photons: {n_photon}")
         print(f'Using {nc} core(s)')
         
-        n = n_photon
+        # Adaptive number of photons: rounds of jobs until the target errors are reached 
+        if target_error is not None:
+            if not isinstance(target_error, dict): 
+                target_error = {'R_total': target_error}
+            for k in target_error:
+                if k not in ['R_atm', 'R_dir', 'R_env', 'R_total']: 
+                    sys.exit("target_error keys have to be 'R_atm', 'R_dir', 'R_env' or 'R_total'")
+            n_round = max(n_photon // ADAPTIVE_FIRST_ROUND, min(njobs * 100, n_photon))
+        else:
+            n_round = n_photon
         
-        # Split all photon IDs into numpy arrays 
-        part_count = [n/njobs for i in range(njobs)]
-        part_count = np.array_split(range(n_photon), njobs)
+        # Independent random streams of the jobs, spawned round after round 
+        seed_sequence = np.random.SeedSequence(seed)
         
         
         print(f"Number of job(s): {njobs}")
+        if target_error is not None:
+            print('Target relative error: ' + str(target_error))
+        print('Photon engine: ' + str(self.engine))
+        if roulette is not None:
+            print('Russian roulette: ' + str(roulette))
+        print('Random seed: ' + str(seed_sequence.entropy))
         print('Wavelength: ' + str(self.wl) + ' nm')
         print('Aerosol type: ' + str(self.Atmosphere.aerosol_type))
         print('AOT at 550 nm: ' + str(self.Atmosphere.aot550)) 
@@ -293,25 +375,191 @@ class Tmart(Tmart2):
         print("=====================================")
         
 
-        pool = ProcessingPool(processes=nc)
-        time.sleep(0.5)
+        # The horizon map goes to the workers with the Tmart object 
+        if self.shadow: self._horizon_map()
         
-        # manual print 
-        results_temp = pool.amap(self._run,part_count) # Async
+        # The Tmart object goes to the workers once, jobs are ranges of photon IDs 
+        self._rng = None
+        key = pool.ship(self)
         
-        if njobs>1:
-            _track_job(results_temp)
+        results = [] # outputs of all jobs
+        tallies, n_photons = [], [] # sums and numbers of photons of all jobs, for the errors 
+        n_done = 0
+        n_movement, n_roulette = 0, 0 # movements traced and photons ended by Russian roulette 
         
-        results = results_temp.get()
-        results = np.vstack(results)
+        while True:
+            
+            # Split photon IDs of the round into numpy arrays 
+            part_count = np.array_split(range(n_done, n_done + n_round), njobs)
+            seeds = seed_sequence.spawn(njobs)
+            
+            tasks = [(part[0], part[-1]+1, seeds[i]) if len(part) > 0 else (0, 0, seeds[i]) for i, part in enumerate(part_count)]
+            results_temp = pool.amap(key, tasks) # Async
+            
+            if njobs>1:
+                _track_job(results_temp)
+            
+            results_round = results_temp.get()
+            n_movement += sum(r[1] for r in results_round)
+            n_roulette += sum(r[2] for r in results_round)
+            results_round = [r[0] for r in results_round]
+            results += results_round
+            n_done += n_round
+            
+            if target_error is None: break
+        
+            tallies += [r if self.streaming else tally_sum(r) for r in results_round]
+            n_photons += [len(part) for part in part_count]
+            error = tally_error(tallies, n_photons)
+            
+            # Worst ratio of achieved to target error 
+            ratio = max(error[k] / target_error[k] for k in target_error)
+            print('Photons: {}, relative error: {}'.format(n_done, {k: round(float(error[k]), 5) for k in target_error}))
+            
+            if ratio <= 1 or n_done >= n_photon: break
+            
+            # Error decreases with the square root of the number of photons 
+            if np.isfinite(ratio):
+                n_round = int(n_done * (ratio**2 - 1) * 1.1) + njobs
+            else:
+                n_round = n_photon
+            n_round = min(n_round, n_photon - n_done)
+        
+        print('Movements traced: {} ({:.2f} per photon)'.format(n_movement, n_movement / max(n_done, 1)))
+        if roulette is not None:
+            print('Photons ended by Russian roulette: ' + str(n_roulette))
+        
+        if self.streaming:
+            results = tally_merge(results)
+        else:
+            results = np.concatenate(results)
+            
+        if target_error is not None:
+            if ratio > 1: 
+                print('WARNING: target error not reached with the maximum number of photons, ' + str(n_photon))
+            return results, {'n_photon': n_done, 'error': error, 'converged': bool(ratio <= 1)}
 
         return results 
 
         
+    def run_spectral(self, wls, bands = None, n_photon=10_000, nc='auto', njobs=100, reflectance=None, bg_ref=None, streaming=False, hist_bins=None, pool=None, seed=None): 
+        '''Run several wavelengths with the same photons. Paths are traced once and weighted for the atmosphere, aerosol SPF, surface reflectance and water refractive index of each wavelength, so that the cost hardly grows with the number of wavelengths and the noise is correlated between them. 
+        
+        Arguments:
+
+        * ``wls`` -- A list of wavelengths in nm.
+        * ``bands`` -- A list of 6S band objects overwriting ``wls``, as ``band`` in ``run``. 
+        * ``reflectance`` -- A list of the surface reflectance at each wavelength, numpy arrays of the shape of the reflectance of the Surface, or numbers. Default the reflectance of the Surface at all wavelengths. 
+        * ``bg_ref`` -- A list of the background reflectance at each wavelength, a number or a list of two numbers as in ``set_background``. Default the background reflectance of the Surface at all wavelengths. 
+        * ``n_photon``, ``nc``, ``njobs``, ``streaming``, ``hist_bins``, ``pool``, ``seed`` -- As in ``run``. 
+        
+        Paths are sampled with the largest Rayleigh and aerosol OTs of the wavelengths in each layer, and the aerosol SPF of the middle wavelength. A wavelength far from the others has larger errors than in its own run. VROOM is not used. 
+        
+        Return:
+
+        * A list of the results of each wavelength, as in ``run``, to be used in ``calc_ref``. 
+        
+        Example usage::
+
+          wls = [400, 500, 600, 700]
+          water = tmart.SpectralSurface('water_chl1')
+          results = my_tmart.run_spectral(wls, n_photon=10_000, bg_ref=[water.wl(wl) for wl in wls])
+          R = [tmart.calc_ref(r, n_photon=10_000) for r in results]
+          
+        '''
+        
+        if bands is None: bands = [None] * len(wls)
+        if reflectance is None: reflectance = [self.Surface.reflectance] * len(wls)
+        if bg_ref is None: bg_ref = [self.Surface.bg_ref] * len(wls)
+        if not len(bands) == len(reflectance) == len(bg_ref) == len(wls): 
+            sys.exit('bands, reflectance and bg_ref have to be lists with one item per wavelength')
+        
+        if self.VROOM != 0:
+            print('WARNING: VROOM is not supported by run_spectral, not used')
+        
+        self.wl = wls[len(wls)//2]
+        self.print_on = False 
+        self.plot_on = False 
+        self.output_flux = False
+        self.streaming = streaming
+        self.hist_bins = hist_bins
+        self.roulette = None
+        self.engine = 'spectral'
+        if self.shadow: self._horizon_map()
+        self._init_spectral(wls, bands, reflectance, bg_ref)
+        
+        if pool is None:
+            pool = default_pool(nc)
+        nc = pool.nc
+        seed_sequence = np.random.SeedSequence(seed)
+        
+        print("\n========= Initiating T-Mart =========")
+        print(f"Number of photons: {n_photon}")
+        print(f'Using {nc} core(s)')
+        print(f"Number of job(s): {njobs}")
+        print('Random seed: ' + str(seed_sequence.entropy))
+        print('Wavelengths: ' + str(list(wls)) + ' nm')
+        print('Aerosol type: ' + str(self.Atmosphere.aerosol_type))
+        print('AOT at 550 nm: ' + str(self.Atmosphere.aot550)) 
+        print('Photon\'s initial direction: ' + str( np.round(self.target_pt_direction,2) ))
+        print('Solar angle: ' + str( np.round(self.sun_dir, 2) ))
+        print("=====================================")
+        
+        self._rng = None
+        key = pool.ship(self)
+        
+        part_count = np.array_split(range(n_photon), njobs)
+        seeds = seed_sequence.spawn(njobs)
+        tasks = [(part[0], part[-1]+1, seeds[i]) if len(part) > 0 else (0, 0, seeds[i]) for i, part in enumerate(part_count)]
+        results_temp = pool.amap(key, tasks) 
+        
+        if njobs>1:
+            _track_job(results_temp)
+        
+        results_jobs = results_temp.get()
+        n_movement = sum(r[1] for r in results_jobs)
+        print('Movements traced: {} ({:.2f} per photon)'.format(n_movement, n_movement / max(n_photon, 1)))
+        
+        # Jobs of each wavelength 
+        results = []
+        for k in range(len(wls)):
+            if self.streaming:
+                results.append(tally_merge([r[0][k] for r in results_jobs]))
+            else:
+                results.append(np.concatenate([r[0][k] for r in results_jobs]))
+        
+        return results
+        
+        
+    # A job in a worker of TmartPool: photon IDs from start to stop, seed of the random stream 
+    # Returns the output of the job, the number of movements and of photons ended by Russian roulette 
+    def _run_task(self, start, stop, seed):
+        output = self._run(np.arange(start, stop), np.random.default_rng(seed))
+        return output, self._n_movement, self._n_roulette
+    
     # Distribute runs to processors     
-    def _run(self,part_count):
+    def _run(self,part_count, rng=None):
+        
+        self._rng = rng if rng is not None else np.random.default_rng()
+        self._n_movement, self._n_roulette = 0, 0
+        
+        if self.engine == 'spectral':
+            return self._run_spectral(part_count)
+        
+        if self.engine == 'batch':
+            pts_stat = self._run_batch(part_count)
+            if self.streaming: 
+                return tally_sum(pts_stat, self.hist_bins)
+            return pts_stat
     
-        pts_stat = np.empty([0,13])
+        # Preallocated records of the job, grow when full 
+        # In streaming mode, a fixed buffer reduced to running sums when full 
+        if self.streaming:
+            pts_stat = tally_empty(STREAMING_BUFFER)
+            tally = tally_sum(pts_stat[:0], self.hist_bins)
+        else:
+            pts_stat = tally_empty(len(part_count) * 4)
+        n_stat = 0
         
         for i in part_count:
             
@@ -319,12 +567,24 @@ class Tmart(Tmart2):
                 print("\n---------- Running Photon " + str(i) + " ----------")
             
             pt_stat = self._run_single_photon(i)
-            pts_stat = np.vstack([pts_stat, pt_stat])
+            
+            if n_stat + len(pt_stat) > len(pts_stat):
+                if self.streaming:
+                    tally = tally_merge([tally, tally_sum(pts_stat[:n_stat], self.hist_bins)])
+                    n_stat = 0
+                else:
+                    pts_stat = np.concatenate([pts_stat, tally_empty(max(len(pts_stat), len(pt_stat)))])
+            
+            pts_stat[n_stat:n_stat+len(pt_stat)] = pt_stat
+            n_stat += len(pt_stat)
+        
+        if self.streaming:
+            return tally_merge([tally, tally_sum(pts_stat[:n_stat], self.hist_bins)])
       
-        return pts_stat
+        return pts_stat[:n_stat]
     
     
-    def run_plot(self, wl, band = None, plot_on=True, plot_range=[0,100_000,0,100_000,0,100_000]): 
+    def run_plot(self, wl, band = None, plot_on=True, plot_range=[0,100_000,0,100_000,0,100_000], seed=None): 
         '''Run a single photon and plot, print the details of photon movements. 
         To observe the photon movements, mostly for debugging purposes. 
         
@@ -334,6 +594,7 @@ class Tmart(Tmart2):
         * ``band`` -- overwrite ``wl`` with a 6S band object. We still need to specify ``wl`` because it is used in interpolating spectral SPF.
         * ``plot_on`` -- Boolean, if plot the movements. 
         * ``plot_range`` -- List, [xmin, xmax, ymin, ymax, zmin, zmax]
+        * ``seed`` -- Seed of the random numbers, an integer. Default random. 
         
         Return:
 
@@ -350,5 +611,6 @@ class Tmart(Tmart2):
         self.plot_on = plot_on  # Default plot, may turn off 
         self.plot_range = plot_range
         self._init_atm(band)
+        self._rng = np.random.default_rng(seed)
         
         return self._run_single_photon(0)
@@ -15,24 +15,16 @@
 
 import sys
 import numpy as np
-import pandas as pd
-import random
 import math
-from scipy.interpolate import interp1d
 from copy import copy
 
 from .tm_move import pt_move
-from .tm_OT import find_OT
 from .tm_sampling import sample_Lambertian, sample_scattering, weight_impSampling
 from .tm_geometry import dirP_to_coord, dirC_to_dirP, rotation_matrix, angle_3d, dirC_to_coord
-from .tm_intersect import find_atm2, intersect_line_DEMtri2
+from .tm_intersect import find_atm2, intersect_line_surface, HorizonMap
 from .tm_intersect import reflectance_intersect, reflectance_background, intersect_background
-from .tm_water import fresnel, sample_cox_munk, find_R_cm
-
-# Plotting 
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
-from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+from .tm_water import fresnel, sample_cox_munk, find_R_cm, GlintTable
+from .tm_tally import tally_empty, tally_L, TYPE_CODES, TYPE_W, TYPE_WS, TYPE_L
 
 # The class is overwritten in Tmart 
 class Tmart2(): 
@@ -47,22 +39,25 @@ class Tmart2():
         if self.print_on: print("\n------- Movement 1 -------")
         
         # numpy atmospheric profile, to runs faster 
-        atm_profile = self.atm_profile_wl.sort_values('Alt_bottom').to_numpy()
+        atm_profile = self.OT_profile_wl.atm_profile
+        
+        # Random numbers of the job, a numpy Generator 
+        rng = self._rng
         
         # Initial position of the photon 
         if self.pixel == None:
             q0 = self.sensor_coords
         else:
-            pixel_x = self.Surface.cell_size * (self.pixel[1] + random.random()) # X
-            pixel_y = self.Surface.cell_size * (self.pixel[0] + random.random()) # Y
+            pixel_x = self.Surface.cell_size * (self.pixel[1] + rng.random()) # X
+            pixel_y = self.Surface.cell_size * (self.pixel[0] + rng.random()) # Y
             q0 = self.sensor_coords + [pixel_x,pixel_y,self.pixel_elevation]
             
         # Initial moving direction of the photon
         
         if self.target_pt_direction == 'lambertian_up': 
-            pt_direction = sample_Lambertian()[1]
+            pt_direction = sample_Lambertian(rng)[1]
         elif self.target_pt_direction == 'lambertian_down': 
-            pt_direction = sample_Lambertian()[1]
+            pt_direction = sample_Lambertian(rng)[1]
             pt_direction[0] = pt_direction[0] + 90
         else:
             pt_direction = self.target_pt_direction
@@ -77,17 +72,23 @@ class Tmart2():
                          self.Surface.bg_ref[0]==0 and self.Surface.bg_ref[1]==0 and 
                          self.Surface.bg_isWater[0]==0 and self.Surface.bg_isWater[1]==0)
         
-        # A numpy array to collect information, here 14 columns, local_estimate has 14 too, output only 13
-        pt_stat = np.empty((0,14))     
+        # Russian roulette, weights relative to the initial weight 
+        if self.roulette is not None:
+            roulette_threshold = self.roulette[0] * 1_000_000
+            roulette_weight = self.roulette[1] * 1_000_000
+        
+        # Typed records to collect information, one per movement, see tm_tally 
+        pt_stat = tally_empty(500)
+        n_stat = 0
         
         ### For loop: photon movements 
         for movement in range(0, 500): 
             
             # sample an optical thickness 
-            sampled_tao = -math.log(random.random())
+            sampled_tao = -math.log(1.0 - rng.random())
             
             # after moving the sampled_tao, the properties of the photon and the atmosphere layer 
-            q1, tao_abs, ot_rayleigh_NA, ot_mie_NA, out = pt_move(atm_profile,q0,pt_direction,sampled_tao)
+            q1, tao_abs, ot_rayleigh_NA, ot_mie_NA, out = pt_move(self.OT_profile_wl,q0,pt_direction,sampled_tao)
             # note: ot_rayleigh and ot_mie are replaced later, the accumulated ot should not be used, thus add _NA to mask them
     
             if self.print_on:
@@ -101,12 +102,12 @@ class Tmart2():
             ### Test triangle collision             
 
             # If the two ends of the movement are both above the max elevation of the DEM, skip the test
-            if self.Surface.DEM.max() < q0[2] and self.Surface.DEM.max() < q1[2]:
-                intersect_tri = pd.DataFrame()  
+            if self.Surface.DEM_max < q0[2] and self.Surface.DEM_max < q1[2]:
+                intersect_tri = None  
                 
             else:
-                # intersect_tri = intersect_line_DEMtri(q0, q1, self.Surface.DEM_triangulated, self.print_on)      
-                intersect_tri = intersect_line_DEMtri2(q0, q1, self.Surface.DEM_triangulated, self.print_on)      
+                # intersect_tri = intersect_line_DEMtri2(q0, q1, self.Surface.DEM_triangulated, self.print_on)      
+                intersect_tri = intersect_line_surface(q0, q1, self.Surface)      
             
             
             ###### Three scenarios 
@@ -117,7 +118,7 @@ class Tmart2():
             
             
             # If there is triangle intersection 
-            if intersect_tri.shape[0] > 0:
+            if intersect_tri is not None:
                 if self.print_on: print ("\nScenario 1: Triangle collision")
                 scenario = 1
             
@@ -148,14 +149,14 @@ class Tmart2():
                 
                 rotated_cm = None
                 
-                # Find triangle with the shortest distance and the exact collision point
-                intersect_tri_chosen = intersect_tri.iloc[intersect_tri.linear_distance.idxmin()] 
+                # The closest triangle and the exact collision point
+                intersect_tri_chosen = intersect_tri 
                 q_collision = intersect_tri_chosen.tolist()[0:3]  
                 
                 if self.print_on: print('Collision position: ' + str(q_collision))    
                 
                 # Re-calculate absorption 
-                tao_abs = find_OT(q0,q_collision,atm_profile)
+                tao_abs = self.OT_profile_wl.abs_between(q0[2], q_collision[2])
                 tao_abs = tao_abs / abs(math.cos(pt_direction[0]/180*math.pi))  
                 
                 # Avoid intersecting again
@@ -169,21 +170,19 @@ class Tmart2():
                     print("\nNormal to collision: " + str(q_collision_N))
                     print("Normal to collision polar: " + str(q_collision_N_polar))                
                 
-                # Find the reflectance at the collision point 
-                q_collision_ref = reflectance_intersect(q_collision, self.Surface.reflectance, 
-                                                        self.Surface.cell_size, self.Surface.bg_ref, 
-                                                        self.Surface.bg_coords)
-                if self.print_on: print("Reflectance at collision position: " + str(q_collision_ref))    
-                
-            
-                ### If water --> there is a chance of specular reflectance             
-                # Chance is determined by Fresnel, pt_weight stays as 1
+                # Find the reflectance at the collision point, and if it's water
+                # Chance of specular reflectance is determined by Fresnel, pt_weight stays as 1
                 # Use pt_direction, q_collision_N and Cox-Munk to calculate the new pt_direction 
-                
-                # Test if it's water at the collision point 
-                q_collision_isWater = reflectance_intersect(q_collision, self.Surface.isWater, 
-                                                            self.Surface.cell_size, self.Surface.bg_isWater, 
-                                                            self.Surface.bg_coords)    
+                if self.Surface.homogeneous is not None:
+                    q_collision_ref, q_collision_isWater = self.Surface.homogeneous
+                else:
+                    q_collision_ref = reflectance_intersect(q_collision, self.Surface.reflectance, 
+                                                            self.Surface.cell_size, self.Surface.bg_ref, 
+                                                            self.Surface.bg_coords)
+                    q_collision_isWater = reflectance_intersect(q_collision, self.Surface.isWater, 
+                                                                self.Surface.cell_size, self.Surface.bg_isWater, 
+                                                                self.Surface.bg_coords)    
+                if self.print_on: print("Reflectance at collision position: " + str(q_collision_ref))    
                 if self.print_on: print('\nIf surface is water: '+str(q_collision_isWater))
                 
     
@@ -202,11 +201,11 @@ class Tmart2():
                     while in_angle>90: 
                     
                         # Use Cox-munk to draw a normal, output polar coordinates 
-                        random_cox_munk = sample_cox_munk(self.wind_speed, self.wind_dir)
+                        random_cox_munk = sample_cox_munk(self.wind_speed, self.wind_dir, rng)
                         
                         # Azimuthally averaged sampling 
                         if self.wind_azi_avg:
-                            random_cox_munk2 = sample_cox_munk(self.wind_speed, self.wind_dir+90)
+                            random_cox_munk2 = sample_cox_munk(self.wind_speed, self.wind_dir+90, rng)
                             random_cox_munk = (random_cox_munk + random_cox_munk2) / 2
                         
                         
@@ -232,7 +231,7 @@ class Tmart2():
                     q_collision_ref = R_surf + (1-self.F_wc_wl) * q_collision_ref
                     
                     # If chance (R_specular) out of q_collision_ref, siwtch on specular_on
-                    specular_on = random.uniform(0,q_collision_ref) < R_specular
+                    specular_on = rng.uniform(0,q_collision_ref) < R_specular
                     # specular_on = True # for testing
                     
                     if self.print_on: 
@@ -264,7 +263,7 @@ class Tmart2():
                     
                     # Sample a direction and tilt it to the surface normal 
     
-                    random_lambertian = sample_Lambertian()
+                    random_lambertian = sample_Lambertian(rng)
     
                     # axis is azimuthal, clockwise 90 degrees
                     axis = [math.cos((q_collision_N_polar[1]+90)*math.pi/180),
@@ -298,7 +297,7 @@ class Tmart2():
                 if self.print_on: print('Collision position: ' + str(q_collision))  
                 
                 # re-calculate absorption 
-                tao_abs = find_OT(q0,q_collision,atm_profile)
+                tao_abs = self.OT_profile_wl.abs_between(q0[2], q_collision[2])
                 tao_abs = tao_abs / abs(math.cos(pt_direction[0]/180*math.pi))                
                   
                 # Avoid intersecting again
@@ -311,9 +310,12 @@ class Tmart2():
                     print("Reflectance at collision position: " + str(q_collision_ref))
                 
                 # Test if it's water at the collision point 
-                q_collision_isWater = reflectance_intersect(q_collision, self.Surface.isWater, 
-                                                            self.Surface.cell_size, self.Surface.bg_isWater, 
-                                                            self.Surface.bg_coords)    
+                if self.Surface.homogeneous is not None:
+                    q_collision_isWater = self.Surface.homogeneous[1]
+                else:
+                    q_collision_isWater = reflectance_intersect(q_collision, self.Surface.isWater, 
+                                                                self.Surface.cell_size, self.Surface.bg_isWater, 
+                                                                self.Surface.bg_coords)    
                 if self.print_on: print('\nIf surface is water: '+str(q_collision_isWater))                    
                 specular_on = False
                 
@@ -329,11 +331,11 @@ class Tmart2():
                     while in_angle>90: 
                         
                         # Use Cox-munk to draw a normal, no need for rotation
-                        random_cox_munk = sample_cox_munk(self.wind_speed, self.wind_dir)
+                        random_cox_munk = sample_cox_munk(self.wind_speed, self.wind_dir, rng)
                         
                         # Azimuthally averaged sampling 
                         if self.wind_azi_avg:
-                            random_cox_munk2 = sample_cox_munk(self.wind_speed, self.wind_dir+90)
+                            random_cox_munk2 = sample_cox_munk(self.wind_speed, self.wind_dir+90, rng)
                             random_cox_munk = (random_cox_munk + random_cox_munk2) / 2                        
                                        
                         # incident angle to calculate Fresnel reflectance 
@@ -346,7 +348,7 @@ class Tmart2():
                     q_collision_ref = R_surf + (1-self.F_wc_wl) * q_collision_ref
                     
                     # if chance (R_specular) out of q_collision_ref, siwtch on specular_on
-                    specular_on = random.uniform(0,q_collision_ref) < R_specular
+                    specular_on = rng.uniform(0,q_collision_ref) < R_specular
       
                     if self.print_on: 
                         print('random_cox_munk: ' + str(random_cox_munk))
@@ -372,7 +374,7 @@ class Tmart2():
                 # else lambertian 
                 else: 
                     # pt_direction = dirC_to_dirP(sample_Lambertian()[0])[0:2] # the line below can be faster???
-                    pt_direction = sample_Lambertian()[1]
+                    pt_direction = sample_Lambertian(rng)[1]
                     tpye_collision = 'W'
                         
                 if self.print_on: print("Photon weight before absorption: " + str(pt_weight))               
@@ -387,22 +389,22 @@ class Tmart2():
                 pt_direction_op_C = np.negative(dirP_to_coord(1, pt_direction))
                 
                 # regular sampling  
-                if random.random() >= self.VROOM:
+                if rng.random() >= self.VROOM:
                     if self.print_on: print('\n== Regular Sampling ==')  
-                    pt_direction, scatt_intensity, type_scat = sample_scattering(ot_mie, ot_rayleigh, pt_direction, self.aerosol_SPF_wl, self.print_on)
+                    pt_direction, scatt_intensity, type_scat = sample_scattering(ot_mie, ot_rayleigh, pt_direction, self.SPF_wl, self.print_on, rng)
     
                 # importance sampling 
                 else:
                     if self.print_on: print('\n== Importance Sampling ==')  
                     
                     # Force mie scattering when importance sampling 
-                    pt_direction, scatt_intensity, type_scat = sample_scattering(1, 0, self.sun_dir, self.Atmosphere.aerosol_SPF, self.print_on)
+                    pt_direction, scatt_intensity, type_scat = sample_scattering(1, 0, self.sun_dir, self.SPF_wl, self.print_on, rng)
                     
                     
                     # angle between the old direction and the importance-sampled direction --> Scattering angle 
                     angle_impSampling = angle_3d(dirP_to_coord(1,pt_direction), [0,0,0], pt_direction_op_C)
                     
-                    scatt_intensity_impSampling = weight_impSampling(ot_mie,ot_rayleigh,angle_impSampling,self.Atmosphere.aerosol_SPF, self.print_on)
+                    scatt_intensity_impSampling = weight_impSampling(ot_mie,ot_rayleigh,angle_impSampling,self.SPF_wl, self.print_on, rng)
                     
                     if self.print_on: print("  pt_weight before adjustment: " + str(pt_weight))
                     if self.print_on: print("  adjustment factor: " + str(scatt_intensity_impSampling/scatt_intensity))
@@ -456,7 +458,8 @@ class Tmart2():
                 
                 if if_shadow: local_est[11] = 1
                 if self.print_on: print("local_est: " + str(local_est))
-                pt_stat = np.vstack([pt_stat, local_est])     
+                pt_stat[n_stat] = tuple(local_est[0:13]) + (TYPE_CODES[local_est[13]],)
+                n_stat += 1
                 
             # Scattering 
             if scenario == 3 and out == False:
@@ -467,7 +470,8 @@ class Tmart2():
                 local_est = [pt_id, movement,0,0,0,0] + le_scatt + q_collision.tolist() + [0,0,type_scat]
                 if if_shadow: local_est[11] = 1
                 if self.print_on: print("local_est: " + str(local_est))
-                pt_stat = np.vstack([pt_stat, local_est])            
+                pt_stat[n_stat] = tuple(local_est[0:13]) + (TYPE_CODES[local_est[13]],)
+                n_stat += 1
             
             
             ###### Plot and out 
@@ -485,6 +489,17 @@ class Tmart2():
             if out:
                 if self.print_on: print('\nPhoton out of atmosphere \n')
                 break
+            
+            # Russian roulette: a photon of low weight survives with a chance of pt_weight/roulette_weight, 
+            # carrying roulette_weight, so the expected weight is unchanged 
+            if self.roulette is not None and pt_weight < roulette_threshold:
+                if rng.random() * roulette_weight < pt_weight:
+                    pt_weight = roulette_weight
+                    if self.print_on: print('\nRussian roulette, photon survives with weight: ' + str(pt_weight))
+                else:
+                    if self.print_on: print('\nRussian roulette, photon ended \n')
+                    self._n_roulette += 1
+                    break
         
             if self.print_on: print("\n------- Movement {} -------".format(movement+2))  
             # the last print won't show because the code breaks above
@@ -493,7 +508,9 @@ class Tmart2():
             # starting the next movement at the collision         
             q0 = q_collision
         
-        pt_stat = self._diff_ref(pt_stat)
+        self._n_movement += movement + 1
+        
+        pt_stat = self._diff_ref(pt_stat[:n_stat])
         
         # return np.array([surface_irradiance]) # for surface_irradiance 
         return pt_stat
@@ -502,78 +519,68 @@ class Tmart2():
     # Differentiate reflectances
     def _diff_ref (self,pt_stat):
         
-        pt_stat_num = pt_stat[:,0:13].astype(float)
-        moves = pt_stat_num[:,1].astype(int)
+        moves = pt_stat['movement']
         
         if not np.all(np.diff(moves) > 0): # check if sorted 
             sys.exit('pt movement has to be sorted')
+        
+        # L_cox-munk, L_whitecap, L_water, L_land, L_rayleigh, L_mie
+        pt_L = tally_L(pt_stat)
             
-        pt_stat_output = np.empty((0,13))   
-            
-        for move in moves:
-            
-            # Entire row 
-            pt_movement = copy( pt_stat_num[move == moves,:] )
+        for i in range(len(pt_stat)):
             
             # Type of collision 
-            t_c = pt_stat[pt_stat[:,1] == str(move), 13].item()
+            t_c = pt_stat['type'][i]
             
-            if t_c=='W' or t_c=='L':
+            if t_c==TYPE_W or t_c==TYPE_L:
                 # Adding all after to L_whitecap, L_water, L_land
                 
                 # Total lambertian in a single row 
-                total = np.sum(pt_movement[0][3:6])
+                total = np.sum(pt_L[i,1:4])
                 
-                # If surface is black, quit loop to speed up calculation 
+                # If surface is black, drop it and all after 
                 if total == 0: 
-                    break
+                    return pt_stat[:i]
         
                 # Identify all movements after that contribute to this 
-                pt_mov_after = pt_stat_num[move+1:,:]
-                pt_mov_after_nonShadow = pt_mov_after[pt_mov_after[:,11]==0]
-                sum_after = np.sum(pt_mov_after_nonShadow[:,2:8])
+                nonShadow = pt_stat['shadowed'][i+1:] == 0
+                sum_after = np.sum(pt_L[i+1:][nonShadow])
               
                 # Ratios: whitecap, water and land 
-                r_wc    = pt_movement[0][3]/ total 
-                r_water = pt_movement[0][4]/ total 
-                r_land  = pt_movement[0][5]/ total 
+                r_wc    = pt_L[i,1]/ total 
+                r_water = pt_L[i,2]/ total 
+                r_land  = pt_L[i,3]/ total 
                 
                 # We calculate ratio before setting shadowed 'total' to 0
-                if pt_movement[0][11] == 1: total = 0
+                if pt_stat['shadowed'][i] == 1: total = 0
                 
                 total_new = total + sum_after
-            
-                pt_movement[0][3] = total_new * r_wc
-                pt_movement[0][4] = total_new * r_water
-                pt_movement[0][5] = total_new * r_land
                 
-                # Add to the main numpy array 
-                pt_stat_output = np.vstack([pt_stat_output, pt_movement])
+                pt_stat_output = pt_stat[:i+1].copy()
+                pt_stat_output['L_whitecap'][i] = total_new * r_wc
+                pt_stat_output['L_water'][i]    = total_new * r_water
+                pt_stat_output['L_land'][i]     = total_new * r_land
                 
-                break 
+                return pt_stat_output
             
-            elif t_c=='Ws':    
+            elif t_c==TYPE_WS:    
                 # Adding all after to L_coxmunk
                 
-                pt_mov_after = pt_stat_num[move+1:,:]
-                pt_mov_after_nonShadow = pt_mov_after[pt_mov_after[:,11]==0]
-                sum_after = np.sum(pt_mov_after_nonShadow[:,2:8])       
+                nonShadow = pt_stat['shadowed'][i+1:] == 0
+                sum_after = np.sum(pt_L[i+1:][nonShadow])
                 
-                if pt_movement[0][11] == 1: # shadow
+                if pt_stat['shadowed'][i] == 1: # shadow
                     total = 0
                 else:
-                    total = pt_movement[0][2]
-                
-                pt_movement[0][2] = total + sum_after
+                    total = pt_L[i,0]
                 
-                pt_stat_output = np.vstack([pt_stat_output, pt_movement])
+                pt_stat_output = pt_stat[:i+1].copy()
+                pt_stat_output['L_cox-munk'][i] = total + sum_after
                 
-                break         
+                return pt_stat_output
                 
-            # If rayleigh or mie 
-            pt_stat_output = np.vstack([pt_stat_output, pt_movement])
-            
-        return pt_stat_output
+        # Only rayleigh or mie 
+        return pt_stat
         
     def local_est_scat(self,pt_direction_op_C,q_collision, pt_weight, ot_mie, ot_rayleigh):
         
@@ -598,10 +605,7 @@ class Tmart2():
         rayleigh_c = rayleigh_c * (ot_rayleigh/ot_scattering)
     
         # mie
-        df_angle = self.aerosol_SPF_wl.Angle.to_numpy()
-        df_value = self.aerosol_SPF_wl.Value.to_numpy()
-        f2 = interp1d(df_angle, df_value, kind='cubic')
-        mie = f2(angle_scattering).item()
+        mie = self.SPF_wl.value(angle_scattering).item()
         
         mie_c = mie / math.cos(self.sun_dir[0]/180*math.pi) / 4 # / math.pi   
         mie_c = mie_c * (ot_mie/ot_scattering)
@@ -625,16 +629,21 @@ class Tmart2():
         R_wc = self.R_wc_wl
         
         # Cox-Munk and Fresnel, this one tells us nothing about the actual flux reflectance!
-        R_cm = find_R_cm(pt_direction_op_C, self.sun_dir, q_collision_N_polar, 
-                         self.wind_dir, self.wind_speed, self.water_refraIdx_wl, self.print_on)
+        # Flat water from the table of the run, azimuthally averaged if needed 
+        if q_collision_N_polar[0] == 0 and not self.print_on:
+            R_cm = self._glint_table().value(pt_direction_op_C)
         
-        # Average = (regular + wind 90 degrees) / 2
-        if self.wind_azi_avg:
-            if self.print_on: print ('\nSampling R_cm again for azimuthally averaged values')
+        else:
+            R_cm = find_R_cm(pt_direction_op_C, self.sun_dir, q_collision_N_polar, 
+                             self.wind_dir, self.wind_speed, self.water_refraIdx_wl, self.print_on)
             
-            R_cm2 = find_R_cm(pt_direction_op_C, self.sun_dir, q_collision_N_polar, 
-                              self.wind_dir + 90, self.wind_speed, self.water_refraIdx_wl, self.print_on)
-            R_cm = (R_cm + R_cm2) / 2
+            # Average = (regular + wind 90 degrees) / 2
+            if self.wind_azi_avg:
+                if self.print_on: print ('\nSampling R_cm again for azimuthally averaged values')
+                
+                R_cm2 = find_R_cm(pt_direction_op_C, self.sun_dir, q_collision_N_polar, 
+                                  self.wind_dir + 90, self.wind_speed, self.water_refraIdx_wl, self.print_on)
+                R_cm = (R_cm + R_cm2) / 2
             
         R_cm = (1-self.F_wc_wl) * R_cm # remove whitecaps from cox-munk reflection 
         if self.print_on:print('\nFinal cox_munk reflectance: '+str(R_cm))
@@ -662,15 +671,36 @@ class Tmart2():
         return local_est.tolist()
            
     
+    # Glint reflectance of flat water in this run, tabulated at the first water collision 
+    def _glint_table(self):
+        if self.glint_table_wl is None:
+            self.glint_table_wl = GlintTable(self.sun_dir, self.wind_dir, self.wind_speed, 
+                                             self.water_refraIdx_wl, self.wind_azi_avg)
+        return self.glint_table_wl
+    
+    
+    # Horizon of the DEM for the sun of this run, rebuilt when the DEM or the sun changes 
+    def _horizon_map(self):
+        if (self.horizon_map is None or self.horizon_map.DEM_grid is not self.Surface.DEM_grid or 
+            self.horizon_map.sun_dir != list(self.sun_dir)):
+            self.horizon_map = HorizonMap(self.Surface.DEM_grid, self.sun_dir)
+        return self.horizon_map
+    
+    
     # If the path between a point and the sun is blocked 
     def detect_shadow(self, q_collision):
         
+        # Points above the horizon are lit, others are tested along the path 
+        if self._horizon_map().lit(q_collision):
+            if self.print_on: print ('\nIf shaded: False, above the horizon')
+            return False
+        
         dist_120000 = (120_000 - q_collision[2]) / np.cos(self.sun_dir[0]/180*np.pi) 
         q_sun = dirP_to_coord(dist_120000, self.sun_dir) + q_collision
         
-        intersect_tri = intersect_line_DEMtri2(q_collision, q_sun, self.Surface.DEM_triangulated, self.print_on)  
+        intersect_tri = intersect_line_surface(q_collision, q_sun, self.Surface)  
         
-        if_shadow = intersect_tri.shape[0] > 0
+        if_shadow = intersect_tri is not None
         
         if self.print_on: print ('\nIf shaded: ' +str(if_shadow))
         
@@ -679,45 +709,14 @@ class Tmart2():
 
     # finds OT between TOA and z
     def _local_est_OT(self,q_collision): 
-        
-        # Altitude of the collision point  
-        z = q_collision[2]
- 
-        # Find all layers whose bottoms are equal to or higher than z, panda series Boolean 
-        alts_higher = np.array(self.atm_profile_wl.Alt_bottom *1000 >= z)
-
-        # Calculate OTs in layers above, capital is output 
-        OT_out = (sum(self.atm_profile_wl.ot_abs[alts_higher]) +  
-                      sum(self.atm_profile_wl.ot_rayleigh[alts_higher]) + 
-                      sum(self.atm_profile_wl.ot_mie[alts_higher]) )   
-
-        # boolean if equal 
-        alts_equal = np.array( self.atm_profile_wl.Alt_bottom * 1000 == z )
-        
-        if sum(alts_equal): 
-            pass
-        else: # Alternative: find the layer where Z is in, find OT_remain_ratio...
-            
-            # calculate top altitudes - collision altitude
-            alts_diff = (self.atm_profile_wl.Alt_top - z/1000)
-            
-            alts_diff_positive_min = alts_diff[alts_diff>0].min()
-            
-            # edited 
-            alts_diff_positive_min_idx = alts_diff[alts_diff>0].idxmin()
-            height = self.atm_profile_wl.Alt_top[alts_diff_positive_min_idx] - self.atm_profile_wl.Alt_bottom[alts_diff_positive_min_idx]
-            OT_remain_ratio = alts_diff_positive_min / height        
-            
-            OT_layer = (self.atm_profile_wl.ot_abs[alts_diff_positive_min_idx] + 
-                        self.atm_profile_wl.ot_rayleigh[alts_diff_positive_min_idx] + 
-                        self.atm_profile_wl.ot_mie[alts_diff_positive_min_idx]  ) 
-            
-            OT_abs_remain = OT_layer * OT_remain_ratio 
-            OT_out = OT_out + OT_abs_remain
-        return OT_out
+        return self.OT_profile_wl.ext_to_TOA(q_collision[2])
 
     def _plot(self,q0,q1, scenario, intersect_tri_chosen=None, rotated=None, q_collision_N=None, specular_on=False, rotated_cm=None, linewidth=2.5):
         
+        # Plotting 
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.mplot3d import Axes3D
+        from mpl_toolkits.mplot3d.art3d import Poly3DCollection
         
         fig = plt.figure()
         ax = Axes3D(fig, auto_add_to_figure=False)
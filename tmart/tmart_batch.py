@@ -0,0 +1,401 @@
+# This file is part of T-Mart.
+#
+# Copyright 2023 Yulun Wu.
+#
+# T-Mart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Batch photon engine
+# All photons of a job move together as numpy arrays, one movement at a time.
+# Physics follows Tmart2._run_single_photon, the output is the same as Tmart2._diff_ref
+
+import numpy as np
+import math
+
+from .tm_move import pt_move_batch
+from .tm_sampling import sample_Lambertian_batch, sample_scattering_batch
+from .tm_geometry import dirP_to_coord, dirC_to_dirP, dirP_to_coord_batch, rotate_batch
+from .tm_intersect import intersect_line_DEMgrid, intersect_line_plane_batch, find_atm2_batch, intersect_background_batch
+from .tm_intersect import reflectance_intersect_batch, reflectance_background_batch
+from .tm_water import fresnel_batch, sample_cox_munk_batch, find_R_cm
+from .tm_tally import tally_from_array, TYPE_W, TYPE_WS, TYPE_L, TYPE_M, TYPE_R
+
+# The class is overwritten in Tmart
+class TmartBatch():
+
+    # A job of photons run together
+    def _run_batch(self, part_count):
+
+        rng = self._rng
+
+        pt_ids = np.asarray(part_count)
+        n = len(pt_ids)
+
+        # numpy atmospheric profile
+        atm_profile = self.OT_profile_wl.atm_profile
+
+        # Sun for local estimates, prepared once per job
+        self._batch_sun_C = dirP_to_coord(1, self.sun_dir)
+        self._batch_cos_sun = math.cos(self.sun_dir[0]/180*math.pi)
+
+        # Initial position of the photons
+        q0 = np.tile(np.array(self.sensor_coords, dtype=float), (n,1))
+        if self.pixel is not None:
+            q0[:,0] = q0[:,0] + self.Surface.cell_size * (self.pixel[1] + rng.random(n)) # X
+            q0[:,1] = q0[:,1] + self.Surface.cell_size * (self.pixel[0] + rng.random(n)) # Y
+            q0[:,2] = q0[:,2] + self.pixel_elevation
+
+        # Initial moving direction of the photons, in XYZ
+        if isinstance(self.target_pt_direction, str):
+            zenith, azimuthal = sample_Lambertian_batch(n, rng)
+            if self.target_pt_direction == 'lambertian_down': zenith = zenith + 90
+            pt_direction = dirP_to_coord_batch(1, zenith, azimuthal)
+        else:
+            pt_direction = np.tile(dirP_to_coord(1, self.target_pt_direction), (n,1))
+
+        pt_weight = np.full(n, 1_000_000.0)
+        alive = np.ones(n, dtype=bool)
+
+        # Optimization: when true, photons hitting the surface are dropped
+        black_surface = ((not self.Surface.reflectance.any()) and (not self.Surface.isWater.any()) and
+                         self.Surface.bg_ref[0]==0 and self.Surface.bg_ref[1]==0 and
+                         self.Surface.bg_isWater[0]==0 and self.Surface.bg_isWater[1]==0)
+        DEM_max = self.Surface.DEM_max
+
+        # The first reflection of a photon collects all the local estimates after it, see _diff_ref
+        first_ref = np.full(n, False)
+        first_ref_row = np.zeros((n,14))
+        first_ref_type = np.zeros(n, dtype=int)
+        first_ref_after = np.zeros(n)
+
+        rows = []
+
+        ### For loop: photon movements
+        for movement in range(0, 500):
+
+            idx = np.flatnonzero(alive)
+            if idx.size == 0: break
+            m = idx.size
+            self._n_movement += m
+
+            q0_m = q0[idx]
+            d_m = pt_direction[idx]
+
+            # sample optical thicknesses
+            sampled_tao = -np.log(1.0 - rng.random(m))
+
+            q1, tao_abs, out = pt_move_batch(self.OT_profile_wl, q0_m, d_m, sampled_tao)
+
+            ###### Three scenarios
+
+            # 1 Triangle collision
+            # 2 Background collision
+            # 3 Photon movement and scattering
+
+            scenario = np.full(m, 3)
+            q_collision = q1.copy()
+            q_collision_N = np.tile([0.0,0.0,1.0], (m,1))
+
+            ### Test triangle collision, unless both ends are above the max elevation of the DEM
+            test_tri = ~((DEM_max < q0_m[:,2]) & (DEM_max < q1[:,2]))
+            if self.Surface.flat_elevation is not None:
+                t = np.flatnonzero(test_tri)
+                hit, q_hit, N_hit = intersect_line_plane_batch(q0_m[t], q1[t], self.Surface.DEM_grid, 
+                                                               self.Surface.flat_elevation)
+                t = t[hit]
+                q_collision[t], q_collision_N[t], scenario[t] = q_hit[hit], N_hit[hit], 1
+            else:
+                for j in np.flatnonzero(test_tri):
+                    intersect_tri = intersect_line_DEMgrid(q0_m[j], q1[j], self.Surface.DEM_grid)
+                    if intersect_tri is not None:
+                        q_collision[j] = intersect_tri[0:3]
+                        q_collision_N[j] = intersect_tri[3:6]
+                        scenario[j] = 1
+
+            ### Background collision if outside the triangles on X or Y axies
+            intersect_bg = intersect_background_batch(q0_m, q1, self.Surface.bg_elevation)
+            outside = ((intersect_bg[:,0] < self.Surface.x_min) | (intersect_bg[:,0] > self.Surface.x_max) |
+                       (intersect_bg[:,1] < self.Surface.y_min) | (intersect_bg[:,1] > self.Surface.y_max))
+            bg = (scenario == 3) & (q1[:,2] < self.Surface.bg_elevation) & outside
+            scenario[bg] = 2
+            q_collision[bg] = intersect_bg[bg]
+
+            collision = scenario != 3
+
+            ### Black surface acceleration
+            if black_surface and np.any(collision):
+                alive[idx[collision]] = False
+                keep = ~collision
+                idx, m = idx[keep], np.sum(keep)
+                q0_m, d_m, q1, q_collision = q0_m[keep], d_m[keep], q1[keep], q_collision[keep]
+                tao_abs, out, scenario = tao_abs[keep], out[keep], scenario[keep]
+                collision = collision[keep]
+
+            new_direction = d_m.copy()
+            type_event = np.full(m, TYPE_R)
+            le = np.zeros((m,6)) # L_cox-munk, L_whitecap, L_water, L_land, L_rayleigh, L_mie
+
+            ### Triangle and background collisions
+            if np.any(collision):
+                c = np.flatnonzero(collision)
+                self._collide_batch(c, scenario, atm_profile, q0_m, d_m, q_collision, q_collision_N,
+                                    tao_abs, pt_weight, idx, new_direction, type_event, le, rng)
+
+            ### Photon movement and scattering
+            scatt = np.flatnonzero(~collision)
+            if scatt.size > 0:
+                ot_rayleigh, ot_mie = find_atm2_batch(atm_profile, q1[scatt])
+                new_direction[scatt], is_mie = sample_scattering_batch(ot_mie, ot_rayleigh, d_m[scatt], self.SPF_wl, rng)
+                type_event[scatt] = np.where(is_mie, TYPE_M, TYPE_R)
+
+                # Absorption, then local estimates of photons still in the atmosphere
+                pt_weight[idx[scatt]] = pt_weight[idx[scatt]] * np.exp(-tao_abs[scatt])
+
+                inside = scatt[~out[scatt]]
+                inside_in_scatt = ~out[scatt]
+                le[inside,4:6] = self._local_est_scat_batch(d_m[inside], q1[inside], pt_weight[idx[inside]],
+                                                            ot_mie[inside_in_scatt], ot_rayleigh[inside_in_scatt])
+
+            ###### Local estimates
+
+            # Every movement has a row of local_est, photons out of the atmosphere have none
+            has_row = collision | ~out
+            if_shadow = np.zeros(m, dtype=bool)
+            if self.shadow:
+                test = has_row & ~self._horizon_map().lit_batch(q_collision)
+                for j in np.flatnonzero(test):
+                    if_shadow[j] = self.detect_shadow(q_collision[j])
+
+            is_env = np.where(collision, int(movement > 0), 0)
+
+            local_est = np.zeros((m,14))
+            local_est[:,0] = pt_ids[idx]
+            local_est[:,1] = movement
+            local_est[:,2:8] = le
+            local_est[:,8:11] = q_collision
+            local_est[:,11] = if_shadow
+            local_est[:,12] = is_env
+            local_est[:,13] = type_event
+
+            # Photons with a reflection before: add to that reflection, skip shadowed
+            after = has_row & first_ref[idx]
+            add = np.where(if_shadow[after], 0, np.sum(le[after], axis=1))
+            first_ref_after[idx[after]] = first_ref_after[idx[after]] + add
+
+            # First reflection: keep the row until the end
+            new_ref = has_row & collision & ~first_ref[idx]
+            first_ref[idx[new_ref]] = True
+            first_ref_row[idx[new_ref]] = local_est[new_ref]
+            first_ref_type[idx[new_ref]] = type_event[new_ref]
+
+            # Scattering before any reflection
+            direct = has_row & ~collision & ~first_ref[idx]
+            rows.append(local_est[direct])
+
+            # Exit if out, start the next movement at the collision
+            alive[idx[out]] = False
+            q0[idx] = q_collision
+            pt_direction[idx] = new_direction
+
+            # Russian roulette of photons of low weight, as in _run_single_photon
+            if self.roulette is not None:
+                low = idx[alive[idx] & (pt_weight[idx] < self.roulette[0] * 1_000_000)]
+                survive = rng.random(low.size) * (self.roulette[1] * 1_000_000) < pt_weight[low]
+                pt_weight[low[survive]] = self.roulette[1] * 1_000_000
+                alive[low[~survive]] = False
+                self._n_roulette += int(np.sum(~survive))
+
+        rows.append(self._diff_ref_batch(first_ref_row[first_ref], first_ref_type[first_ref], first_ref_after[first_ref]))
+
+        pts_stat = np.vstack(rows)
+        pts_stat = pts_stat[np.lexsort((pts_stat[:,1], pts_stat[:,0]))]
+        return tally_from_array(pts_stat)
+
+
+    # Reflection at triangles (scenario 1) and background (scenario 2), edits arrays in place
+    def _collide_batch(self, c, scenario, atm_profile, q0_m, d_m, q_collision, q_collision_N,
+                       tao_abs, pt_weight, idx, new_direction, type_event, le, rng):
+
+        Surface = self.Surface
+        tri = c[scenario[c] == 1]
+        bg = c[scenario[c] == 2]
+
+        # Re-calculate absorption
+        tao_abs[c] = self.OT_profile_wl.abs_between(q0_m[c,2], q_collision[c,2]) / np.abs(d_m[c,2])
+
+        # Avoid intersecting again
+        q_collision[c,2] = q_collision[c,2] + 0.01
+
+        # Reflectance and if water at the collision points
+        q_collision_ref = np.zeros(len(scenario))
+        q_collision_isWater = np.zeros(len(scenario))
+        if Surface.homogeneous is not None:
+            q_collision_ref[c], q_collision_isWater[c] = Surface.homogeneous
+        else:
+            q_collision_ref[tri] = reflectance_intersect_batch(q_collision[tri], Surface.reflectance,
+                                                               Surface.cell_size, Surface.bg_ref, Surface.bg_coords)
+            q_collision_ref[bg] = reflectance_background_batch(q_collision[bg], Surface.bg_ref, Surface.bg_coords)
+            q_collision_isWater[c] = reflectance_intersect_batch(q_collision[c], Surface.isWater,
+                                                                 Surface.cell_size, Surface.bg_isWater, Surface.bg_coords)
+
+        # Direction of normal to the triangles
+        q_collision_N_polar = np.zeros((len(scenario),2))
+        for j in tri:
+            q_collision_N_polar[j] = dirC_to_dirP(q_collision_N[j])[0:2]
+
+        water = c[q_collision_isWater[c] == 1]
+        land = c[q_collision_isWater[c] != 1]
+        specular_on = np.zeros(len(scenario), dtype=bool)
+
+        ### If water --> there is a chance of specular reflectance
+        if water.size > 0:
+
+            # Opposite to pt_direction in XYZ coordinates
+            pt_direction_op_C = -d_m[water]
+
+            facet, in_angle = self._sample_facet_batch(pt_direction_op_C, scenario[water], q_collision_N_polar[water], rng)
+
+            R_specular = fresnel_batch(self.water_refraIdx_wl, in_angle)
+            R_surf = self.R_wc_wl + (1-self.F_wc_wl) * R_specular
+            q_collision_ref[water] = R_surf + (1-self.F_wc_wl) * q_collision_ref[water]
+            specular_on[water] = rng.random(water.size) * q_collision_ref[water] < R_specular
+
+            # Local estimates use the weight after reflection and absorption
+            pt_weight_water = pt_weight[idx[water]] * q_collision_ref[water] * np.exp(-tao_abs[water])
+            le[water,0:3] = self._local_est_water_batch(pt_weight_water, pt_direction_op_C, q_collision[water],
+                                                        q_collision_N_polar[water], q_collision_ref[water], R_surf)
+
+            # Specular reflection at the facet
+            spec = specular_on[water]
+            d_in = d_m[water[spec]]
+            new_direction[water[spec]] = d_in - 2 * np.sum(d_in * facet[spec], axis=1)[:,None] * facet[spec]
+            type_event[water[spec]] = TYPE_WS
+            type_event[water[~spec]] = TYPE_W
+
+        type_event[land] = TYPE_L
+
+        # Weight after reflection and absorption
+        pt_weight[idx[c]] = pt_weight[idx[c]] * q_collision_ref[c] * np.exp(-tao_abs[c])
+        le[land,3] = pt_weight[idx[land]] * self._local_est_T_batch(q_collision[land]) / 1_000_000
+
+        ### Else lambertian, tilted to the surface normal on triangles
+        lambertian = c[~specular_on[c]]
+        if lambertian.size > 0:
+            zenith, azimuthal = sample_Lambertian_batch(lambertian.size, rng)
+            random_lambertian = dirP_to_coord_batch(1, zenith, azimuthal)
+
+            N_polar = np.radians(q_collision_N_polar[lambertian])
+            axis = np.stack([np.cos(N_polar[:,1] + math.pi/2), np.cos(N_polar[:,1]), np.zeros(lambertian.size)], axis=1)
+            rotated = rotate_batch(axis, N_polar[:,0], random_lambertian)
+            new_direction[lambertian] = rotated / np.linalg.norm(rotated, axis=1)[:,None]
+
+
+    # Draw Cox-Munk facet normals for water collisions, the same as in _run_single_photon
+    def _sample_facet_batch(self, pt_direction_op_C, scenario, q_collision_N_polar, rng):
+
+        facet = np.empty((len(scenario),3))
+        in_angle = np.empty(len(scenario))
+        pt_direction_op_C = pt_direction_op_C / np.linalg.norm(pt_direction_op_C, axis=1)[:,None]
+
+        # If an impossible angle (CM does it sometimes), re-randomize
+        pending = np.arange(len(scenario))
+        while pending.size > 0:
+
+            random_cox_munk = sample_cox_munk_batch(pending.size, self.wind_speed, self.wind_dir, rng)
+
+            # Azimuthally averaged sampling
+            if self.wind_azi_avg:
+                random_cox_munk2 = sample_cox_munk_batch(pending.size, self.wind_speed, self.wind_dir+90, rng)
+                random_cox_munk = (random_cox_munk + random_cox_munk2) / 2
+            random_cox_munk = random_cox_munk / np.linalg.norm(random_cox_munk, axis=1)[:,None]
+
+            # tilt cox_munk to the triangle normal
+            tilted = pending[scenario[pending] == 1]
+            if tilted.size > 0:
+                N_polar = np.radians(q_collision_N_polar[tilted])
+                axis = np.stack([np.cos(N_polar[:,1] + math.pi/2), np.cos(N_polar[:,1]), np.zeros(tilted.size)], axis=1)
+                k = scenario[pending] == 1
+                random_cox_munk[k] = rotate_batch(axis, N_polar[:,0], random_cox_munk[k])
+
+            facet[pending] = random_cox_munk
+            in_angle[pending] = np.degrees(np.arccos(np.clip(np.sum(random_cox_munk * pt_direction_op_C[pending], axis=1), -1, 1)))
+            pending = pending[in_angle[pending] > 90]
+
+        return facet, in_angle
+
+
+    # Direct transmittance between the points and TOA towards the sun
+    def _local_est_T_batch(self, q_collision):
+        OT = self.OT_profile_wl.ext_to_TOA(q_collision[:,2])
+        return np.exp(-OT / self._batch_cos_sun)
+
+    def _local_est_scat_batch(self, pt_direction_C, q_collision, pt_weight, ot_mie, ot_rayleigh):
+
+        T = self._local_est_T_batch(q_collision)
+        ot_scattering = ot_mie + ot_rayleigh
+
+        # The angle needed to scatter the photon into the sun's direction
+        cos_scattering = np.clip(pt_direction_C @ self._batch_sun_C, -1, 1)
+        angle_scattering = np.degrees(np.arccos(cos_scattering))
+
+        rayleigh = (3/4)*(1+cos_scattering**2)
+        rayleigh_c = rayleigh / self._batch_cos_sun / 4 * (ot_rayleigh/ot_scattering)
+
+        mie = self.SPF_wl.value(angle_scattering)
+        mie_c = mie / self._batch_cos_sun / 4 * (ot_mie/ot_scattering)
+
+        return np.stack([rayleigh_c, mie_c], axis=1) * (T * pt_weight / 1_000_000)[:,None]
+
+    def _local_est_water_batch(self, pt_weight, pt_direction_op_C, q_collision, q_collision_N_polar, q_collision_ref, R_surf):
+
+        # Flat water from the table of the run 
+        R_cm = np.empty(len(pt_weight))
+        flat = q_collision_N_polar[:,0] == 0
+        if flat.any():
+            R_cm[flat] = self._glint_table().value_batch(pt_direction_op_C[flat])
+        
+        for k in np.flatnonzero(~flat):
+            R_cm[k] = find_R_cm(pt_direction_op_C[k], self.sun_dir, q_collision_N_polar[k],
+                                self.wind_dir, self.wind_speed, self.water_refraIdx_wl, False)
+
+            # Average = (regular + wind 90 degrees) / 2
+            if self.wind_azi_avg:
+                R_cm2 = find_R_cm(pt_direction_op_C[k], self.sun_dir, q_collision_N_polar[k],
+                                  self.wind_dir + 90, self.wind_speed, self.water_refraIdx_wl, False)
+                R_cm[k] = (R_cm[k] + R_cm2) / 2
+
+        R_cm = (1-self.F_wc_wl) * R_cm # remove whitecaps from cox-munk reflection
+        T = self._local_est_T_batch(q_collision)
+
+        # cox-munk, whitecap and water-leaving
+        local_est = np.stack([pt_weight * (R_cm / q_collision_ref),
+                              pt_weight * (self.R_wc_wl / q_collision_ref),
+                              pt_weight * ((q_collision_ref - R_surf) / q_collision_ref)], axis=1) / 1_000_000
+        return local_est * T[:,None]
+
+
+    # Differentiate reflectances of the first reflections, same as _diff_ref
+    def _diff_ref_batch(self, first_ref_row, first_ref_type, first_ref_after):
+
+        rows = first_ref_row.copy()
+        shadowed = rows[:,11] == 1
+
+        # Water lambertian and land: adding all after to L_whitecap, L_water, L_land
+        lambertian = (first_ref_type == TYPE_W) | (first_ref_type == TYPE_L)
+        total = np.sum(rows[:,3:6], axis=1)
+
+        # Black surface, the photon is dropped from here
+        keep = ~(lambertian & (total == 0))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = rows[:,3:6] / total[:,None]
+        total_new = np.where(shadowed, 0, total) + first_ref_after
+        rows[lambertian,3:6] = total_new[lambertian,None] * ratios[lambertian]
+
+        # Water specular: adding all after to L_coxmunk
+        specular = first_ref_type == TYPE_WS
+        rows[specular,2] = np.where(shadowed[specular], 0, rows[specular,2]) + first_ref_after[specular]
+
+        return rows[keep]
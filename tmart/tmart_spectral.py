@@ -0,0 +1,335 @@
+# This file is part of T-Mart.
+#
+# Copyright 2024 Yulun Wu.
+#
+# T-Mart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Correlated multi-wavelength engine
+# Paths are sampled once with the largest Rayleigh and Mie OTs of all wavelengths in each layer.
+# Each wavelength carries a weight: the ratio of the probabilities of the path at the wavelength
+# and in sampling, times absorption and reflectance. Local estimates use a Tmart of each wavelength,
+# the output of each wavelength is the same as Tmart2._diff_ref
+
+import numpy as np
+import math
+import bisect
+import sys
+from copy import copy
+
+from .tm_move import pt_move
+from .tm_OT import OTProfile
+from .tm_sampling import sample_Lambertian, sample_scattering
+from .tm_geometry import dirP_to_coord, dirC_to_dirP, rotation_matrix, angle_3d
+from .tm_intersect import intersect_line_surface, intersect_background, reflectance_intersect, reflectance_background
+from .tm_water import fresnel_batch, sample_cox_munk
+from .tm_tally import tally_empty, tally_sum, tally_merge, TYPE_CODES
+
+# Photons of a job in streaming mode before reducing their records to sums
+SPECTRAL_BUFFER = 10_000
+
+
+# The class is overwritten in Tmart
+class TmartSpectral():
+
+    # A Tmart of each wavelength and the profile to sample paths, before the scene goes to the workers
+    def _init_spectral(self, wls, bands, reflectance, bg_ref):
+
+        self.spectral_wl = None
+        spectral = []
+        for wl, band in zip(wls, bands):
+            my_tmart = copy(self)
+            my_tmart.wl = wl
+            my_tmart._init_atm(band)
+            spectral.append(my_tmart)
+
+        # Layers of all wavelengths, from the bottom: Alt_bottom, Alt_top, ot_abs, ot_rayleigh, ot_mie, ot_scatt
+        profiles = np.array([my_tmart.OT_profile_wl.atm_profile[:,0:6] for my_tmart in spectral], dtype=float)
+        if not np.all(profiles[:,:,0:2] == profiles[0,:,0:2]):
+            sys.exit('Atmospheric layers have to be the same at all wavelengths')
+
+        # Sampling: the largest Rayleigh and Mie OTs in each layer, no absorption
+        profile = profiles[0].copy()
+        profile[:,2] = 0
+        profile[:,3] = profiles[:,:,3].max(axis=0)
+        profile[:,4] = profiles[:,:,4].max(axis=0)
+        profile[:,5] = profile[:,3] + profile[:,4]
+        self._spectral_profile = OTProfile(profile)
+
+        # Cumulative absorption and scattering OT of the wavelengths, layer tops in km
+        self._spectral_cum = np.stack([np.concatenate([np.zeros((len(wls),1)), np.cumsum(profiles[:,:,i], axis=1)], axis=1)
+                                       for i in [2, 3, 4]])
+        self._spectral_cum = np.stack([self._spectral_cum[0], self._spectral_cum[1] + self._spectral_cum[2]])
+        self._spectral_layers = profiles[:,:,3:5]
+        self._spectral_tops = profile[:,1].tolist()
+
+        # Mie of the middle wavelength is sampled, per solid angle
+        self._spectral_SPF = spectral[len(wls)//2].SPF_wl
+        self._spectral_mie = np.array([np.maximum(my_tmart.SPF_wl.values, 0) / my_tmart.SPF_wl.norm for my_tmart in spectral])
+        self._spectral_mie_ref = np.maximum(self._spectral_SPF.values, 0) / self._spectral_SPF.norm
+
+        # Surface reflectance of the wavelengths in the last axis
+        shape = self.Surface.reflectance.shape
+        self._spectral_reflectance = np.stack([np.broadcast_to(np.asarray(r, dtype=float), shape) for r in reflectance], axis=-1)
+        bg_ref = [b if isinstance(b, list) else [b, b] for b in bg_ref]
+        self._spectral_bg_ref = [np.array([b[0] for b in bg_ref], dtype=float), np.array([b[1] for b in bg_ref], dtype=float)]
+
+        self.spectral_wl = spectral
+
+
+    # Absorption and scattering OTs of the wavelengths between altitudes z0 and z1, and sampling scattering OT
+    def _spectral_between(self, z0, z1, mu):
+
+        alts = self._spectral_profile.alts_list
+        ots = []
+        for z in [z0, z1]:
+            i = min(max(bisect.bisect_right(alts, z) - 1, 0), len(alts)-2)
+            f = min(max((z - alts[i]) / (alts[i+1] - alts[i]), 0), 1)
+            ots.append(self._spectral_cum[:,:,i] + f * (self._spectral_cum[:,:,i+1] - self._spectral_cum[:,:,i]))
+
+        profile = self._spectral_profile
+        ot_sampling = abs(np.interp(z1, profile.alts, profile.cum_scatt) - np.interp(z0, profile.alts, profile.cum_scatt))
+
+        tao_abs, tao_scatt = np.abs(ots[1] - ots[0]) / mu
+        return tao_abs, tao_scatt, ot_sampling / mu
+
+
+    # A job: records or sums of each wavelength
+    def _run_spectral(self, part_count):
+
+        n_wl = len(self.spectral_wl)
+        outputs = [[] for k in range(n_wl)]
+        tallies = [[] for k in range(n_wl)]
+
+        for n, i in enumerate(part_count):
+            pt_stats = self._run_spectral_photon(i)
+            for k in range(n_wl):
+                outputs[k].append(pt_stats[k])
+
+            # Reduce to sums now and then
+            if self.streaming and (n+1) % SPECTRAL_BUFFER == 0:
+                for k in range(n_wl):
+                    tallies[k].append(tally_sum(np.concatenate(outputs[k]), self.hist_bins))
+                    outputs[k] = []
+
+        if self.streaming:
+            return [tally_merge(tallies[k] + [tally_sum(np.concatenate(outputs[k] + [tally_empty(0)]), self.hist_bins)])
+                    for k in range(n_wl)]
+
+        return [np.concatenate(outputs[k] + [tally_empty(0)]) for k in range(n_wl)]
+
+
+    # A single photon, followed at all wavelengths
+    def _run_spectral_photon(self, pt_id):
+
+        rng = self._rng
+        spectral = self.spectral_wl
+        n_wl = len(spectral)
+        OT_profile = self._spectral_profile
+
+        # Initial position and direction of the photon, as in _run_single_photon
+        if self.pixel == None:
+            q0 = self.sensor_coords
+        else:
+            pixel_x = self.Surface.cell_size * (self.pixel[1] + rng.random()) # X
+            pixel_y = self.Surface.cell_size * (self.pixel[0] + rng.random()) # Y
+            q0 = self.sensor_coords + [pixel_x,pixel_y,self.pixel_elevation]
+
+        if self.target_pt_direction == 'lambertian_up':
+            pt_direction = sample_Lambertian(rng)[1]
+        elif self.target_pt_direction == 'lambertian_down':
+            pt_direction = sample_Lambertian(rng)[1]
+            pt_direction[0] = pt_direction[0] + 90
+        else:
+            pt_direction = self.target_pt_direction
+
+        pt_weight = np.full(n_wl, 1_000_000.0)
+
+        # Black at all wavelengths, exit at collisions
+        black_surface = ((not self._spectral_reflectance.any()) and (not self.Surface.isWater.any()) and
+                         (not self._spectral_bg_ref[0].any()) and (not self._spectral_bg_ref[1].any()) and
+                         self.Surface.bg_isWater[0]==0 and self.Surface.bg_isWater[1]==0)
+
+        pt_stat = [tally_empty(500) for k in range(n_wl)]
+        n_stat = 0
+
+        for movement in range(0, 500):
+
+            sampled_tao = -math.log(1.0 - rng.random())
+            q1, tao_abs_NA, ot_rayleigh_NA, ot_mie_NA, out = pt_move(OT_profile, q0, pt_direction, sampled_tao)
+            mu = max(abs(math.cos(pt_direction[0]/180*math.pi)), 1e-12)
+
+            ### Scenarios, as in _run_single_photon
+            if self.Surface.DEM_max < q0[2] and self.Surface.DEM_max < q1[2]:
+                intersect_tri = None
+            else:
+                intersect_tri = intersect_line_surface(q0, q1, self.Surface)
+
+            if intersect_tri is not None:
+                scenario = 1
+            else:
+                intersect_bg = intersect_background(q0, q1, self.Surface.bg_elevation)
+                intersect_bg_x = intersect_bg[0] < self.Surface.x_min or intersect_bg[0] > self.Surface.x_max
+                intersect_bg_y = intersect_bg[1] < self.Surface.y_min or intersect_bg[1] > self.Surface.y_max
+                if q1[2]<self.Surface.bg_elevation and (intersect_bg_x or intersect_bg_y):
+                    scenario = 2
+                else:
+                    scenario = 3
+
+            if (scenario == 1 or scenario == 2) and black_surface:
+                break
+
+            # Leaving the atmosphere, nothing more to estimate
+            if scenario == 3 and out:
+                break
+
+            if scenario == 1:
+                q_collision = intersect_tri.tolist()[0:3]
+                q_collision_N_polar = dirC_to_dirP(intersect_tri.tolist()[3:6])
+            elif scenario == 2:
+                q_collision = intersect_bg
+                q_collision_N_polar = [0,0]
+            else:
+                q_collision = q1
+
+            # Probability of the movement at each wavelength over the one in sampling, and absorption
+            tao_abs, tao_scatt, tao_sampling = self._spectral_between(q0[2], q_collision[2], mu)
+            pt_weight = pt_weight * np.exp(tao_sampling - tao_scatt - tao_abs)
+
+            if_shadow = False
+
+            ### Reflection
+            if scenario == 1 or scenario == 2:
+
+                # Avoid intersecting again
+                q_collision[2] = q_collision[2] + 0.01
+                pt_direction_op_C = np.negative(dirP_to_coord(1, pt_direction))
+
+                # Reflectance of each wavelength, and if water
+                if scenario == 1:
+                    q_collision_ref = reflectance_intersect(q_collision, self._spectral_reflectance, self.Surface.cell_size,
+                                                            self._spectral_bg_ref, self.Surface.bg_coords)
+                else:
+                    q_collision_ref = reflectance_background(q_collision, self._spectral_bg_ref, self.Surface.bg_coords)
+                q_collision_isWater = reflectance_intersect(q_collision, self.Surface.isWater, self.Surface.cell_size,
+                                                            self.Surface.bg_isWater, self.Surface.bg_coords)
+
+                if q_collision_isWater == 1:
+
+                    in_angle = 100
+                    while in_angle>90:
+                        random_cox_munk = sample_cox_munk(self.wind_speed, self.wind_dir, rng)
+                        if self.wind_azi_avg:
+                            random_cox_munk2 = sample_cox_munk(self.wind_speed, self.wind_dir+90, rng)
+                            random_cox_munk = (random_cox_munk + random_cox_munk2) / 2
+
+                        # tilt cox_munk to the normal of the triangle
+                        if scenario == 1:
+                            axis = [math.cos((q_collision_N_polar[1]+90)*math.pi/180),
+                                    math.cos(q_collision_N_polar[1]*math.pi/180),
+                                    0]
+                            random_cox_munk = np.dot(rotation_matrix(axis, q_collision_N_polar[0]*math.pi/180), random_cox_munk)
+                        in_angle = angle_3d(random_cox_munk, [0,0,0], pt_direction_op_C)
+
+                    # Fresnel, whitecaps and water-leaving reflectance of each wavelength
+                    R_specular = fresnel_batch(np.array([my_tmart.water_refraIdx_wl for my_tmart in spectral]), np.full(n_wl, in_angle))
+                    F_wc = np.array([my_tmart.F_wc_wl for my_tmart in spectral])
+                    R_surf = np.array([my_tmart.R_wc_wl for my_tmart in spectral]) + (1-F_wc) * R_specular
+                    q_collision_ref = R_surf + (1-F_wc) * q_collision_ref
+
+                    # Specular part of the reflectance, at most q_collision_ref as the chance in _run_single_photon
+                    R_specular_on = np.minimum(R_specular, q_collision_ref)
+
+                    # Chance of specular reflection averaged over the wavelengths, so that both are sampled
+                    # wherever a wavelength has them, the weights correct for the chance of each
+                    chance_specular = np.mean(R_specular_on / q_collision_ref)
+                    specular_on = rng.random() < chance_specular
+
+                    le = [my_tmart.local_est_water(pt_weight[k] * q_collision_ref[k], pt_direction_op_C, q_collision,
+                                                   q_collision_N_polar, R_specular[k], q_collision_ref[k], R_surf[k])
+                          for k, my_tmart in enumerate(spectral)]
+
+                    if specular_on:
+                        pt_weight = pt_weight * R_specular_on / chance_specular
+                        rotated = np.dot(rotation_matrix(random_cox_munk, math.pi), pt_direction_op_C)
+                        pt_direction = dirC_to_dirP(rotated)[0:2]
+                        tpye_collision = 'Ws'
+                    else:
+                        pt_weight = pt_weight * (q_collision_ref - R_specular_on) / (1 - chance_specular)
+                        tpye_collision = 'W'
+
+                    local_est = [[pt_id, movement] + le[k] + [0,0,0] + q_collision + [0,0,tpye_collision] for k in range(n_wl)]
+
+                else:
+                    local_est = [[pt_id, movement,0,0,0] + spectral[k].local_est_land(q_collision, pt_weight[k] * q_collision_ref[k]) +
+                                 [0,0] + q_collision + [0,0,'L'] for k in range(n_wl)]
+                    pt_weight = pt_weight * q_collision_ref
+                    specular_on = False
+
+                # Lambertian reflection, tilted to the triangle
+                if not specular_on:
+                    random_lambertian = sample_Lambertian(rng)
+                    if scenario == 1:
+                        axis = [math.cos((q_collision_N_polar[1]+90)*math.pi/180),
+                                math.cos(q_collision_N_polar[1]*math.pi/180),
+                                0]
+                        rotated = np.dot(rotation_matrix(axis, q_collision_N_polar[0]*math.pi/180), random_lambertian[0])
+                        pt_direction = dirC_to_dirP(rotated)[0:2]
+                    else:
+                        pt_direction = random_lambertian[1]
+
+                is_env = 0 if movement == 0 else 1
+
+            ### Scattering
+            else:
+
+                pt_direction_op_C = np.negative(dirP_to_coord(1, pt_direction))
+
+                # Layer of the scattering
+                layer = min(bisect.bisect_left(self._spectral_tops, q1[2]/1000), len(self._spectral_tops)-1)
+                ot_rayleigh, ot_mie = self._spectral_layers[:,layer,0], self._spectral_layers[:,layer,1]
+                ot_rayleigh_ref, ot_mie_ref = OT_profile.atm_profile[layer,3], OT_profile.atm_profile[layer,4]
+                ot_scatt, ot_scatt_ref = ot_rayleigh + ot_mie, ot_rayleigh_ref + ot_mie_ref
+
+                # Probability of scattering here
+                pt_weight = pt_weight * ot_scatt / ot_scatt_ref
+
+                le = [my_tmart.local_est_scat(pt_direction_op_C, q1, pt_weight[k], ot_mie[k], ot_rayleigh[k])
+                      if ot_scatt[k] > 0 else [0,0] for k, my_tmart in enumerate(spectral)]
+
+                pt_direction, scatt_intensity, type_scat = sample_scattering(ot_mie_ref, ot_rayleigh_ref, pt_direction,
+                                                                             self._spectral_SPF, False, rng)
+
+                # Probability of the scattering angle at each wavelength over the one in sampling, per solid angle
+                cos_angle = min(max(-np.dot(pt_direction_op_C, dirP_to_coord(1, pt_direction)), -1), 1)
+                angles = self._spectral_SPF.angles
+                i = min(int(math.degrees(math.acos(cos_angle)) / (angles[1] - angles[0])), len(angles)-2)
+                f = (math.degrees(math.acos(cos_angle)) - angles[i]) / (angles[1] - angles[0])
+                rayleigh = 3 / (16*math.pi) * (1 + cos_angle**2)
+                mie = self._spectral_mie[:,i] + f * (self._spectral_mie[:,i+1] - self._spectral_mie[:,i])
+                mie_ref = self._spectral_mie_ref[i] + f * (self._spectral_mie_ref[i+1] - self._spectral_mie_ref[i])
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    ratio = (ot_rayleigh * rayleigh + ot_mie * mie) / ot_scatt
+                pt_weight = pt_weight * np.where(ot_scatt > 0, ratio, 0) / ((ot_rayleigh_ref * rayleigh + ot_mie_ref * mie_ref) / ot_scatt_ref)
+
+                local_est = [[pt_id, movement,0,0,0,0] + le[k] + q1.tolist() + [0,0,type_scat] for k in range(n_wl)]
+                is_env = 0
+
+            # Records of the wavelengths, the shadow is the same
+            if self.shadow: if_shadow = self.detect_shadow(q_collision)
+            for k in range(n_wl):
+                local_est[k][12] = is_env
+                if if_shadow: local_est[k][11] = 1
+                pt_stat[k][n_stat] = tuple(local_est[k][0:13]) + (TYPE_CODES[local_est[k][13]],)
+            n_stat += 1
+
+            if out:
+                break
+
+            q0 = q_collision
+
+        self._n_movement += movement + 1
+
+        return [self._diff_ref(pt_stat[k][:n_stat]) for k in range(n_wl)]